@@ -1,5 +1,6 @@
 #! /usr/bin/env python
 import os
+import sys
 import time
 import subprocess
 
@@ -9,7 +10,7 @@ import scipy
 
 # ETS imports
 from enthought.traits.api import HasTraits, Instance, Str, Enum, Any, List, Array, Dict, Button, NO_COMPARE, Float, \
-    File, Directory, on_trait_change, HTML, Range
+    File, Directory, on_trait_change, HTML, Range, Int, Bool
 
 from enthought.traits.ui.api import View, Item, Group, VGroup, HGroup, EnumEditor, TableEditor, TabularEditor, spring, Spring, \
     HTMLEditor, HSplit, VSplit, VGrid, RangeEditor
@@ -21,20 +22,50 @@ from enthought.enable.api import Component, ComponentEditor, Window
 
 from enthought.chaco.tools.api import PanTool, ZoomTool, LegendTool, TraitsTool, DragZoom
 
-from spectrum_plot_view import make_spectrum_plot, save_plot
+from enthought.pyface.api import GUI
+from enthought.pyface.timer.api import do_after
+
+from spectrum_plot_view import make_spectrum_plot, make_waterfall_plot, save_plot, waterfall_image
 from detection_limits_helpers import detection_limits_to_html, detection_limits_to_tsv
 
 from function_lib import calc_det_limit, calc_det_limit_sel
 
+# Shared PYRAMDS modules live one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from histogram_service import HistogramService
+from peak_fit import PeakFitter
+from peak_search import PeakSearch
+from pyramid import SpectrumPyramid
+from spectrogram import Spectrogram
+
 np = numpy
 tb = tables
 
 size = (500, 500)
 
+# Milliseconds the time sliders must rest before the full-resolution
+# spectrum replaces the coarse one drawn while dragging
+REFINE_DELAY = 150
+
 class PyramdsView(HasTraits):
     plot = Instance(Component)
     index_selections = List
     peak_indices = Dict
+    peak_searches = Dict
+    peak_fitters = Dict
+
+    # Level-of-detail spectra for time scrubbing, and the latest pending
+    # full-resolution redraw
+    pyramid = Any()
+    refine_token = Int(0)
+
+    # Cached time-window reads on a worker thread
+    histograms = Any()
+
+    # Time x energy waterfall, re-rendered from cached tiles on pan/zoom
+    waterfall = Instance(Component)
+    spectrogram = Any()
+    waterfall_busy = Bool(False)
 
     # Database info
     filename = File
@@ -60,6 +91,7 @@ class PyramdsView(HasTraits):
     hist = Array(dtype=int)
     pchn = Array(dtype=int)
     peak = Array(dtype=int)
+    bkg = Array(dtype=float)
 
     title = Str("")
     linlog_toggle = Enum(["Linear", "Log"])
@@ -114,7 +146,11 @@ class PyramdsView(HasTraits):
         VGroup(
             Group(Item('filename', label="Data File")),
             HSplit(
-                Item('plot', editor=ComponentEditor(size=size), show_label=False),
+                Group(
+                    Group(Item('plot', editor=ComponentEditor(size=size), show_label=False), label="Spectrum"),
+                    Group(Item('waterfall', editor=ComponentEditor(size=size), show_label=False), label="Waterfall"),
+                    layout='tabbed',
+                ),
                 VGroup(
                     HGroup(spring, Item('detection_limits_title', style='readonly', show_label=False), spring),
                     VGroup(
@@ -177,6 +213,13 @@ class PyramdsView(HasTraits):
         hist_set = getattr(hist_grp, "{0}{1}_spec".format(self.spectrum_set_names[self.spectrum], self.detector))
         return hist_set
 
+    def get_background_data_set(self):
+        # SNIP continuum stored by the parser; None for older files
+        if "background" not in self.dfr:
+            return None
+        bkg_name = "{0}{1}_bkg".format(self.spectrum_set_names[self.spectrum], self.detector)
+        return getattr(self.dfr.background, bkg_name, None)
+
     def load_histogram_data(self):
         hist_set = self.get_histogram_data_set()
         hist = hist_set[-1]
@@ -184,25 +227,36 @@ class PyramdsView(HasTraits):
         pchn = np.array([])
         peak = np.array([])
 
+        bkg_set = self.get_background_data_set()
+        if bkg_set is None:
+            bkg = np.zeros(len(hist))
+        else:
+            bkg = bkg_set[-1]
+
         self.peak_indices = {}
+        self.pyramid = SpectrumPyramid.load(self.datafile, hist_set)
+
+        if self.histograms is not None:
+            self.histograms.close()
+        self.histograms = HistogramService([hist_set, bkg_set], self._histogram_ready, self.pyramid)
+        self.spectrogram = Spectrogram(hist_set, self.histograms.lock)
 
         self.chan = chan
         self.hist = hist
         self.pchn = pchn
         self.peak = peak
+        self.bkg = bkg
 
     def load_sig_lookup(self):
         sig_lookup = {"1": {}, "2": {}}
 
         for n in ["1", "2"]:
             sig_table = getattr(self.dfr.sig_lookup, "det{0}_sig".format(n))
-            # init isolists
-            for row in sig_table:
-                sig_lookup[n][row['name']] = []
 
-            # Add data
-            for row in sig_table:
-                sig_lookup[n][row['name']].append( (row['LM'], row['RM']) )
+            # One read of the table, grouping marker pairs by isotope
+            rows = sig_table.read()
+            for name, LM, RM in zip(rows['name'], rows['LM'], rows['RM']):
+                sig_lookup[n].setdefault(name, []).append((LM, RM))
 
         self.sig_lookup = sig_lookup
 
@@ -211,10 +265,21 @@ class PyramdsView(HasTraits):
         self.fwhm_coeff_1 = self.dfr.sig_lookup.fwhm_coeff_1.read()
         self.fwhm_coeff_2 = self.dfr.sig_lookup.fwhm_coeff_2.read()
 
+        # Peak searches (with their result caches) for each detector
+        n_bins = len(self.hist)
+        self.peak_searches = {
+            "1": PeakSearch.from_coeffs(self.fwhm_coeff_1, n_bins),
+            "2": PeakSearch.from_coeffs(self.fwhm_coeff_2, n_bins),
+            }
 
-    def calc_histogram_data(self):
-        hist_set = self.get_histogram_data_set()
-        len_set = len(hist_set)
+        # Peak fitters (memoized by spectrum) giving the net areas
+        self.peak_fitters = {
+            "1": PeakFitter.from_coeffs(self.fwhm_coeff_1, n_bins),
+            "2": PeakFitter.from_coeffs(self.fwhm_coeff_2, n_bins),
+            }
+
+    def calc_time_indices(self):
+        len_set = len(self.get_histogram_data_set())
 
         # Calculate lower index
         lower_index = int( np.floor(len_set * self.start_time / self.end_time_high) )
@@ -226,15 +291,58 @@ class PyramdsView(HasTraits):
         if upper_index == len_set:
             upper_index = upper_index - 1
 
-        # Calculate histogram
-        hist = hist_set[upper_index] - hist_set[lower_index]
-        return hist
+        return lower_index, upper_index
+
+    def background_window(self, bkg):
+        if bkg is None:
+            return np.zeros(len(self.hist))
+
+        # The continuum is close to additive, so a time window uses the
+        # difference of the stored rows rather than a new SNIP pass
+        return np.maximum(bkg, 0.0)
 
     def draw_plot(self):
         label = "Detector {0} {1} Spectrum".format(self.detector, self.spectrum)
         en_coeff = getattr(self, "en_coeff_{0}".format(self.detector))
-        plot = make_spectrum_plot(self.chan, self.hist, self.pchn, self.peak, en_coeff, label, self.linlog_toggle)
+        plot = make_spectrum_plot(self.chan, self.hist, self.pchn, self.peak, en_coeff, label, self.linlog_toggle, self.bkg)
         self.plot = plot
+        self.draw_waterfall()
+
+    def draw_waterfall(self):
+        label = "Detector {0} {1} Waterfall".format(self.detector, self.spectrum)
+        en_coeff = getattr(self, "en_coeff_{0}".format(self.detector))
+        sg = self.spectrogram
+        image, row_edges, chan_edges = sg.image(0, sg.n_chunks, 0, sg.n_bins, size[1], size[0])
+        waterfall = make_waterfall_plot(image, chan_edges, self.row_times(row_edges), en_coeff, label)
+
+        waterfall.index_range.on_trait_change(self.update_waterfall, 'updated')
+        waterfall.value_range.on_trait_change(self.update_waterfall, 'updated')
+        self.waterfall = waterfall
+
+    def row_times(self, rows):
+        return rows * self.get_total_time() / max(self.spectrogram.n_chunks, 1)
+
+    def update_waterfall(self):
+        # Re-render the visible part at screen resolution; tiles already
+        # seen come from the spectrogram's cache
+        if self.waterfall is None or self.waterfall_busy:
+            return
+        self.waterfall_busy = True
+        try:
+            sg = self.spectrogram
+            x_range = self.waterfall.index_range
+            y_range = self.waterfall.value_range
+            rows_per_sec = sg.n_chunks / max(self.get_total_time(), 1e-9)
+
+            image, row_edges, chan_edges = sg.image(
+                np.floor(y_range.low * rows_per_sec), np.ceil(y_range.high * rows_per_sec),
+                np.floor(x_range.low), np.ceil(x_range.high), size[1], size[0])
+
+            renderer = self.waterfall.plots['waterfall'][0]
+            self.waterfall.data.set_data('imagedata', waterfall_image(image))
+            renderer.index.set_data(chan_edges, self.row_times(row_edges))
+        finally:
+            self.waterfall_busy = False
 
     def redraw_hist_plot(self):
         self.plot.plots['plot0'][0].index.set_data(self.chan)
@@ -244,9 +352,48 @@ class PyramdsView(HasTraits):
         self.plot.plots['plot1'][0].index.set_data(self.pchn)
         self.plot.plots['plot1'][0].value.set_data(self.peak)
 
+    def redraw_bkg_plot(self):
+        self.plot.plots['plot2'][0].index.set_data(self.chan)
+        self.plot.plots['plot2'][0].value.set_data(self.bkg)
+
     def redraw_plot(self):
         self.redraw_hist_plot()
         self.redraw_peak_plot()
+        self.redraw_bkg_plot()
+
+    def calc_net_areas(self):
+        # Every selected peak of the current window is fitted in one batch,
+        # on the stored continuum; the fitted areas are the net counts shown
+        if self.detector not in self.peak_fitters:
+            return
+
+        clicked = self.detection_limits['clicked_selected']
+        lookup = self.detection_limits['lookup_selected']
+
+        keys = sorted(clicked.keys())
+        centres = []
+        for si in keys:
+            roi = self.peak_indices.get(si, [si])
+            centres.append(0.5 * (roi[0] + roi[-1]))
+        for row in lookup:
+            markers = self.sig_lookup[self.detector][row[0]][int(row[1])-1]
+            centres.append(0.5 * (markers[0] + markers[1]))
+
+        if centres == []:
+            return
+
+        fits = self.peak_fitters[self.detector](self.hist, centres, self.bkg)[0]
+        nets = []
+        for fit in fits:
+            if fit['converged']:
+                nets.append([fit['area'], fit['area_err']])
+            else:
+                nets.append([np.nan, np.nan])
+
+        for si, net in zip(keys, nets):
+            clicked[si][2:] = net
+        for row, net in zip(lookup, nets[len(keys):]):
+            row[4:] = net
 
     def draw_detection_limits(self):
         detection_limits_html = detection_limits_to_html(self.detection_limits)
@@ -264,10 +411,59 @@ class PyramdsView(HasTraits):
         self.peaknum_enum = peaknum_enum
         self.peaknum = peaknum
 
+    def visible_channels(self):
+        index_range = self.plot.index_range
+        return max(int(index_range.high - index_range.low), 1)
+
     def time_changed(self):
+        self.refine_token += 1
+        if self.pyramid is None:
+            self.refine_histogram(self.refine_token)
+            return
+
+        # While a slider moves, draw the coarsest pyramid level that still
+        # fills the plot at the current zoom: straight away if it is in
+        # memory, otherwise once the worker has read it. The full spectrum
+        # follows once the slider has rested for REFINE_DELAY
+        lower_index, upper_index = self.calc_time_indices()
+        level = self.pyramid.level_for(self.visible_channels(), size[0])
+        coarse = self.histograms.cached(lower_index, upper_index, level)
+        if coarse is not None:
+            self.show_coarse(*coarse)
+        else:
+            self.histograms.request(lower_index, upper_index, self.refine_token, level)
+
+        do_after(REFINE_DELAY, self.refine_histogram, self.refine_token)
+
+    def show_coarse(self, chan, hist):
+        self.plot.plots['plot0'][0].index.set_data(chan)
+        self.plot.plots['plot0'][0].value.set_data(hist)
+
+    def refine_histogram(self, token=None):
+        # Skip redraws superseded by a later slider move
+        if token is not None and token != self.refine_token:
+            return
+
+        # The window is read on the worker thread and shown when it arrives
+        lower_index, upper_index = self.calc_time_indices()
+        self.histograms.request(lower_index, upper_index, token)
+
+    def _histogram_ready(self, token, lower_index, upper_index, windows, level):
+        # Called on the worker thread; the plot is updated on the UI thread
+        GUI.invoke_later(self.show_histogram, token, windows, level)
+
+    def show_histogram(self, token, windows, level=0):
+        if token is not None and token != self.refine_token:
+            return
+
+        if level:
+            self.show_coarse(*windows)
+            return
+
         # Calculate new hisogram
-        hist = self.calc_histogram_data()
+        hist = windows[0]
         self.hist = hist
+        self.bkg = self.background_window(windows[1])
 
         # Recalculate peak
         if 0 < len(self.pchn):
@@ -277,6 +473,10 @@ class PyramdsView(HasTraits):
         # Redraw points on plot
         self.redraw_plot()
 
+        # Refit the selected peaks in the new window
+        self.calc_net_areas()
+        self.draw_detection_limits()
+
     #
     # Set Trait Defaults
     #
@@ -316,9 +516,12 @@ class PyramdsView(HasTraits):
     def _peak_default(self):
         return np.array([])
 
+    def _bkg_default(self):
+        return np.zeros(len(self.hist))
+
     def _plot_default(self):
         en_coeff = getattr(self, "en_coeff_{0}".format(self.detector))
-        plot = make_spectrum_plot(self.chan, self.hist, self.pchn, self.peak, en_coeff, scale=self.linlog_toggle)
+        plot = make_spectrum_plot(self.chan, self.hist, self.pchn, self.peak, en_coeff, scale=self.linlog_toggle, bkg=self.bkg)
         return plot
 
     def _start_time_low_default(self):
@@ -435,13 +638,21 @@ class PyramdsView(HasTraits):
         self.index_selections = self.plot.plots['plot0'][0].index.metadata['selections']
 
     def _index_selections_changed(self, old, new):
-        # Some fake way of selecting the peak
+        # Select the found peak whose ROI holds the clicked channel; fall
+        # back to +/-10 channels when no peak was found there
         pi = []
         for si in self.index_selections:
             # Prevent the peak-finding algorithm from running 
             # unnecessarily often by caching the results
             if si not in self.peak_indices:
-                self.peak_indices[si] = range(si-10, si+11) 
+                peak = None
+                if self.detector in self.peak_searches:
+                    search = self.peak_searches[self.detector]
+                    peak = search.peak_at(self.hist, si)
+                if peak is None:
+                    self.peak_indices[si] = range(si-10, si+11)
+                else:
+                    self.peak_indices[si] = range(peak['LM'], peak['RM'] + 1)
             pi.extend( self.peak_indices[si] )
 
         # Remove old selections
@@ -469,14 +680,15 @@ class PyramdsView(HasTraits):
                 en_coeff = getattr(self, "en_coeff_{0}".format(self.detector))
                 fwhm_coeff = getattr(self, "fwhm_coeff_{0}".format(self.detector))
                 ld, lc = calc_det_limit_sel(self.detector, si, en_coeff, fwhm_coeff, self.hist)
-                self.detection_limits['clicked_selected'][si] = [ld, lc]
+                self.detection_limits['clicked_selected'][si] = [ld, lc, np.nan, np.nan]
 
         # Remove old detection limits
         for key in self.detection_limits['clicked_selected'].keys():
             if key not in self.index_selections:
                 del self.detection_limits['clicked_selected'][key]
 
-        # Redraw the detection limits display
+        # Fit net areas and redraw the detection limits display
+        self.calc_net_areas()
         self.draw_detection_limits()
         
     #
@@ -488,10 +700,11 @@ class PyramdsView(HasTraits):
         ld, lc = calc_det_limit(markers[0], markers[1], self.hist)
 
         # Set detection limits
-        row = [self.isotope, self.peaknum, ld, lc]
+        row = [self.isotope, self.peaknum, ld, lc, np.nan, np.nan]
         self.detection_limits['lookup_selected'].append(row)
 
-        # Redraw the detection limits display
+        # Fit net areas and redraw the detection limits display
+        self.calc_net_areas()
         self.draw_detection_limits()
 
         # Add peak to plot
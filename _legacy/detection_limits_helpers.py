@@ -9,7 +9,8 @@ def detection_limits_to_html(detection_limits):
             s += "<b>Isotope:</b> {0}<br>\n".format(row[0])
             s += "<b>Peak Number:</b> {0}<br>\n".format(row[1])
             s += "<b>LD:</b> {0}<br>\n".format( row[2] )
-            s += "<b>LC:</b> {0}<br><br>\n".format( row[3] )
+            s += "<b>LC:</b> {0}<br>\n".format( row[3] )
+            s += "<b>Net Area:</b> {0:.1f} +/- {1:.1f}<br><br>\n".format( row[4], row[5] )
 
         s += "<br>\n"
 
@@ -19,7 +20,8 @@ def detection_limits_to_html(detection_limits):
         for key in sorted(detection_limits['clicked_selected'].keys()):
             s += "<b>Peak Index:</b> {0}<br>\n".format(key)
             s += "<b>LD:</b> {0}<br>\n".format( detection_limits['clicked_selected'][key][0] )
-            s += "<b>LC:</b> {0}<br><br>\n".format( detection_limits['clicked_selected'][key][1] )
+            s += "<b>LC:</b> {0}<br>\n".format( detection_limits['clicked_selected'][key][1] )
+            s += "<b>Net Area:</b> {0:.1f} +/- {1:.1f}<br><br>\n".format( *detection_limits['clicked_selected'][key][2:4] )
 
     return s
 
@@ -30,19 +32,18 @@ def detection_limits_to_tsv(detection_limits):
 
     if detection_limits['lookup_selected'] != {}:
         s += ("Lookup Selected Peaks:\n\n"
-             "Isotope\tPeaknum\tLD\tLC\n")
+             "Isotope\tPeaknum\tLD\tLC\tNet\tNet_Err\n")
 
         for row in sorted(detection_limits['lookup_selected']):
-            s += "{0}\t{1}\t{2}\t{3}\n".format(*row)
+            s += "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(*row)
         s += "\n\n\n"
 
     if detection_limits['clicked_selected'] != {}:
         s += ("Peaks Selected from Plot:\n\n"
-             "Index\tLD\tLC\n")
+             "Index\tLD\tLC\tNet\tNet_Err\n")
 
         for key in sorted(detection_limits['clicked_selected'].keys()):
-            s += "{0}\t{1}\t{2}\n".format(key, 
-                                    detection_limits['clicked_selected'][key][0],
-                                    detection_limits['clicked_selected'][key][1],
+            s += "{0}\t{1}\t{2}\t{3}\t{4}\n".format(key, 
+                                    *detection_limits['clicked_selected'][key]
                                     )
     return s
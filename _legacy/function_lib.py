@@ -86,7 +86,8 @@ def bin_count(t_start, t_stop, group):
     return cnt_array
 
 def marker2energy(marker, en_coeff):
-    energy = en_coeff[0] + en_coeff[1] * marker
+    # Works element-wise on whole arrays of markers
+    energy = en_coeff[0] + en_coeff[1] * np.asarray(marker)
     return energy
 
 def write_spec(file_path, data_title):
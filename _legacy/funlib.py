@@ -1,32 +1,31 @@
+import numpy as np
+
 # Define all functions
 
 def build_gamma(lib_name, fwhm_coeff, en_coeff):
     with open(lib_name, 'r') as ginput:
-        gamma_lib = {}
-        
-        line_data = ginput.readline().split()
-        while line_data:
-            ZAID = line_data[0]
-            name_str = line_data[1]
-            energy = line_data[2]
-            
-            gamma_lib[ZAID] = [name_str, float(energy)]
-            
-            line_data = ginput.readline().split()
-        
-        sig_lookup = [{}]*4
-        for c,chn in enumerate(en_coeff.keys()):
-            for z,zaid in enumerate(gamma_lib.keys()):
-                top_val = gamma_lib[zaid][1] - en_coeff[chn][0]
-                bottom_val = en_coeff[chn][1]
-                cent_chn = top_val/bottom_val
-                width = fwhm_coeff[chn][0] + fwhm_coeff[chn][1] * cent_chn + fwhm_coeff[chn][2] * cent_chn * cent_chn
-                
-                left_marker = int(round(cent_chn - 1.75*width))
-                right_marker = int(round(cent_chn + 1.75*width))
-                
-                sig_lookup[int(chn)][zaid] = [left_marker, right_marker]
-            
+        rows = [line.split()[:3] for line in ginput if line.split()]
+
+    gamma_lib = dict((zaid, [name_str, float(energy)])
+                     for zaid, name_str, energy in rows)
+
+    zaids = [row[0] for row in rows]
+    energies = np.array([float(row[2]) for row in rows])
+
+    # One dictionary per channel (not [{}]*4, which shares a single dict)
+    sig_lookup = [{} for chn in range(4)]
+    for chn in en_coeff.keys():
+        # Marker windows of every library line at once
+        cent_chn = (energies - en_coeff[chn][0]) / en_coeff[chn][1]
+        width = np.polyval(list(fwhm_coeff[chn])[::-1], cent_chn)
+
+        left_marker = np.round(cent_chn - 1.75 * width).astype(int)
+        right_marker = np.round(cent_chn + 1.75 * width).astype(int)
+
+        sig_lookup[int(chn)] = dict(
+            zip(zaids, [list(m) for m in zip(left_marker.tolist(),
+                                             right_marker.tolist())]))
+
     return gamma_lib, sig_lookup
 
 def write_spec(spe_choices, file_series, spec_start, live_t, total_t, detector_choices, energy_max, spec_markers, enerfit, mca_cal, shape_cal, roi_list):
@@ -28,14 +28,8 @@ emax = 800
 gg_list_1 = np.array([row['energy_1'] for row in evtstab.where("""(energy_1 <= emax) & (energy_2 <= emax) & (energy_1 > 0) & (energy_2 > 0)""")])
 gg_list_2 = np.array([row['energy_2'] for row in evtstab.where("""(energy_1 <= emax) & (energy_2 <= emax) & (energy_1 > 0) & (energy_2 > 0)""")])
 
-gg_en_1 = np.zeros(len(gg_list_1))
-gg_en_2 = np.zeros(len(gg_list_2))
-
-for i in range(len(gg_list_1)):
-    gg_en_1[i] = marker2energy(gg_list_1[i], en_coeff1)
-    
-for i in range(len(gg_list_2)):
-    gg_en_2[i] = marker2energy(gg_list_2[i], en_coeff2)
+gg_en_1 = marker2energy(gg_list_1, en_coeff1)
+gg_en_2 = marker2energy(gg_list_2, en_coeff2)
 
 xmin = 0
 xmax = gg_en_1.max()
@@ -57,30 +57,27 @@ for channel in range(3):
 # Supply the path to the custom signature library. Builds necessary lookup arrays
 
 with open(lib_name, 'r') as ginput:
-    gamma_lib = {}
+    lib_rows = [line.split()[:3] for line in ginput if line.split()]
 
-    line_data = ginput.readline().split()
-    while line_data:
-        ZAID     = line_data[0]
-        name_str = line_data[1]
-        energy   = line_data[2]
+gamma_lib = dict((ZAID, [name_str, float(energy)])
+                 for ZAID, name_str, energy in lib_rows)
 
-        gamma_lib[ZAID] = [name_str, float(energy)]
+lib_zaids = [row[0] for row in lib_rows]
+lib_energies = np.array([float(row[2]) for row in lib_rows])
 
-        line_data = ginput.readline().split()
+# One dictionary per channel (not [{}]*3, which shares a single dict)
+sig_lookup = [{} for chn in range(3)]
+for chn in en_coeff.keys():
+    # Marker windows of every library line at once
+    cent_chn = (lib_energies - en_coeff[chn][0]) / en_coeff[chn][1]
+    width = np.polyval(list(fwhm_coeff[chn])[::-1], cent_chn)
 
-    sig_lookup = [{}]*3
-    for c,chn in enumerate(en_coeff.keys()):
-        for z,zaid in enumerate(gamma_lib.keys()):
-            top_val = gamma_lib[zaid][1] - en_coeff[chn][0]
-            bottom_val = en_coeff[chn][1]
-            cent_chn = top_val/bottom_val
-            width = fwhm_coeff[chn][0] + fwhm_coeff[chn][1] * cent_chn + fwhm_coeff[chn][2] * cent_chn * cent_chn
+    left_marker = np.round(cent_chn - 1.75 * width).astype(int)
+    right_marker = np.round(cent_chn + 1.75 * width).astype(int)
 
-            left_marker = int(round(cent_chn - 1.75*width))
-            right_marker = int(round(cent_chn + 1.75*width))
-
-            sig_lookup[int(chn)][zaid] = [left_marker, right_marker]
+    sig_lookup[int(chn)] = dict(
+        zip(lib_zaids, [list(m) for m in zip(left_marker.tolist(),
+                                             right_marker.tolist())]))
 
 # Detector system variables
 energy_max = 8192 # maximum number of bins (energies) to be stored for detectors
@@ -92,7 +89,6 @@ t_steps = 60. # seconds
 
 # Store the bin-energy mapping for plotting spectra
 en_plot_axis = {}
+markers = np.arange(energy_max + 1, dtype=np.float32)
 for c, chn in enumerate(en_coeff.keys()):
-    en_plot_axis[chn] = np.zeros( (energy_max + 1), dtype=np.float32)
-    for marker in range(energy_max + 1):
-        en_plot_axis[chn][marker] = en_coeff[chn][0] + en_coeff[chn][1] * marker
+    en_plot_axis[chn] = en_coeff[chn][0] + en_coeff[chn][1] * markers
@@ -1,12 +1,16 @@
-from enthought.chaco.api import Plot, ArrayPlotData, ScatterInspectorOverlay, PlotLabel, PlotAxis, LabelAxis
+import numpy as np
+
+from enthought.chaco.api import Plot, ArrayPlotData, ScatterInspectorOverlay, PlotLabel, PlotAxis, LabelAxis, jet
 from enthought.chaco.tools.api import PanTool, ZoomTool, LegendTool, TraitsTool, DragZoom, ScatterInspector
 
 from enthought.chaco.plot_graphics_context import PlotGraphicsContext
 
 from function_lib import marker2energy
 
-def make_spectrum_plot(chan, hist, pchn, peak, en_coeff, label="Spectrum Plot", scale="Linear"):
-    plotdata = ArrayPlotData(x=chan, y=hist, x2=pchn, y2=peak)
+def make_spectrum_plot(chan, hist, pchn, peak, en_coeff, label="Spectrum Plot", scale="Linear", bkg=None):
+    if bkg is None:
+        bkg = np.zeros(len(hist))
+    plotdata = ArrayPlotData(x=chan, y=hist, x2=pchn, y2=peak, x3=chan, y3=bkg)
 
     container = Plot(
         plotdata,
@@ -24,6 +28,11 @@ def make_spectrum_plot(chan, hist, pchn, peak, en_coeff, label="Spectrum Plot",
                     marker_size=4,
                     color="red",
                     )
+    # Continuum estimate under the spectrum
+    container.plot(("x3", "y3"),
+                    type="line",
+                    color="blue",
+                    )
 
     # Add nice zooming and Panning
     container.tools.append(PanTool(container))
@@ -77,6 +86,56 @@ def make_spectrum_plot(chan, hist, pchn, peak, en_coeff, label="Spectrum Plot",
 
     return container
 
+def waterfall_image(image):
+    # log10 of the counts per chunk and channel; empty or missing cells at 0
+    return np.log10(1.0 + np.nan_to_num(image))
+
+def make_waterfall_plot(image, chan_edges, time_edges, en_coeff, label="Waterfall"):
+    plotdata = ArrayPlotData(imagedata=waterfall_image(image))
+
+    container = Plot(
+        plotdata,
+        border_visible=True,
+        overlay_border=True,
+        )
+
+    container.img_plot("imagedata",
+                       name="waterfall",
+                       xbounds=chan_edges,
+                       ybounds=time_edges,
+                       colormap=jet,
+                       )
+
+    # Add nice zooming and Panning
+    container.tools.append(PanTool(container))
+
+    zoom = ZoomTool(container, tool_mode="box", always_on=False)
+    container.overlays.append(zoom)
+
+    # Add the title at the top
+    container.overlays.append(PlotLabel(label,
+        component=container,
+        font = "Roman 20",
+        overlay_position="top")
+        )
+
+    # Set x-axis
+    container.x_axis.title = "Energy (keV)"
+    container.x_axis.title_font = "Roman 16"
+    container.x_axis.tick_label_font = "Roman 12"
+
+    container.x_axis.tick_label_formatter = lambda x: "{0:.2f}".format(marker2energy(x, en_coeff))
+
+    # Set y-axis
+    container.y_axis.title = "Time (s)"
+    container.y_axis.title_font = "Roman 16"
+    container.y_axis.tick_label_font = "Roman 12"
+
+    # Get Title Spacing right
+    container.padding_left = 65
+
+    return container
+
 def save_plot(plot, filename, width, height):
     orig_bounds = plot.outer_bounds
     plot.outer_bounds = [width, height]
@@ -0,0 +1,141 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import re
+import sys
+
+# External Imports
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Bounds on the number of readout rows pulled into memory at once
+MIN_BLOCK_SIZE = 2 ** 12
+BLOCK_SIZE = 2 ** 18
+MAX_BLOCK_SIZE = 2 ** 22
+
+# Working memory per readout row in a block (masks, keys and temporaries),
+# as a multiple of the row size
+ROW_OVERHEAD = 16
+
+# Approximate bytes of working memory per sparse histogram cell while
+# merging (key, count and the temporaries of np.unique)
+CELL_BYTES = 48
+
+MEMORY_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_memory(size):
+    """
+    Memory budget in bytes from a number or a string such as '2GB',
+    '512M' or '1.5 GiB'.
+    """
+
+    if isinstance(size, (int, float)):
+        return int(size)
+
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)I?B?\s*$', size.upper())
+    if match is None:
+        raise ValueError("Bad memory size: {0!r}".format(size))
+
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def block_size_for(budget, row_bytes, share=0.1):
+    """
+    Number of readout rows per block so that a block and its temporaries
+    take about 'share' of the memory budget.
+    """
+
+    rows = int(budget * share) // (row_bytes * ROW_OVERHEAD)
+
+    return int(min(max(rows, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE))
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (None if unknown)."""
+
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, OS X bytes
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def iter_blocks(table, block_size=BLOCK_SIZE):
+    """
+    Yield successive blocks of a PyTables table as NumPy structured arrays.
+    Aggregates are then built with whole-block array operations rather than
+    walking the table one row at a time.
+    """
+
+    nrows = table.nrows
+
+    for start in range(0, nrows, block_size):
+        yield table.read(start, min(start + block_size, nrows))
+
+
+def read_rows(node, rows, band=256):
+    """
+    Rows 'rows' (sorted, unique) of a 2-D array node, read 'band' rows at a
+    time: a band of close rows as one slice, a sparse band as a point
+    selection of just those rows.
+    """
+
+    rows = np.asarray(rows, dtype=np.intp)
+    out = np.empty((len(rows), node.shape[1]), dtype=node.dtype)
+
+    for lo in range(0, len(rows), band):
+        sel = rows[lo:lo + band]
+        first, last = sel[0], sel[-1] + 1
+        if last - first <= 2 * len(sel):
+            out[lo:lo + band] = node[first:last][sel - first]
+        else:
+            out[lo:lo + band] = node[sel.tolist(), :]
+
+    return out
+
+
+def reduce_counts(keys, counts):
+    """Sum the counts of repeated keys, returning sorted unique keys."""
+
+    keys, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts,
+                         minlength=len(keys))
+
+    return keys, counts.astype(np.int64)
+
+
+def merge_counts(keys_a, counts_a, keys_b, counts_b):
+    """
+    Merge two sparse (sorted key, count) histograms into one, summing the
+    counts of keys present in both.
+    """
+
+    return reduce_counts(np.concatenate((keys_a, keys_b)),
+                         np.concatenate((counts_a, counts_b)))
+
+
+def partition_sizes(sizes, limit):
+    """
+    Split consecutive bins into (lo, hi) ranges holding about 'limit' items
+    each. A single bin larger than 'limit' gets a range of its own.
+    """
+
+    cum = np.cumsum(sizes)
+    total = cum[-1] if len(cum) else 0
+
+    cuts = np.searchsorted(cum, np.arange(limit, total, max(limit, 1)),
+                           side='right')
+    edges = np.unique(np.concatenate(([0], cuts, [len(sizes)])))
+
+    return list(zip(edges[:-1], edges[1:]))
@@ -0,0 +1,58 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+
+# SNIP clipping window half-width at each channel, in units of the FWHM
+SNIP_WIDTH = 1.5
+
+# Name suffix of background arrays (e.g. norm1_bkg for norm1_spec)
+BKG_SUFFIX = 'bkg'
+
+
+def lls(counts):
+    """Log-log-square root transform, compressing the dynamic range."""
+
+    return np.log(np.log(np.sqrt(counts + 1.0) + 1.0) + 1.0)
+
+
+def inverse_lls(values):
+    """Inverse of lls."""
+
+    return (np.exp(np.exp(values) - 1.0) - 1.0) ** 2 - 1.0
+
+
+def snip_background(spectra, fwhm, width=SNIP_WIDTH):
+    """
+    SNIP continuum of one spectrum or of every row of a rows x channels
+    array (e.g. all time chunks) at once, with 'fwhm' (channels) giving the
+    width of the peaks at each channel.
+
+    Each channel is clipped to the mean of the channels p either side, in
+    the LLS domain, for decreasing p from 'width' FWHMs down to 1, so the
+    clipping window follows the detector resolution across the spectrum.
+    """
+
+    spectra = np.asarray(spectra, dtype=float)
+    n_bins = spectra.shape[-1]
+    fwhm = np.broadcast_to(np.asarray(fwhm, dtype=float), (n_bins,))
+
+    window = np.maximum(np.round(width * fwhm), 1).astype(np.intp)
+    channel = np.arange(n_bins)
+    window = np.minimum(window, np.minimum(channel, n_bins - 1 - channel))
+
+    values = lls(np.maximum(spectra, 0.0))
+    for p in range(int(window.max()) if n_bins else 0, 0, -1):
+        clip = np.nonzero(window >= p)[0]
+        mean = 0.5 * (values[..., clip - p] + values[..., clip + p])
+        values[..., clip] = np.minimum(values[..., clip], mean)
+
+    return np.minimum(np.maximum(inverse_lls(values), 0.0), spectra)
+
+
+def background_name(spec_name):
+    """Background array name for a spectrum array (norm1_spec -> norm1_bkg)."""
+
+    return spec_name[:-4] + BKG_SUFFIX
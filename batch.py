@@ -0,0 +1,128 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Headless batch processing: parses and exports every series of a job
+# manifest across a pool of processes, without a display.
+#
+# Usage: python batch.py manifest.json [--workers N] [--summary out.json]
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from os.path import abspath, basename, dirname, join, splitext
+
+# Internal Imports
+from jobs import POOL_SETTINGS, run_job, series_first_file
+
+
+def read_manifest(path):
+    """
+    Jobs of a JSON manifest as (data_file, overrides) pairs:
+
+        {"defaults": {"t_steps": 30.0, "export_formats": ["spe", "chn"]},
+         "series": ["run_a0001.bin",
+                    {"data_file": "run_b", "short_window": 120.0}]}
+
+    Each series is a first .bin file or a series basename (its lowest
+    numbered .bin file is used), relative to the manifest; any other keys
+    of a series entry override the defaults.
+    """
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    base = dirname(abspath(path))
+    defaults = manifest.get('defaults', {})
+
+    jobs = []
+    for entry in manifest['series']:
+        if not isinstance(entry, dict):
+            entry = {'data_file': entry}
+
+        overrides = dict(defaults)
+        overrides.update((k, v) for k, v in entry.items() if k != 'data_file')
+
+        data_file = join(base, entry['data_file'])
+        if splitext(data_file)[1] != '.bin':
+            # A series without .bin files is left to fail as its own job
+            data_file = series_first_file(dirname(data_file),
+                                          basename(data_file)) or data_file
+        jobs.append((data_file, overrides))
+
+    return jobs
+
+
+def _run_entry(args):
+    index, data_file, overrides, export = args
+    return index, run_job(data_file, overrides, export)
+
+
+def run_batch(jobs, workers=0, export=True):
+    """
+    Run (data_file, overrides) jobs on 'workers' processes (0: one per
+    CPU), a fresh process per job. Returns the job summaries in manifest
+    order.
+    """
+
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+
+    tasks = [(k, data_file, dict(overrides, **POOL_SETTINGS), export)
+             for k, (data_file, overrides) in enumerate(jobs)]
+
+    summaries = [None] * len(tasks)
+    pool = multiprocessing.Pool(min(workers, max(len(tasks), 1)),
+                                maxtasksperchild=1)
+    try:
+        for index, summary in pool.imap_unordered(_run_entry, tasks):
+            print('{status:>6}  {elapsed:8.1f} s  {data_file}'.format(
+                **summary))
+            summaries[index] = summary
+    finally:
+        pool.close()
+        pool.join()
+
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parse and export the PIXIE series of a job manifest.")
+    parser.add_argument('manifest')
+    parser.add_argument('--workers', type=int, default=0,
+                        help="processes (default: one per CPU)")
+    parser.add_argument('--summary', default=None,
+                        help="JSON summary file (default: "
+                             "<manifest>_summary.json)")
+    parser.add_argument('--no-export', action='store_true')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    jobs = read_manifest(args.manifest)
+    summaries = run_batch(jobs, args.workers, not args.no_export)
+
+    summary = {
+        'manifest': abspath(args.manifest),
+        'started': start,
+        'elapsed': time.time() - start,
+        'done': sum(s['status'] == 'done' for s in summaries),
+        'failed': sum(s['status'] == 'failed' for s in summaries),
+        'jobs': summaries,
+    }
+
+    summary_file = (args.summary or
+                    splitext(args.manifest)[0] + '_summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    print('{done} done, {failed} failed in {elapsed:.1f} s; '
+          'summary in {0}'.format(summary_file, **summary))
+
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
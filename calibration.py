@@ -0,0 +1,182 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+
+# Parsed calibrations, keyed by the detector_config strings they came from
+_calibrations = {}
+
+
+def parse_fit(fit_str):
+    """Polynomial coefficients from a detector_config fit string."""
+
+    return np.array(fit_str.split(), dtype=float)
+
+
+def parse_cal(cal_str):
+    """
+    Polynomial coefficients from an ORTEC MCA_CAL/SHAPE_CAL string, i.e. the
+    number of coefficients on the first line followed by the coefficients.
+    """
+
+    lines = cal_str.split()
+    if not lines:
+        return np.zeros(0)
+
+    return np.array(lines[1:1 + int(lines[0])], dtype=float)
+
+
+def get_calibration(enerfit, fwhmfit, mca_cal, shape_cal, n_bins=8193):
+    """
+    Calibration for a set of detector_config dictionaries. Each distinct set
+    is parsed only once; later calls return the cached Calibration and its
+    lookup tables.
+    """
+
+    key = tuple(tuple(sorted(d.items()))
+                for d in (enerfit, fwhmfit, mca_cal, shape_cal)) + (n_bins,)
+
+    if key not in _calibrations:
+        _calibrations[key] = Calibration(enerfit, fwhmfit, mca_cal,
+                                         shape_cal, n_bins)
+
+    return _calibrations[key]
+
+
+class Calibration(object):
+    """
+    Parsed energy and resolution calibrations for every detector, with
+    lazily built channel -> keV lookup tables.
+
+    The energy polynomial comes from MCA_CAL (which may carry a quadratic
+    term), falling back to ENER_FIT. FWHM is in channels, as a polynomial
+    in channel number.
+    """
+
+    def __init__(self, enerfit, fwhmfit, mca_cal, shape_cal, n_bins=8193):
+
+        self.n_bins = n_bins
+        self.en_coeff = {}
+        self.fwhm_coeff = {}
+
+        for det in enerfit:
+            en_coeff = parse_cal(mca_cal.get(det, ''))
+            if not len(en_coeff):
+                en_coeff = parse_fit(enerfit[det])
+            fwhm_coeff = parse_cal(shape_cal.get(det, ''))
+            if not len(fwhm_coeff):
+                fwhm_coeff = parse_fit(fwhmfit.get(det, ''))
+
+            if len(en_coeff):
+                self.en_coeff[det] = en_coeff
+                self.fwhm_coeff[det] = fwhm_coeff
+
+        self._luts = {}
+
+    @property
+    def detectors(self):
+        return sorted(self.en_coeff)
+
+    def channel_kev(self, det):
+        """Energy (keV) at the centre of every channel of detector 'det'."""
+
+        return self._lut('kev', det, lambda: self.to_kev(
+            det, np.arange(self.n_bins, dtype=float)))
+
+    def channel_edges(self, det):
+        """Energy (keV) at the n_bins + 1 channel boundaries."""
+
+        return self._lut('edges', det, lambda: self.to_kev(
+            det, np.arange(self.n_bins + 1, dtype=float) - 0.5))
+
+    def channel_fwhm(self, det):
+        """FWHM (channels) at every channel of detector 'det'."""
+
+        return self._lut('fwhm', det, lambda: self.fwhm(
+            det, np.arange(self.n_bins, dtype=float)))
+
+    def to_kev(self, det, channel):
+        return np.polyval(self.en_coeff[det][::-1], channel)
+
+    def fwhm(self, det, channel):
+        return np.polyval(self.fwhm_coeff[det][::-1], channel)
+
+    def to_channel(self, det, energy):
+        """
+        Fractional channel of each energy (keV), inverting the calibration by
+        interpolation in the channel -> keV table.
+        """
+
+        return np.interp(energy, self.channel_kev(det),
+                         np.arange(self.n_bins, dtype=float),
+                         left=np.nan, right=np.nan)
+
+    def rebin_table(self, det, grid_edges):
+        """
+        Redistribution of channels onto a keV grid: one (bin index, weight)
+        layer per grid bin a channel can straddle. Weights are the fraction
+        of the channel's keV width falling in that bin.
+        """
+
+        key = ('rebin', det, len(grid_edges), grid_edges[0], grid_edges[-1])
+
+        def build():
+            edges = self.channel_edges(det)
+            lo, hi = edges[:-1], edges[1:]
+            n_grid = len(grid_edges) - 1
+
+            first = np.searchsorted(grid_edges, lo, side='right') - 1
+            last = np.searchsorted(grid_edges, hi, side='left') - 1
+            n_layers = int(max((last - first).max(), 0)) + 1
+
+            layers = []
+            for layer in range(n_layers):
+                index = first + layer
+                valid = (index <= last) & (index >= 0) & (index < n_grid)
+                index = np.clip(index, 0, n_grid - 1)
+
+                overlap = (np.minimum(hi, grid_edges[index + 1]) -
+                           np.maximum(lo, grid_edges[index]))
+                weight = np.where(valid, overlap / (hi - lo), 0.0)
+
+                layers.append((index, np.maximum(weight, 0.0)))
+            return layers
+
+        return self._lut(key, det, build)
+
+    def to_kev_grid(self, det, spectra, grid_edges):
+        """
+        Rebin channel spectra (1-D, or 2-D with channels along the last axis)
+        of detector 'det' onto the keV grid with edges 'grid_edges'. Counts
+        are split between grid bins in proportion to overlap, so totals are
+        preserved for channels inside the grid.
+        """
+
+        spectra = np.asarray(spectra, dtype=float)
+        n_grid = len(grid_edges) - 1
+        out = np.zeros(spectra.shape[:-1] + (n_grid,))
+
+        for index, weight in self.rebin_table(det, grid_edges):
+            # Bin indices are non-decreasing in channel, so each bin's share
+            # is one contiguous run summed by reduceat
+            starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+            sums = np.add.reduceat(spectra[..., :len(index)] * weight,
+                                   starts, axis=-1)
+            out[..., index[starts]] += sums
+
+        return out
+
+    def _lut(self, kind, det, build):
+        key = (kind, det)
+        if key not in self._luts:
+            self._luts[key] = build()
+        return self._luts[key]
+
+
+def kev_grid(kev_max, kev_width=0.5, kev_min=0.0):
+    """Edges of a common, uniform keV grid."""
+
+    n_grid = int(np.ceil((kev_max - kev_min) / kev_width))
+    return kev_min + kev_width * np.arange(n_grid + 1)
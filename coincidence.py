@@ -0,0 +1,402 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+import tables as tb
+
+# Internal Imports
+from aggregation import merge_counts, partition_sizes, reduce_counts
+
+# Compression used for the sparse coincidence arrays stored in the HDF5 file
+SPARSE_FILTERS = tb.Filters(complevel=5, complib='zlib', shuffle=True)
+
+
+class SparseAccumulator(object):
+    """
+    Streaming sparse histogram over flat integer keys into a grid of the
+    given shape (row-major, so key // prod(shape[1:]) is the leading index).
+
+    Each block contributes a sorted (key, count) histogram. Partial
+    histograms are merged once enough of them have piled up, so memory
+    scales with the number of occupied cells rather than the full grid.
+    When a 'scratch' (h5file, group) is given, merged histograms larger than
+    'max_keys' cells are spilled to it as sorted runs and merged back one
+    band of leading indices at a time.
+    """
+
+    def __init__(self, shape, max_keys=2 ** 22, scratch=None):
+
+        self.shape = tuple(shape)
+        self.lead = int(np.prod(self.shape[1:]))
+        self.max_keys = max_keys
+        self.scratch = scratch
+
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+        self._pending = []
+        self._pending_size = 0
+        self._runs = []
+
+    def add_keys(self, keys):
+        keys, counts = np.unique(keys, return_counts=True)
+
+        self._pending.append((keys, counts))
+        self._pending_size += len(keys)
+
+        if self._pending_size > self.max_keys // 2:
+            self._merge_pending()
+
+    def iter_sorted(self):
+        """
+        Yield the accumulated (keys, counts) in ascending key order, in
+        pieces covering whole bands of the leading index.
+        """
+
+        self._merge_pending()
+
+        if not self._runs:
+            yield self.keys, self.counts
+            return
+
+        mem_indptr = self._indptr(self.keys)
+        sizes = np.diff(mem_indptr)
+        for keys_node, counts_node, indptr in self._runs:
+            sizes = sizes + np.diff(indptr)
+
+        for lo, hi in partition_sizes(sizes, self.max_keys):
+            keys = [self.keys[mem_indptr[lo]:mem_indptr[hi]]]
+            counts = [self.counts[mem_indptr[lo]:mem_indptr[hi]]]
+            for keys_node, counts_node, indptr in self._runs:
+                keys.append(keys_node[indptr[lo]:indptr[hi]])
+                counts.append(counts_node[indptr[lo]:indptr[hi]])
+
+            yield reduce_counts(np.concatenate(keys), np.concatenate(counts))
+
+    def _merge_pending(self):
+        if not self._pending:
+            return
+
+        keys = np.concatenate([k for k, c in self._pending])
+        counts = np.concatenate([c for k, c in self._pending])
+
+        self.keys, self.counts = merge_counts(self.keys, self.counts,
+                                              keys, counts)
+
+        self._pending = []
+        self._pending_size = 0
+
+        if self.scratch is not None and len(self.keys) > self.max_keys // 2:
+            self._spill()
+
+    def _spill(self):
+        h5file, group = self.scratch
+
+        # The scratch group may be shared, so number runs by its contents
+        run_no = group._v_nchildren
+
+        nodes = []
+        for name, arr in (('keys', self.keys), ('counts', self.counts)):
+            node = h5file.createEArray(
+                group, 'run{0}_{1}'.format(run_no, name),
+                tb.Atom.from_dtype(arr.dtype), (0,), filters=SPARSE_FILTERS,
+                expectedrows=len(arr))
+            node.append(arr)
+            nodes.append(node)
+
+        self._runs.append((nodes[0], nodes[1], self._indptr(self.keys)))
+
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _indptr(self, keys):
+        return _indptr(keys // self.lead, self.shape[0])
+
+
+class GammaGammaMatrix(SparseAccumulator):
+    """
+    Streaming builder for the energy_x x energy_y coincidence matrix, keyed
+    by energy_x * n_bins + energy_y.
+    """
+
+    def __init__(self, n_bins, short_window, axes=('energy_1', 'energy_2'),
+                 delta_t='deltaT_12', **kwargs):
+        super(GammaGammaMatrix, self).__init__((n_bins, n_bins), **kwargs)
+
+        self.n_bins = n_bins
+        self.short_window = short_window
+        self.axes = axes
+        self.delta_t = delta_t
+
+    def update(self, block):
+        ex = block[self.axes[0]]
+        ey = block[self.axes[1]]
+
+        sel = ((ex >= 0) & (ex < self.n_bins) &
+               (ey >= 0) & (ey < self.n_bins) &
+               (block[self.delta_t] < self.short_window))
+
+        self.add_keys(ex[sel].astype(np.int64) * self.n_bins + ey[sel])
+
+
+class GammaCube(SparseAccumulator):
+    """
+    Streaming builder for the energy_0 x energy_1 x energy_2 cube of events
+    where all three detectors fire inside the coincidence window. Keys are
+    (energy_0 * n_bins + energy_1) * n_bins + energy_2.
+    """
+
+    axes = ('energy_0', 'energy_1', 'energy_2')
+    delta_ts = ('deltaT_01', 'deltaT_02', 'deltaT_12')
+
+    def __init__(self, n_bins, short_window, **kwargs):
+        super(GammaCube, self).__init__((n_bins, n_bins, n_bins), **kwargs)
+
+        self.n_bins = n_bins
+        self.short_window = short_window
+
+    def update(self, block):
+        sel = np.ones(len(block), dtype=bool)
+        for axis in self.axes:
+            sel &= (block[axis] >= 0) & (block[axis] < self.n_bins)
+        for delta_t in self.delta_ts:
+            sel &= block[delta_t] < self.short_window
+
+        e0, e1, e2 = [block[axis][sel].astype(np.int64) for axis in self.axes]
+
+        self.add_keys((e0 * self.n_bins + e1) * self.n_bins + e2)
+
+
+def _indptr(rows, n_rows):
+    return np.concatenate(([0], np.cumsum(
+        np.bincount(rows, minlength=n_rows)))).astype(np.int64)
+
+
+def _sparse_array(h5file, group, name, dtype, expectedrows):
+    return h5file.createEArray(group, name, tb.Atom.from_dtype(np.dtype(dtype)),
+                               (0,), filters=SPARSE_FILTERS,
+                               expectedrows=max(expectedrows, 1))
+
+
+def store_sparse_matrix(h5file, where, name, matrix, title=''):
+    """
+    Write a GammaGammaMatrix to its own group in the HDF5 file as compressed
+    row-major (indptr, indices, counts) and column-major (t_indptr,
+    t_indices, t_counts) arrays plus both marginal projections.
+
+    'indptr' is the prefix sum of occupied cells per row, so the cells of
+    rows lo..hi are the contiguous slice indptr[lo]:indptr[hi + 1]. Both
+    copies are written a band at a time so memory stays within the
+    accumulator's max_keys.
+    """
+
+    group = h5file.createGroup(where, name, title)
+    n_bins = matrix.n_bins
+
+    indices = _sparse_array(h5file, group, 'indices', np.int32, 0)
+    counts = _sparse_array(h5file, group, 'counts', np.int32, 0)
+
+    row_sizes = np.zeros(n_bins, dtype=np.int64)
+    col_sizes = np.zeros(n_bins, dtype=np.int64)
+    proj0 = np.zeros(n_bins, dtype=np.int64)
+    proj1 = np.zeros(n_bins, dtype=np.int64)
+
+    for keys, cnts in matrix.iter_sorted():
+        rows = keys // n_bins
+        cols = keys % n_bins
+
+        indices.append(cols.astype(np.int32))
+        counts.append(cnts.astype(np.int32))
+
+        row_sizes += np.bincount(rows, minlength=n_bins)
+        col_sizes += np.bincount(cols, minlength=n_bins)
+        proj0 += np.bincount(rows, weights=cnts,
+                             minlength=n_bins).astype(np.int64)
+        proj1 += np.bincount(cols, weights=cnts,
+                             minlength=n_bins).astype(np.int64)
+
+    indptr = np.concatenate(([0], np.cumsum(row_sizes)))
+    nnz = int(indptr[-1])
+
+    # Column-major copy, gathered one band of columns at a time
+    t_indices = _sparse_array(h5file, group, 't_indices', np.int32, nnz)
+    t_counts = _sparse_array(h5file, group, 't_counts', np.int32, nnz)
+
+    for lo, hi in partition_sizes(col_sizes, matrix.max_keys):
+        band_keys, band_counts = [], []
+
+        for pos in range(0, nnz, matrix.max_keys):
+            end = min(pos + matrix.max_keys, nnz)
+            cols = indices[pos:end].astype(np.int64)
+            sel = (cols >= lo) & (cols < hi)
+
+            rows = np.searchsorted(indptr, np.arange(pos, end)[sel],
+                                   side='right') - 1
+            band_keys.append(cols[sel] * n_bins + rows)
+            band_counts.append(counts[pos:end][sel])
+
+        if not band_keys:
+            continue
+
+        band_keys = np.concatenate(band_keys)
+        order = np.argsort(band_keys, kind='mergesort')
+
+        t_indices.append((band_keys[order] % n_bins).astype(np.int32))
+        t_counts.append(np.concatenate(band_counts)[order])
+
+    for key, arr in (('indptr', indptr),
+                     ('t_indptr', np.concatenate(([0], np.cumsum(col_sizes)))),
+                     ('proj0', proj0), ('proj1', proj1)):
+        _sparse_array(h5file, group, key, np.int64, len(arr)).append(arr)
+
+    group._v_attrs.n_bins = n_bins
+
+    return group
+
+
+def _coordinate_dtype(n_bins):
+    """Smallest unsigned integer type holding every bin index below n_bins."""
+
+    for dtype in (np.uint16, np.uint32):
+        if n_bins - 1 <= np.iinfo(dtype).max:
+            return dtype
+
+    raise ValueError('Too many bins for sparse coordinates: {0}'.format(
+        n_bins))
+
+
+def store_sparse_cube(h5file, where, name, cube, title=''):
+    """
+    Write a GammaCube to its own group in the HDF5 file as sorted compact
+    coordinates (e1, e2, counts). Cells sharing an energy_0 value are
+    contiguous and 'indptr' locates them.
+    """
+
+    group = h5file.createGroup(where, name, title)
+    n_bins = cube.n_bins
+    dtype = _coordinate_dtype(n_bins)
+
+    e1 = _sparse_array(h5file, group, 'e1', dtype, 0)
+    e2 = _sparse_array(h5file, group, 'e2', dtype, 0)
+    counts = _sparse_array(h5file, group, 'counts', np.int32, 0)
+
+    row_sizes = np.zeros(n_bins, dtype=np.int64)
+
+    for keys, cnts in cube.iter_sorted():
+        e1.append(((keys // n_bins) % n_bins).astype(dtype))
+        e2.append((keys % n_bins).astype(dtype))
+        counts.append(cnts.astype(np.int32))
+
+        row_sizes += np.bincount(keys // (n_bins * n_bins), minlength=n_bins)
+
+    indptr = np.concatenate(([0], np.cumsum(row_sizes)))
+    _sparse_array(h5file, group, 'indptr', np.int64,
+                  len(indptr)).append(indptr)
+
+    group._v_attrs.n_bins = n_bins
+
+    return group
+
+
+class CoincidenceMatrix(object):
+    """
+    Read-only view of a stored gamma-gamma matrix. Only the small row
+    pointer and marginal arrays are held in memory; a gate reads just the
+    slice of cells belonging to the gated band.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.n_bins = int(group._v_attrs.n_bins)
+
+        self.indptr = (group.indptr.read(), group.t_indptr.read())
+        self.proj = (group.proj0.read(), group.proj1.read())
+
+        # Prefix sums of the marginals give band totals in O(1)
+        self.proj_cum = tuple(np.concatenate(([0], np.cumsum(p)))
+                              for p in self.proj)
+
+    def gate(self, lo, hi, axis=0):
+        """
+        Project the matrix onto the other axis, summing over the channel band
+        lo..hi (inclusive) of 'axis'.
+        """
+
+        lo, hi = self._clip_band(lo, hi)
+
+        if axis == 0:
+            indices, counts = self.group.indices, self.group.counts
+        else:
+            indices, counts = self.group.t_indices, self.group.t_counts
+
+        start = self.indptr[axis][lo]
+        stop = self.indptr[axis][hi + 1]
+
+        return np.bincount(indices[start:stop], weights=counts[start:stop],
+                           minlength=self.n_bins).astype(np.int64)
+
+    def gate_total(self, lo, hi, axis=0):
+        """Total coincidences with the 'axis' energy inside lo..hi."""
+
+        lo, hi = self._clip_band(lo, hi)
+        if hi < lo:
+            return 0
+
+        return self.proj_cum[axis][hi + 1] - self.proj_cum[axis][lo]
+
+    def _clip_band(self, lo, hi):
+        return max(int(lo), 0), min(int(hi), self.n_bins - 1)
+
+
+class CoincidenceCube(object):
+    """
+    Read-only view of a stored gamma-gamma-gamma cube. Double-gated
+    projections are summed from the cells inside both gates; a gate on
+    energy_0 only reads that band's slice of the coordinate arrays.
+    """
+
+    def __init__(self, group, read_size=2 ** 22):
+        self.group = group
+        self.n_bins = int(group._v_attrs.n_bins)
+        self.read_size = read_size
+
+        self.indptr = group.indptr.read()
+
+    def gate(self, gates, axis):
+        """
+        Project onto 'axis' (0, 1 or 2), keeping only cells whose energies on
+        the other axes fall inside 'gates', a dict of {axis: (lo, hi)} with
+        inclusive channel bounds.
+        """
+
+        start, stop = 0, int(self.indptr[-1])
+        if 0 in gates:
+            lo, hi = gates[0]
+            lo, hi = max(int(lo), 0), min(int(hi), self.n_bins - 1)
+            if hi < lo:
+                return np.zeros(self.n_bins, dtype=np.int64)
+            start, stop = int(self.indptr[lo]), int(self.indptr[hi + 1])
+
+        proj = np.zeros(self.n_bins, dtype=np.int64)
+
+        for pos in range(start, stop, self.read_size):
+            end = min(pos + self.read_size, stop)
+
+            coords = {1: self.group.e1[pos:end].astype(np.int64),
+                      2: self.group.e2[pos:end].astype(np.int64)}
+            if 0 in gates or axis == 0:
+                coords[0] = np.searchsorted(self.indptr, np.arange(pos, end),
+                                            side='right') - 1
+            counts = self.group.counts[pos:end]
+
+            sel = np.ones(end - pos, dtype=bool)
+            for gate_axis, (lo, hi) in gates.items():
+                if gate_axis != 0:
+                    sel &= (coords[gate_axis] >= lo) & (coords[gate_axis] <= hi)
+
+            proj += np.bincount(coords[axis][sel], weights=counts[sel],
+                                minlength=self.n_bins).astype(np.int64)
+
+        return proj
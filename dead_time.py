@@ -0,0 +1,104 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+
+# Internal Imports
+from spectrum_defs import HIT_CHANNELS
+
+
+class ChunkedHits(object):
+    """
+    Number of events recorded by each detector channel in every time chunk,
+    counted alongside the spectra during the aggregation pass.
+    """
+
+    def __init__(self, n_chunks, t_start, t_steps, n_channels=HIT_CHANNELS):
+
+        self.n_chunks = n_chunks
+        self.t_start = t_start
+        self.t_steps = t_steps
+        self.n_channels = n_channels
+        self.hits = np.zeros((n_chunks, n_channels), dtype=np.int64)
+
+    def update(self, block):
+        chunk = np.floor((block['timestamp'] - self.t_start) / self.t_steps)
+        chunk = np.clip(chunk, 0, self.n_chunks - 1).astype(np.intp)
+
+        for chan in range(self.n_channels):
+            fired = block['energy_' + str(chan)] != -1
+            self.hits[:, chan] += np.bincount(chunk[fired],
+                                              minlength=self.n_chunks)
+
+
+def chunk_real_times(n_chunks, t_steps, t_duration, real_total):
+    """
+    Real time of each chunk: t_steps for all but the last, which ends with
+    the final event, scaled so the chunks add up to the run real time.
+    """
+
+    real = np.empty(n_chunks)
+    real.fill(t_steps)
+    if n_chunks:
+        real[-1] = max(t_duration - (n_chunks - 1) * t_steps, 0.0)
+
+    if real.sum() > 0:
+        real *= real_total / real.sum()
+
+    return real
+
+
+def chunk_live_times(hits, real, live_total):
+    """
+    Live time of every channel in each chunk (n_chunks x channels).
+
+    Each channel is given a fixed dead time per recorded event, chosen so
+    that its dead time summed over the run matches real - live from the .ifm
+    files. Channels with no events keep the run live fraction throughout.
+
+    A chunk whose rate is well above the run average would be given more
+    dead time than real time; its live time is clipped to zero and the
+    excess dead time is taken from the other chunks of the channel in
+    proportion to their live time, so live times stay within [0, real] and
+    still add up to live_total.
+    """
+
+    live_total = np.asarray(live_total, dtype=float)
+    real_total = real.sum()
+
+    n_events = np.zeros((len(real), len(live_total)))
+    n_events[:, :hits.shape[1]] = hits[:, :len(live_total)]
+    totals = n_events.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau = np.where(totals > 0, (real_total - live_total) / totals, 0.0)
+        fraction = np.where(real_total > 0, live_total / real_total, 0.0)
+
+    live = real[:, None] - n_events * tau
+    excess = np.maximum(-live, 0.0).sum(axis=0)
+    live = np.clip(live, 0.0, real[:, None])
+
+    remaining = live.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(remaining > 0, 1.0 - excess / remaining, 0.0)
+    live *= np.maximum(scale, 0.0)
+
+    idle = totals == 0
+    live[:, idle] = real[:, None] * fraction[idle]
+
+    return live
+
+
+def cumulative(per_chunk):
+    """
+    Running totals aligned with the rows of the time-chunked spectrum
+    arrays: row k covers chunks 0..k-1, so row 0 is zero.
+    """
+
+    per_chunk = np.asarray(per_chunk, dtype=float)
+    out = np.zeros((len(per_chunk) + 1,) + per_chunk.shape[1:])
+    np.cumsum(per_chunk, axis=0, out=out[1:])
+
+    return out
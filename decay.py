@@ -0,0 +1,146 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import math
+
+# External Imports
+import numpy as np
+
+LN2 = math.log(2.0)
+
+# Largest exponent allowed in the decay model, to keep exp() finite
+MAX_EXPONENT = 700.0
+
+SERIES_DTYPE = np.dtype([('spectrum', 'S16'), ('det', 'i4'),
+                         ('zaid', 'S12'), ('name', 'S12'), ('energy', 'f8'),
+                         ('t_start', 'f8'), ('t_stop', 'f8'), ('live', 'f8'),
+                         ('gross', 'f8'), ('background', 'f8'),
+                         ('net', 'f8'), ('rate', 'f8'), ('rate_err', 'f8')])
+
+DECAY_DTYPE = np.dtype([('spectrum', 'S16'), ('det', 'i4'),
+                        ('zaid', 'S12'), ('name', 'S12'), ('energy', 'f8'),
+                        ('n_points', 'i4'), ('net', 'f8'), ('rate0', 'f8'),
+                        ('rate0_err', 'f8'), ('half_life', 'f8'),
+                        ('half_life_err', 'f8'), ('activity0', 'f8'),
+                        ('activity0_err', 'f8'), ('chi2', 'f8'),
+                        ('converged', '?')])
+
+
+def interval_rates(gross, background, live):
+    """
+    Net counts and count rates (with their errors) of every line in each
+    interval, from ROI gross and background sums over the cumulative rows
+    bounding the intervals (rows x lines) and the cumulative live time at
+    those rows. Returns dicts of (intervals x lines) arrays.
+    """
+
+    gross = np.diff(gross, axis=0)
+    background = np.diff(background, axis=0)
+    live = np.diff(np.asarray(live, dtype=float))[:, None]
+
+    net = gross - background
+    variance = np.maximum(gross + background, 1.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = np.where(live > 0, net / live, 0.0)
+        rate_err = np.where(live > 0, np.sqrt(variance) / live, np.inf)
+
+    return {'gross': gross, 'background': background, 'net': net,
+            'rate': rate, 'rate_err': rate_err}
+
+
+def fit_decay(times, rates, rate_errs, max_iter=50, tol=1e-8):
+    """
+    Fit rate = rate0 * exp(-lambda * t) to the count rates of every line
+    at once (lines x points, measured at 'times' in seconds), by
+    iteratively reweighted least squares on the log-linear model, so that
+    points with zero or negative net rates still count.
+
+    Returns a dict of per-line arrays: rate0 (at t = 0) and decay constant
+    lambda (1/s) with their errors, reduced chi-square, the number of
+    points used and whether the fit converged.
+    """
+
+    rates = np.atleast_2d(np.asarray(rates, dtype=float))
+    errs = np.atleast_2d(np.asarray(rate_errs, dtype=float))
+    times = np.asarray(times, dtype=float)
+
+    usable = np.isfinite(errs) & (errs > 0)
+    inv_var = np.where(usable, 1.0 / np.where(usable, errs, 1.0) ** 2, 0.0)
+    n_points = usable.sum(axis=1)
+
+    # Centre the times so the two parameters are nearly uncorrelated
+    t_ref = times.mean() if len(times) else 0.0
+    dt = times - t_ref
+    span = np.abs(dt).max() if len(dt) else 0.0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_rate = (inv_var * rates).sum(axis=1) / inv_var.sum(axis=1)
+    intercept = np.log(np.where(mean_rate > 0, mean_rate, 1e-12))
+    slope = np.zeros(len(rates))
+    converged = np.zeros(len(rates), dtype=bool)
+
+    for _ in range(max_iter):
+        eta = np.clip(intercept[:, None] + slope[:, None] * dt,
+                      -MAX_EXPONENT, MAX_EXPONENT)
+        mu = np.exp(eta)
+
+        # Working response and weights of a log-link GLM
+        z = eta + (rates - mu) / mu
+        w = mu ** 2 * inv_var
+
+        s0, s1, s2 = w.sum(1), (w * dt).sum(1), (w * dt ** 2).sum(1)
+        r0, r1 = (w * z).sum(1), (w * z * dt).sum(1)
+        det = s0 * s2 - s1 ** 2
+        ok = det > 0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_intercept = np.where(ok, (s2 * r0 - s1 * r1) / det, intercept)
+            new_slope = np.where(ok, (s0 * r1 - s1 * r0) / det, slope)
+
+        step = (np.abs(new_intercept - intercept) +
+                np.abs(new_slope - slope) * span)
+        intercept, slope = new_intercept, new_slope
+        converged = ok & (step < tol * (1.0 + np.abs(intercept)))
+        if converged.all():
+            break
+
+    eta = np.clip(intercept[:, None] + slope[:, None] * dt,
+                  -MAX_EXPONENT, MAX_EXPONENT)
+    mu = np.exp(eta)
+    w = mu ** 2 * inv_var
+    s0, s1, s2 = w.sum(1), (w * dt).sum(1), (w * dt ** 2).sum(1)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        det = s0 * s2 - s1 ** 2
+        var_a, var_b, cov_ab = s2 / det, s0 / det, -s1 / det
+
+        dof = np.maximum(n_points - 2, 1)
+        chi2 = (inv_var * (rates - mu) ** 2).sum(axis=1) / dof
+        scale = np.maximum(chi2, 1.0)
+
+        # ln(rate0) = intercept - slope * t_ref
+        log_rate0 = intercept - slope * t_ref
+        var_log_rate0 = var_a + t_ref ** 2 * var_b - 2 * t_ref * cov_ab
+        rate0 = np.exp(np.minimum(log_rate0, MAX_EXPONENT))
+
+        return {
+            'rate0': rate0,
+            'rate0_err': rate0 * np.sqrt(np.maximum(
+                var_log_rate0 * scale, 0.0)),
+            'lambda': -slope,
+            'lambda_err': np.sqrt(np.maximum(var_b * scale, 0.0)),
+            'chi2': chi2,
+            'n_points': n_points,
+            'converged': converged & (n_points > 2),
+        }
+
+
+def half_lives(decay_const, decay_const_err):
+    """Half-lives (s) and their errors from fitted decay constants."""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        half_life = LN2 / decay_const
+        return half_life, np.abs(half_life * decay_const_err / decay_const)
@@ -0,0 +1,167 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+
+# Half-width of the centroid search window in units of the detector FWHM
+SEARCH_WIDTH = 3.0
+
+# Channels averaged at each edge of the window for the linear background
+EDGE_CHANNELS = 3
+
+# Name suffix of gain-corrected spectrum arrays (e.g. norm1_gc_spec)
+GC_SUFFIX = 'gc_spec'
+
+# SplitMix64 constants for the per-event dither
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def corrected_spec(spec):
+    """
+    spectrum_config style dict for the gain-corrected copy of a spectrum:
+    same selection, '_gc' name and '-GC' label, no event log.
+    """
+
+    label, rest = spec['title'].split(' ', 1)
+    return dict(spec, name=spec['name'][:-4] + GC_SUFFIX,
+                title=label + '-GC ' + rest, log=None)
+
+
+def peak_centroids(spectra, centres, half_width):
+    """
+    Background-subtracted centroids of the peaks near 'centres' (channels) in
+    every row of 'spectra' at once. The background is a straight line between
+    the edge channels of each window. Returns the centroids and net counts,
+    both shaped (rows, lines).
+    """
+
+    spectra = np.asarray(spectra, dtype=float)
+    n_bins = spectra.shape[-1]
+
+    lo = np.clip(np.floor(centres - half_width), 0, n_bins - 1)
+    hi = np.clip(np.ceil(centres + half_width), lo + 1, n_bins - 1)
+    lo, hi = lo.astype(np.intp), hi.astype(np.intp)
+
+    offsets = np.arange((hi - lo).max() + 1)
+    chan = np.minimum(lo[:, None] + offsets, hi[:, None])
+    inside = offsets <= (hi - lo)[:, None]
+    window = spectra[..., chan]
+
+    edge = np.arange(EDGE_CHANNELS)
+    left = spectra[..., np.minimum(lo[:, None] + edge, hi[:, None])]
+    right = spectra[..., np.maximum(hi[:, None] - edge, lo[:, None])]
+    left, right = left.mean(axis=-1), right.mean(axis=-1)
+
+    slope = (right - left) / (hi - lo)
+    background = left[..., None] + slope[..., None] * (chan - lo[:, None])
+
+    net = np.where(inside, np.maximum(window - background, 0.0), 0.0)
+    net_counts = net.sum(axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroid = (net * chan).sum(axis=-1) / net_counts
+
+    return centroid, net_counts
+
+
+def event_uniform(rows, stream):
+    """
+    Uniform [0, 1) number for each readout row index in 'rows', a SplitMix64
+    hash of the row and an integer 'stream'. The value an event gets does
+    not depend on how the readout was split into blocks.
+    """
+
+    z = (np.asarray(rows, dtype=np.uint64) * np.uint64(256) +
+         np.uint64(stream)) * GOLDEN_GAMMA
+    z = (z ^ (z >> np.uint64(30))) * MIX_1
+    z = (z ^ (z >> np.uint64(27))) * MIX_2
+    z ^= z >> np.uint64(31)
+
+    return (z >> np.uint64(11)) * 2.0 ** -53
+
+
+def fit_gains(measured, reference, weights, min_counts=100.0):
+    """
+    Weighted least-squares fit of reference = gain * measured + offset for
+    every row of 'measured' (rows, lines). Lines with fewer than 'min_counts'
+    net counts are ignored; rows left with a single line fit a gain alone,
+    and rows with none are interpolated from their neighbours (or left at
+    unit gain if no row can be fitted).
+    """
+
+    weights = np.where(np.isfinite(measured) & (weights >= min_counts),
+                       weights, 0.0)
+    measured = np.where(weights > 0, measured, 0.0)
+    reference = np.broadcast_to(reference, measured.shape)
+
+    sw = weights.sum(axis=-1)
+    sx = (weights * measured).sum(axis=-1)
+    sy = (weights * reference).sum(axis=-1)
+    sxx = (weights * measured ** 2).sum(axis=-1)
+    sxy = (weights * measured * reference).sum(axis=-1)
+
+    det = sw * sxx - sx ** 2
+    linear = ((weights > 0).sum(axis=-1) >= 2) & (det > 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gain = np.where(linear, (sw * sxy - sx * sy) / det, sxy / sxx)
+        offset = np.where(linear, (sxx * sy - sx * sxy) / det, 0.0)
+
+    fitted = (sw > 0) & np.isfinite(gain) & np.isfinite(offset)
+    if not fitted.any():
+        return np.ones(len(gain)), np.zeros(len(gain))
+
+    rows = np.arange(len(gain))
+    return (np.interp(rows, rows[fitted], gain[fitted]),
+            np.interp(rows, rows[fitted], offset[fitted]))
+
+
+class GainCorrection(object):
+    """
+    Time-dependent gain/offset of each detector channel, interpolated
+    linearly between the centres of the tracking intervals and applied to
+    the event energies of readout blocks.
+
+    Each count is spread uniformly over its channel before the mapping,
+    which keeps the re-histogrammed spectra free of the comb pattern a plain
+    rounding would leave. The dither of an event is a hash of its readout
+    row, channel and 'seed', so reruns match whatever the block size.
+    """
+
+    def __init__(self, times, seed=0):
+
+        self.times = np.asarray(times, dtype=float)
+        self.gains = {}
+        self.seed = seed
+
+    def add(self, channel, gain, offset):
+        self.gains['energy_' + str(channel)] = (gain, offset)
+
+    def apply(self, block, start=0):
+        """
+        Copy of 'block' with the energies of every channel corrected;
+        'start' is the readout row of the first event in the block.
+        """
+
+        corrected = block.copy()
+        timestamp = block['timestamp']
+        rows = start + np.arange(len(block))
+
+        for field, (gain, offset) in sorted(self.gains.items()):
+            energy = block[field]
+            hit = energy >= 0
+            stream = 16 * self.seed + int(field.split('_')[-1])
+
+            t_hit = timestamp[hit]
+            channel = (energy[hit] - 0.5 +
+                       event_uniform(rows[hit], stream))
+            channel = (np.interp(t_hit, self.times, gain) * channel +
+                       np.interp(t_hit, self.times, offset))
+
+            corrected[field][hit] = np.floor(channel + 0.5)
+
+        return corrected
@@ -0,0 +1,124 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+import tables as tb
+
+# Internal Imports
+from coincidence import SPARSE_FILTERS, SparseAccumulator
+
+
+def gate_lut(left_marker, right_marker, n_bins):
+    """
+    Compile inclusive channel gates into a channel -> gate-id lookup table.
+
+    Gates may overlap, so the table has one layer per level of overlap:
+    lut[layer, channel] is the id of a gate covering 'channel', or -1.
+    Gates falling entirely outside 0..n_bins-1 are left out.
+    """
+
+    left = np.clip(np.asarray(left_marker), 0, n_bins)
+    right = np.clip(np.asarray(right_marker), -1, n_bins - 1)
+    lengths = np.maximum(right - left + 1, 0)
+
+    # Expand every gate into its (gate id, channel) pairs
+    gate_id = np.repeat(np.arange(len(lengths)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) -
+                                                   lengths, lengths)
+    channel = np.repeat(left, lengths) + offsets
+
+    # Rank of each pair among those sharing its channel gives its layer
+    order = np.argsort(channel, kind='mergesort')
+    channel, gate_id = channel[order], gate_id[order]
+    layer = np.arange(len(channel)) - np.searchsorted(channel, channel)
+
+    depth = layer.max() + 1 if len(layer) else 1
+    lut = np.empty((depth, n_bins), dtype=np.int32)
+    lut.fill(-1)
+    lut[layer, channel] = gate_id
+
+    return lut
+
+
+class GatedSpectra(object):
+    """
+    Coincidence spectra of one detector gated on every line of a library at
+    once. For each block the gate ids of all coincident events are looked up
+    in the LUT and the spectra for all gates come out of a single bincount.
+
+    When the dense (n_gates x n_bins) array would exceed 'max_cells', the
+    spectra are accumulated sparsely instead (spilling to 'scratch' if given)
+    and written out a band of gates at a time.
+    """
+
+    def __init__(self, lut, n_gates, n_bins, short_window,
+                 gate_axis='energy_1', axis='energy_2', delta_t='deltaT_12',
+                 max_cells=None, scratch=None):
+
+        self.lut = lut
+        self.n_gates = n_gates
+        self.n_bins = n_bins
+        self.short_window = short_window
+        self.gate_axis = gate_axis
+        self.axis = axis
+        self.delta_t = delta_t
+        self.max_cells = max_cells
+
+        self.spectra = None
+        self.sparse = None
+        if max_cells is None or n_gates * n_bins <= max_cells:
+            self.spectra = np.zeros(n_gates * n_bins, dtype=np.int64)
+        else:
+            self.sparse = SparseAccumulator((n_gates, n_bins),
+                                            max_keys=max_cells,
+                                            scratch=scratch)
+
+    def update(self, block):
+        eg = block[self.gate_axis]
+        ex = block[self.axis]
+
+        sel = ((eg >= 0) & (eg < self.n_bins) &
+               (ex >= 0) & (ex < self.n_bins) &
+               (block[self.delta_t] < self.short_window))
+
+        gate_id = self.lut[:, eg[sel]]
+        hit = gate_id >= 0
+
+        # Broadcast the measured energy across every overlapping gate layer
+        energy = np.broadcast_to(ex[sel], gate_id.shape)
+        keys = gate_id[hit].astype(np.int64) * self.n_bins + energy[hit]
+
+        if self.spectra is not None:
+            self.spectra += np.bincount(keys, minlength=len(self.spectra))
+        else:
+            self.sparse.add_keys(keys)
+
+    def store(self, h5file, where, name, title=''):
+        """Write the gated spectra as an (n_gates x n_bins) array."""
+
+        if self.spectra is not None:
+            spectra = self.spectra.reshape(self.n_gates, self.n_bins)
+            return h5file.createArray(where, name, spectra.astype(np.int32),
+                                      title)
+
+        node = h5file.createCArray(where, name, tb.Int32Atom(),
+                                   (self.n_gates, self.n_bins), title,
+                                   filters=SPARSE_FILTERS)
+
+        band = max(self.max_cells // self.n_bins, 1)
+        for keys, counts in self.sparse.iter_sorted():
+            if not len(keys):
+                continue
+
+            gates = keys // self.n_bins
+            for lo in range(int(gates[0]), int(gates[-1]) + 1, band):
+                hi = min(lo + band, self.n_gates)
+                sel = (gates >= lo) & (gates < hi)
+
+                rows = np.zeros((hi - lo) * self.n_bins, dtype=np.int32)
+                rows[keys[sel] - lo * self.n_bins] = counts[sel]
+                node[lo:hi] = rows.reshape(hi - lo, self.n_bins)
+
+        return node
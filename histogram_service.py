@@ -0,0 +1,181 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import threading
+from collections import OrderedDict
+
+# External Imports
+import numpy as np
+
+# Cumulative rows and finished time windows kept in memory
+ROW_CACHE = 256
+WINDOW_CACHE = 64
+
+# Rows either side of the last request read ahead while idle
+PREFETCH = 4
+
+
+class LRUCache(object):
+    """Dict-like cache holding at most max_items, dropping the oldest used."""
+
+    def __init__(self, max_items):
+
+        self.max_items = max_items
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+
+        value = self._items.pop(key)
+        self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+class HistogramService(object):
+    """
+    Time-window histograms (differences of two cumulative rows) of one or
+    more time-chunked arrays, e.g. a spectrum and its background, computed
+    on a worker thread. With a SpectrumPyramid of the first array, coarse
+    windows can be asked for at a pyramid level as well.
+
+    Requests are coalesced: only the latest one waiting is served, so fast
+    slider moves never queue up reads. Each result is handed to 'deliver'
+    (on the worker thread) as deliver(tag, lower, upper, windows, level);
+    while idle the worker reads the rows next to the last request. Rows and
+    windows are kept in LRU caches, which 'cached' looks up without ever
+    waiting on a read. All reads of the arrays go through 'lock', which
+    callers share for their own reads of the same file.
+    """
+
+    def __init__(self, nodes, deliver, pyramid=None, max_rows=ROW_CACHE,
+                 max_windows=WINDOW_CACHE, prefetch=PREFETCH):
+
+        self.nodes = list(nodes)
+        self.deliver = deliver
+        self.pyramid = pyramid
+        self.prefetch = prefetch
+        self.rows = LRUCache(max_rows)
+        self.windows = LRUCache(max_windows)
+        self.lock = threading.RLock()
+
+        # Guards the caches only, so it is never held during a read
+        self._cache_lock = threading.Lock()
+
+        self._wake = threading.Condition()
+        self._pending = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def request(self, lower, upper, tag=None, level=0):
+        """Queue a window, replacing any request not yet started."""
+
+        with self._wake:
+            self._pending = (lower, upper, tag, level)
+            self._wake.notify()
+
+    def close(self):
+        with self._wake:
+            self._closed = True
+            self._wake.notify()
+
+    def cached(self, lower, upper, level=0):
+        """A window already in memory, or None; the arrays are not read."""
+
+        with self._cache_lock:
+            return self.windows.get((level, lower, upper))
+
+    def row(self, index, row):
+        """Cumulative row of node 'index', from the cache when possible."""
+
+        with self._cache_lock:
+            value = self.rows.get((index, row))
+
+        if value is None:
+            with self.lock:
+                value = self.nodes[index][row]
+            with self._cache_lock:
+                self.rows.put((index, row), value)
+
+        return value
+
+    def window(self, lower, upper, level=0):
+        """
+        Histograms between two cumulative rows, one per node (or None). At
+        a pyramid level above 0, the (channels, counts) of the first
+        node's pyramid spectrum instead.
+        """
+
+        windows = self.cached(lower, upper, level)
+        if windows is not None:
+            return windows
+
+        if level:
+            with self.lock:
+                windows = self.pyramid.spectrum(level, lower, upper)
+        else:
+            windows = tuple(
+                None if node is None else
+                np.asarray(self.row(k, upper)) -
+                np.asarray(self.row(k, lower))
+                for k, node in enumerate(self.nodes))
+
+        with self._cache_lock:
+            self.windows.put((level, lower, upper), windows)
+
+        return windows
+
+    def _run(self):
+        last = None
+        while True:
+            with self._wake:
+                while self._pending is None and not self._closed:
+                    if last is not None:
+                        break
+                    self._wake.wait()
+
+                if self._closed:
+                    return
+
+                job, self._pending = self._pending, None
+
+            if job is not None:
+                lower, upper, tag, level = job
+                self.deliver(tag, lower, upper,
+                             self.window(lower, upper, level), level)
+                last = (lower, upper)
+            elif last is not None:
+                self._prefetch(*last)
+                last = None
+
+    def _prefetch(self, lower, upper):
+        # Rows a slider step or two either side, stopping for new requests
+        for step in range(1, self.prefetch + 1):
+            for row in (lower - step, lower + step, upper - step,
+                        upper + step):
+                if self._pending is not None or self._closed:
+                    return
+
+                for k, node in enumerate(self.nodes):
+                    if node is not None and 0 <= row < len(node):
+                        self.row(k, row)
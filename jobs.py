@@ -0,0 +1,195 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import os
+import time
+import traceback
+from collections import OrderedDict
+
+# External Imports
+from traits.api import TraitError
+
+# Internal Imports
+from parser_model import PyramdsParser, SpectrumExporter
+from series_catalog import SeriesCatalog
+
+# Parser stages of a full parse, in order, with the parser setting that
+# switches each optional stage on (None: always run)
+PARSE_STAGES = (('start_parse', None),
+                ('store_sig_lookup_h5', None),
+                ('store_spectra_h5', None),
+                ('store_gain_corrected_h5', 'gain_stabilize'),
+                ('store_coincidence_h5', 'build_coincidence'),
+                ('store_calibrated_h5', 'build_calibrated'),
+                ('store_background_h5', 'build_background'),
+                ('store_detection_limits_h5', 'build_limits'),
+                ('store_decay_h5', 'build_decay'),
+                ('store_pyramid_h5', 'build_pyramid'))
+
+# Settings forced on jobs run inside a process pool, over any overrides:
+# pool workers cannot start export pools of their own, so their files are
+# written in-process
+POOL_SETTINGS = {'export_workers': 1}
+
+# Settings kept as plain class attributes rather than traits
+PLAIN_SETTINGS = ('t_steps',)
+
+
+def series_first_file(data_cwd, series_basename):
+    """
+    Path of the lowest-numbered .bin file of a series (what the GUI is
+    given), which for a partial copy need not be series_basename0001.bin.
+    None if the series has no .bin files.
+    """
+
+    names = SeriesCatalog(os.path.join(data_cwd,
+                                       series_basename)).list_series('bin')
+    if not names:
+        return None
+
+    return os.path.join(data_cwd, names[0])
+
+
+def _tuples(value):
+    """JSON arrays (lists) as tuples, at every depth."""
+
+    if isinstance(value, list):
+        return tuple(_tuples(item) for item in value)
+
+    return value
+
+
+def settings_of(model):
+    """Names of a model's settings: its traits and PLAIN_SETTINGS."""
+
+    names = model.trait_names(type=lambda t: t not in ('event', 'property'))
+    return set(names).union(PLAIN_SETTINGS)
+
+
+def _set_value(model, name, value):
+    # Values read from JSON have lists where traits may want tuples (e.g.
+    # time_windows, a List of (start, stop) Tuples), so those forms are
+    # tried as well
+    candidates = [value]
+    if isinstance(value, list):
+        candidates += [[_tuples(item) for item in value], _tuples(value)]
+
+    for candidate in candidates:
+        try:
+            setattr(model, name, candidate)
+            return True
+        except TraitError:
+            pass
+
+    return False
+
+
+def apply_overrides(models, overrides):
+    """
+    Set parser/exporter settings from a dict (e.g. {'t_steps': 30.0}) on
+    every one of 'models' that has them. Only traits and PLAIN_SETTINGS are
+    settings, so methods cannot be replaced. Returns the names applied;
+    raises ValueError naming any unknown setting or any value that does not
+    fit its trait.
+    """
+
+    applied = []
+    invalid = []
+    for name, value in sorted((overrides or {}).items()):
+        targets = [model for model in models if name in settings_of(model)]
+        if not targets:
+            invalid.append('{0} (unknown)'.format(name))
+        elif not all(_set_value(model, name, value) for model in targets):
+            invalid.append('{0}={1!r}'.format(name, value))
+        else:
+            applied.append(name)
+
+    if invalid:
+        raise ValueError('Invalid settings: ' + ', '.join(invalid))
+
+    return applied
+
+
+def _timed(timings, name, func, *args):
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        if timings is not None:
+            timings[name] = time.time() - start
+
+
+def run_parse(parser, timings=None):
+    """
+    The parse stages switched on for the parser's series, as the Parse
+    Series button runs them, with the seconds taken by each added to
+    'timings'. Returns the HDF5 file written.
+    """
+
+    for stage, setting in PARSE_STAGES:
+        if setting is not None and not getattr(parser, setting):
+            continue
+        _timed(timings, stage, getattr(parser, stage))
+
+    return parser.h5_filename
+
+
+def run_export(exporter, timings=None):
+    """
+    Every export of an HDF5 file, as the Export Spectra button runs them,
+    with stage timings added to 'timings'. Returns the files written.
+    """
+
+    outputs = []
+    outputs.extend(_timed(timings, 'write_spec', exporter.write_spec))
+    outputs.extend(_timed(timings, 'write_time_slices',
+                          exporter.write_time_slices))
+    if exporter.bulk_export:
+        outputs.append(_timed(timings, 'write_bulk', exporter.write_bulk))
+
+    return outputs
+
+
+def run_job(data_file, overrides=None, export=True):
+    """
+    Parse one series (given its first .bin file) and export its spectra,
+    headless. Settings of both models can be overridden by name. Returns a
+    summary dict: status ('done' or 'failed'), the HDF5 file, the files
+    written, per-stage timings and the error traceback of a failed job.
+    """
+
+    timings = OrderedDict()
+    summary = {'data_file': data_file, 'status': 'done', 'h5_file': None,
+               'outputs': [], 'timings': timings, 'error': None}
+    start = time.time()
+
+    parser = PyramdsParser()
+    exporter = SpectrumExporter()
+    try:
+        if not os.path.isfile(data_file):
+            raise IOError('No such series file: ' + data_file)
+
+        apply_overrides([parser, exporter], overrides)
+
+        parser.data_file = data_file
+        _timed(timings, 'get_bin_info', parser.get_bin_info)
+
+        summary['h5_file'] = run_parse(parser, timings)
+        parser.h5file.close()
+        parser.h5file = None
+        summary['outputs'].append(summary['h5_file'])
+
+        if export:
+            exporter.data_file = summary['h5_file']
+            summary['outputs'].extend(run_export(exporter, timings))
+    except Exception:
+        summary['status'] = 'failed'
+        summary['error'] = traceback.format_exc()
+    finally:
+        if parser.h5file is not None and parser.h5file.isopen:
+            parser.h5file.close()
+
+    summary['elapsed'] = time.time() - start
+    return summary
@@ -6,15 +6,37 @@
 import struct
 import os
 import numpy as np
-import textwrap
-from datetime import datetime
+from itertools import chain
+from datetime import datetime, timedelta
 
 # External Imports
 import tables as tb
 from tables import Float32Col, Int32Col, IsDescription
 
 # Internal Imports
+from aggregation import (CELL_BYTES, block_size_for, iter_blocks, parse_memory,
+                         read_rows)
+from background import background_name, snip_background
+from coincidence import (GammaCube, GammaGammaMatrix, store_sparse_cube,
+                         store_sparse_matrix)
+from dead_time import (ChunkedHits, chunk_live_times, chunk_real_times,
+                       cumulative)
+from decay import (DECAY_DTYPE, SERIES_DTYPE, fit_decay, half_lives,
+                   interval_rates)
+from detection_limits import (LIMITS_DTYPE, currie_limits, efficiency,
+                              fitted_net, mda, sized_names)
+from gain_drift import (SEARCH_WIDTH, GC_SUFFIX, GainCorrection,
+                        corrected_spec, fit_gains, peak_centroids)
+from gating import GatedSpectra, gate_lut
 from parser_setup import PyramdsBase
+from peak_fit import fit_peaks
+from pyramid import downsample, level_name, level_rows, n_levels
+from calibration import kev_grid
+from signatures import (SignatureIndex, library_rois, read_sig_library,
+                        sig_markers)
+from spectrum_io import export_spectra, write_results
+from spectrum_defs import (ChunkedSpectrum, compile_definitions,
+                           evaluate_definitions)
 
 # Setup PyTables metaclasses for use in Table constructor
 class GammaEvent(IsDescription):
@@ -36,10 +58,18 @@ class AggEvent1(IsDescription):
     energy = Int32Col(pos=0)
     timestamp = Float32Col(pos=1)
 
-class AggEvent2(IsDescription):
-    energy_1 = Int32Col(pos=0)
-    energy_2 = Int32Col(pos=1)
-    timestamp = Float32Col(pos=2)
+# Fractions of max_memory given to the in-memory time-chunked spectra and to
+# each coincidence product; the remainder covers blocks and temporaries
+SPECTRA_SHARE = 0.5
+COINC_SHARES = {'matrix': 0.3, 'cube': 0.2, 'gated': 0.2}
+CALIBRATED_SHARE = 0.5
+LIMITS_SHARE = 0.5
+BACKGROUND_SHARE = 0.5
+PYRAMID_SHARE = 0.5
+
+# Library lines used as energy gates, with their ROI markers (channels)
+GATE_DTYPE = np.dtype([('zaid', 'S12'), ('name', 'S12'), ('energy', 'f8'),
+                       ('LM', 'i4'), ('RM', 'i4')])
 
 class PyramdsParser(PyramdsBase):
 
@@ -50,8 +80,11 @@ class PyramdsParser(PyramdsBase):
 
         # This table is where the data will be placed after unpacking it
         # from binary
+        # Size the table for the event count of the catalog prescan
+        expected = self.get_catalog().total_events()
         self.table = self.h5file.createTable(self.h5_group, 'readout',
-                                             GammaEvent, "Data readout")
+                                             GammaEvent, "Data readout",
+                                             expectedrows=expected or 10000)
 
         # Only start the buffer count before the entire run, not each file
         buffer_no = 0
@@ -167,290 +200,832 @@ class PyramdsParser(PyramdsBase):
         self.t_array_dim = int(np.ceil(self.t_duration / self.t_steps))
 
     def store_spectra_h5(self):
-
-        ######################################################################
-        # Store Det-1 & 2 arrays containing Normal counts ####################
-        ######################################################################
-
-        print('Started creating normal data aggregates...')
-
-        norm12table = self.h5file.createTable(self.h5_gNormal, 'norm_evts12',
-                                              AggEvent2,
-                                              "Normal Log Data")
-        norm_event = norm12table.row
-
-        for row in self.table.where("""(energy_1 != -1) | (energy_2 != -1)"""):
-            norm_event['energy_1'] = row['energy_1']
-            norm_event['energy_2'] = row['energy_2']
-            norm_event['timestamp'] = row['timestamp']
-            norm_event.append()
-            norm12table.flush()
-
-        # Det 1
-        dt_temp = np.zeros(self.energy_max + 1, dtype=np.int32)
-        dt_array = np.zeros((self.t_array_dim + 1, self.energy_max + 1),
-                            dtype=np.int32)
-        ti = 0
-        for row in norm12table:
-            if (row['timestamp'] - self.t_start) >= (ti + 1) * self.t_steps:
-                ti += 1
-                dt_array[ti] = dt_temp.copy()
-            if row['energy_1'] >= 0:
-                dt_temp[row['energy_1']] += 1
-        dt_array[-1] = dt_temp.copy()
-
-        self.h5file.createArray(self.h5_gNormal, 'norm1_spec',
-                                dt_array,
-                                "Normal Time-Chunked Spec Array - Det 1")
-
-        # Det 2
-        dt_temp = np.zeros(self.energy_max + 1, dtype=np.int32)
-        dt_array = np.zeros((self.t_array_dim + 1, self.energy_max + 1),
-                            dtype=np.int32)
-        ti = 0
-        for row in norm12table:
-            if (row['timestamp'] - self.t_start) >= (ti + 1) * self.t_steps:
-                ti += 1
-                dt_array[ti] = dt_temp.copy()
-            if row['energy_2'] >= 0:
-                dt_temp[row['energy_2']] += 1
-        dt_array[-1] = dt_temp.copy()
-
-        self.h5file.createArray(self.h5_gNormal, 'norm2_spec',
-                                dt_array,
-                                "Normal Time-Chunked Spec Array - Det 2")
-
-        ######################################################################
-        # Store Det-1 & 2 arrays containing Compton counts ###################
-        ######################################################################
-
-        print('Started creating anti-coincidence data aggregates...')
-
-        compt1table = self.h5file.createTable(self.h5_gCompton, 'compt_evts1',
-                                              AggEvent1,
-                                              "Compton Log Data - Det 1")
-        compt_event = compt1table.row
-
-        query = "(energy_0 == -1) & (energy_1 != -1) & (energy_2 == -1)"
-        for row in self.table.where(query):
-            compt_event['energy'] = row['energy_1']
-            compt_event['timestamp'] = row['timestamp']
-            compt_event.append()
-            compt1table.flush()
-
-        compt2table = self.h5file.createTable(self.h5_gCompton, 'compt_evts2',
-                                              AggEvent1,
-                                              "Compton Log Data - Det 2")
-        compt_event = compt2table.row
-
-        query = "(energy_0 == -1) & (energy_1 == -1) & (energy_2 != -1)"
-        for row in self.table.where(query):
-            compt_event['energy'] = row['energy_2']
-            compt_event['timestamp'] = row['timestamp']
-            compt_event.append()
-            compt2table.flush()
-
-        # Det 1
-        dt_temp = np.zeros(self.energy_max + 1, dtype=np.int32)
-        dt_array = np.zeros((self.t_array_dim + 1, self.energy_max + 1),
-                            dtype=np.int32)
-
-        ti = 0
-        for row in compt1table:
-            if (row['timestamp'] - self.t_start) >= (ti + 1) * self.t_steps:
-                ti += 1
-                dt_array[ti] = dt_temp.copy()
-            if row['energy'] >= 0:
-                dt_temp[row['energy']] += 1
-        dt_array[-1] = dt_temp.copy()
-
-        self.h5file.createArray(self.h5_gCompton, 'compt1_spec', dt_array,
-                                "Compton-Supp Time-Chunked Spec Array - Det 1")
-
-        # Det 2
-        dt_temp = np.zeros(self.energy_max + 1, dtype=np.int32)
-        dt_array = np.zeros((self.t_array_dim + 1, self.energy_max + 1),
-                            dtype=np.int32)
-
-        ti = 0
-        for row in compt2table:
-            if (row['timestamp'] - self.t_start) >= (ti + 1) * self.t_steps:
-                ti += 1
-                dt_array[ti] = dt_temp.copy()
-            if row['energy'] >= 0:
-                dt_temp[row['energy']] += 1
-        dt_array[-1] = dt_temp.copy()
-
-        self.h5file.createArray(self.h5_gCompton, 'compt2_spec', dt_array,
-                                "Compton-Supp Time-Chunked Spec Array - Det 2")
-
-        ######################################################################
-        # Store Det-1 & 2 arrays containing Gamma-Gamma counts ###############
-        ######################################################################
-
-        print('Started creating coincidence data aggregates...')
-
-        gg1table = self.h5file.createTable(self.h5_gGGcoinc, 'gg_evts1',
-                                           AggEvent1, "G-G Log Data - Det 1")
-        gg_event = gg1table.row
-
-        # Det 1
-        teststr1 = ("((energy_0 == -1) & "
-                    "(energy_1 != -1) & "
-                    "(energy_2 != -1) & "
-                    "(deltaT_12 < {0}))")
-
-        teststr2 = ("((energy_0 != -1) & "
-                    "(energy_1 != -1) & "
-                    "(energy_2 == -1) & "
-                    "(deltaT_01 < {0}))")
-
-        teststr3 = ("((energy_0 != -1) & "
-                    "(energy_1 != -1) & "
-                    "(energy_2 != -1) & "
-                    "(deltaT_01 < {0}))")
-
-        teststr4 = ("((energy_0 != -1) & "
-                    "(energy_1 != -1) & "
-                    "(energy_2 != -1) & "
-                    "(deltaT_12 < {0}))")
-
-        teststr = ' | '.join([teststr1, teststr2, teststr3, teststr4])
-        query = teststr.format(self.short_window)
-
-        for row in self.table.where(query):
-            gg_event['energy'] = row['energy_1']
-            gg_event['timestamp'] = row['timestamp']
-            gg_event.append()
-            gg1table.flush()
-
-        dt_temp = np.zeros(self.energy_max + 1, dtype=np.int32)
-        dt_array = np.zeros((self.t_array_dim + 1, self.energy_max + 1),
-                            dtype=np.int32)
-
-        ti = 0
-        for row in gg1table:
-            if (row['timestamp'] - self.t_start) >= (ti + 1) * self.t_steps:
-                ti += 1
-                dt_array[ti] = dt_temp.copy()
-            if row['energy'] >= 0:
-                dt_temp[row['energy']] += 1
-        dt_array[-1] = dt_temp.copy()
-
-        self.h5file.createArray(self.h5_gGGcoinc, 'gg1_spec', dt_array,
-                                "G-G Time-Chunked Spec Array - Det 1")
-
-        # Det 2
-        gg2table = self.h5file.createTable(self.h5_gGGcoinc, 'gg_evts2',
-                                           AggEvent1, "G-G Log Data - Det 2")
-        gg_event = gg2table.row
-
-        teststr1 = ("((energy_0 == -1) & "
-                    "(energy_1 != -1) & "
-                    "(energy_2 != -1) & "
-                    "(deltaT_12 < {0}))")
-
-        teststr2 = ("((energy_0 != -1) & "
-                    "(energy_1 == -1) & "
-                    "(energy_2 != -1) & "
-                    "(deltaT_02 < {0}))")
-
-        teststr3 = ("((energy_0 != -1) & "
-                    "(energy_1 != -1) & "
-                    "(energy_2 != -1) & "
-                    "(deltaT_02 < {0}))")
-
-        teststr4 = ("((energy_0 != -1) & "
-                    "(energy_1 != -1) & "
-                    "(energy_2 != -1) & "
-                    "(deltaT_12 < {0}))")
-
-        teststr = ' | '.join([teststr1, teststr2, teststr3, teststr4])
-        query = teststr.format(self.short_window)
-
-        for row in self.table.where(query):
-            gg_event['energy'] = row['energy_2']
-            gg_event['timestamp'] = row['timestamp']
-            gg_event.append()
-            gg2table.flush()
-
-        dt_temp = np.zeros(self.energy_max + 1, dtype=np.int32)
-        dt_array = np.zeros((self.t_array_dim + 1, self.energy_max + 1),
-                            dtype=np.int32)
-        ti = 0
-        for row in gg2table:
-            if (row['timestamp'] - self.t_start) >= (ti + 1) * self.t_steps:
-                ti += 1
-                dt_array[ti] = dt_temp.copy()
-            if row['energy'] >= 0:
-                dt_temp[row['energy']] += 1
-        dt_array[-1] = dt_temp.copy()
-
-        self.h5file.createArray(self.h5_gGGcoinc, 'gg2_spec', dt_array,
-                                "G-G Time-Chunked Spec Array - Det 2")
+        """
+        Build every spectrum in spectrum_defs (see spectrum_config.py) in a
+        single pass over the readout table, storing each as a time-chunked
+        cumulative array.
+        """
+
+        print('Started creating spectra aggregates...')
+
+        definitions = compile_definitions(self.spectrum_defs)
+
+        budget = parse_memory(self.max_memory)
+        block_size = block_size_for(budget, self.table.rowsize)
+        spectra = self.create_chunked_spectra(definitions, budget)
+        hits = ChunkedHits(self.t_array_dim, self.t_start, self.t_steps)
+
+        logs = {}
+        for defn in definitions:
+            if defn.log:
+                logs[defn.name] = self.h5file.createTable(
+                    self.get_spectra_group(defn.group), defn.log, AggEvent1,
+                    "{0} Log Data - Det {1}".format(defn.title.split()[0],
+                                                    defn.channel))
+
+        for block in iter_blocks(self.table, block_size):
+            hits.update(block)
+            masks = evaluate_definitions(definitions, block,
+                                         self.short_window)
+
+            for spectrum, sel in zip(spectra, masks):
+                sel = spectrum.update(block, sel)
+
+                log = logs.get(spectrum.definition.name)
+                if log is not None:
+                    events = np.zeros(sel.sum(), dtype=log.dtype)
+                    events['energy'] = block[spectrum.definition.field][sel]
+                    events['timestamp'] = block['timestamp'][sel]
+                    log.append(events)
+
+        self.store_chunked_spectra(spectra)
+
+        for log in logs.values():
+            log.flush()
+
+        self.store_chunk_times(hits.hits)
+
+        self.report_peak_memory('spectra')
+
+    def store_chunk_times(self, hits):
+        """
+        Store the cumulative real and per-channel live times of the time
+        chunks, row for row with the *_spec arrays, so the times of any
+        window of rows come from a difference like the spectrum itself.
+        """
+
+        stats = self.h5file.root.stats
+        real_total = float(stats.total.read())
+        live_total = np.asarray(stats.live.read(), dtype=float)
+
+        real = chunk_real_times(self.t_array_dim, self.t_steps,
+                                self.t_duration, real_total)
+        live = chunk_live_times(hits, real, live_total)
+
+        self.h5file.createArray(stats, 'real_chunks', cumulative(real),
+                                "Cumulative real time of time chunks")
+        self.h5file.createArray(stats, 'live_chunks', cumulative(live),
+                                "Cumulative live time of time chunks "
+                                "per channel")
+
+    def create_chunked_spectra(self, definitions, budget):
+        """
+        ChunkedSpectrum accumulators for 'definitions'. As many as fit in
+        their share of the budget are held in memory; the rest write each
+        chunk row to the file as it completes.
+        """
+
+        n_bins = self.energy_max + 1
+        dense_size = (self.t_array_dim + 1) * n_bins * 4
+        in_memory = int(budget * SPECTRA_SHARE) // dense_size
+
+        spectra = []
+        for spec_no, defn in enumerate(definitions):
+            spill = None
+            if spec_no >= in_memory:
+                spill = self.h5file.createCArray(
+                    self.get_spectra_group(defn.group), defn.name,
+                    tb.Int32Atom(), (self.t_array_dim + 1, n_bins),
+                    defn.title, chunkshape=(16, n_bins))
+
+            spectra.append(ChunkedSpectrum(defn, n_bins, self.t_array_dim,
+                                           self.t_start, self.t_steps,
+                                           spill=spill))
+
+        return spectra
+
+    def store_chunked_spectra(self, spectra):
+        for spectrum in spectra:
+            defn = spectrum.definition
+            if spectrum.spill is None:
+                self.h5file.createArray(self.get_spectra_group(defn.group),
+                                        defn.name, spectrum.finish(),
+                                        defn.title)
+            else:
+                spectrum.finish()
+
+    def store_gain_corrected_h5(self):
+        """
+        Correct the detector gains for drift over the run. The centroids of
+        the gain_lines are tracked in the normal spectra over intervals of
+        gain_chunks time chunks, a gain/offset is fitted per interval, and
+        every spectrum is re-histogrammed from the readout table with the
+        corrected energies. The corrected arrays (e.g. norm1_gc_spec) are
+        stored next to the raw ones.
+        """
+
+        print('Started gain-drift correction...')
+
+        cal = self.calibration
+        sig_lib = read_sig_library(self.sig_library)
+        ref_lines = sig_lib[np.array([zaid in self.gain_lines for zaid in
+                                      sig_lib['zaid'].astype(str)], bool)]
+
+        # Rows of the cumulative arrays bounding each tracking interval
+        edges = list(range(0, self.t_array_dim, self.gain_chunks))
+        edges.append(self.t_array_dim)
+        edges = np.array(edges)
+        times = self.t_start + self.t_steps * (edges[:-1] + edges[1:]) / 2.0
+
+        correction = GainCorrection(times)
+        for defn in compile_definitions(self.spectrum_defs):
+            det = str(defn.channel)
+            if (defn.group != 'normal' or det not in cal.detectors or
+                    defn.field in correction.gains):
+                continue
+
+            node = getattr(self.get_spectra_group(defn.group), defn.name)
+            counts = np.diff(read_rows(node, edges), axis=0)
+
+            centres = cal.to_channel(det, ref_lines['energy'])
+            valid = np.isfinite(centres)
+            centres = centres[valid]
+            half_width = SEARCH_WIDTH * cal.fwhm(det, centres)
+
+            centroid, net = peak_centroids(counts, centres, half_width)
+            gain, offset = fit_gains(centroid, centres, net,
+                                     self.gain_min_counts)
+            correction.add(defn.channel, gain, offset)
+
+            fit = self.h5file.createArray(
+                self.h5_gGain, 'det{0}_gain'.format(det),
+                np.column_stack([times, gain, offset]),
+                "Gain Drift Fit (time, gain, offset) - Det {0}".format(det))
+            fit.attrs.lines = ref_lines['zaid'][valid]
+
+        definitions = compile_definitions(
+            [corrected_spec(spec) for spec in self.spectrum_defs
+             if 'energy_' + str(spec['channel']) in correction.gains])
+
+        budget = parse_memory(self.max_memory)
+        block_size = block_size_for(budget, self.table.rowsize)
+        spectra = self.create_chunked_spectra(definitions, budget)
+
+        # Hit patterns and cuts come from the raw block; only the energies
+        # histogrammed are corrected
+        start = 0
+        for block in iter_blocks(self.table, block_size):
+            masks = evaluate_definitions(definitions, block,
+                                         self.short_window)
+            corrected = correction.apply(block, start)
+            start += len(block)
+
+            for spectrum, sel in zip(spectra, masks):
+                spectrum.update(corrected, sel)
+
+        self.store_chunked_spectra(spectra)
+
+        self.report_peak_memory('gain')
+
+    def store_sig_lookup_h5(self):
+        """
+        Cache the sorted signature library and the ROI markers of each
+        detector in /sig_lookup, for Pyraviz and later stages.
+        """
+
+        index = SignatureIndex.from_library(self.calibration, self.sig_library)
+        index.store(self.h5file)
+
+        return index
+
+    def store_coincidence_h5(self):
+
+        print('Started creating coincidence matrices...')
+
+        budget = parse_memory(self.max_memory)
+        block_size = block_size_for(budget, self.table.rowsize)
+        n_bins = self.energy_max + 1
+
+        # Sparse accumulators that outgrow their share of the budget spill
+        # sorted runs here; the group is removed once everything is stored
+        scratch = (self.h5file, self.h5file.createGroup(
+            self.h5_gCoinc, 'scratch', "Spilled partial histograms"))
+
+        matrix = GammaGammaMatrix(
+            n_bins, self.short_window, scratch=scratch,
+            max_keys=int(budget * COINC_SHARES['matrix']) // CELL_BYTES)
+
+        # Triple coincidences are rare enough to keep sparse, but the cube is
+        # only built on request
+        cube = None
+        if self.ggg_cube:
+            cube = GammaCube(
+                n_bins, self.short_window, scratch=scratch,
+                max_keys=int(budget * COINC_SHARES['cube']) // CELL_BYTES)
+
+        # Spectra of each detector gated on every library line seen by the
+        # other detector
+        sig_lib = read_sig_library(self.sig_library)
+        gated = {}
+        for gate_det, det in [('1', '2'), ('2', '1')]:
+            markers = sig_markers(sig_lib['energy'], self.calibration,
+                                  gate_det)
+            lut = gate_lut(markers[0], markers[1], n_bins)
+            gated[gate_det] = (markers, GatedSpectra(
+                lut, len(sig_lib), n_bins, self.short_window,
+                gate_axis='energy_' + gate_det, axis='energy_' + det,
+                max_cells=int(budget * COINC_SHARES['gated']) // 16,
+                scratch=scratch))
+
+        for block in iter_blocks(self.table, block_size):
+            matrix.update(block)
+            for markers, spectra in gated.values():
+                spectra.update(block)
+            if cube is not None:
+                cube.update(block)
+
+        store_sparse_matrix(self.h5file, self.h5_gCoinc, 'gg12', matrix,
+                            "G-G Coincidence Matrix - Det 1 x Det 2")
+
+        if cube is not None:
+            store_sparse_cube(self.h5file, self.h5_gCoinc, 'ggg012', cube,
+                              "G-G-G Coincidence Cube - Det 0 x 1 x 2")
+
+        for gate_det, (markers, spectra) in sorted(gated.items()):
+            det = spectra.axis[-1]
+
+            gate_lines = np.zeros(len(sig_lib), dtype=GATE_DTYPE)
+            for field in ('zaid', 'name', 'energy'):
+                gate_lines[field] = sig_lib[field]
+            gate_lines['LM'], gate_lines['RM'] = markers
+
+            self.h5file.createTable(
+                self.h5_gGated, 'gate{0}_lines'.format(gate_det), gate_lines,
+                "Gate Lines - Det {0}".format(gate_det))
+
+            spectra.store(
+                self.h5file, self.h5_gGated,
+                'gate{0}_det{1}'.format(gate_det, det),
+                "G-G Gated Spec Array - Gate Det {0} - Det {1}".format(
+                    gate_det, det))
+
+        self.h5file.removeNode(scratch[1], recursive=True)
+
+        self.report_peak_memory('coincidence')
+
+    def store_calibrated_h5(self):
+        """
+        Rebin every time-chunked spectrum onto one common keV grid using the
+        cached channel -> keV tables, and sum the detectors of each spectra
+        group on that grid. Rows are converted a band at a time to stay
+        within max_memory.
+        """
+
+        print('Started creating calibrated spectra...')
+
+        cal = self.calibration
+        kev_max = max(cal.channel_edges(det)[-1] for det in cal.detectors)
+        grid = kev_grid(kev_max, self.kev_width)
+        n_grid = len(grid) - 1
+
+        self.h5file.createArray(self.h5_gCalibrated, 'kev_edges', grid,
+                                "Common keV Grid Edges")
+
+        # Float64 input, output and temporaries for one row of each
+        budget = parse_memory(self.max_memory)
+        row_bytes = 8 * 3 * (self.energy_max + 1 + n_grid)
+        band = max(int(budget * CALIBRATED_SHARE) // row_bytes, 1)
+
+        for spec_group in self.h5file.root.spectra:
+            spec_nodes = [x for x in spec_group if (x.name[-4:] == 'spec')]
+
+            # Raw and gain-corrected spectra are summed separately
+            for suffix in ('', 'gc_'):
+                nodes = [x for x in spec_nodes if
+                         x.name.endswith(GC_SUFFIX) == bool(suffix)]
+                if nodes:
+                    self._store_calibrated_group(
+                        nodes, spec_group._v_name + '_' + suffix + 'sum_kev',
+                        grid, band)
+
+        self.report_peak_memory('calibrated')
+
+    def store_background_h5(self):
+        """
+        SNIP continuum of every row of every time-chunked spectrum, with the
+        clipping window following the detector FWHM, stored under
+        /background (e.g. norm1_bkg) for the detection limits, peak fits and
+        Pyraviz to share. Rows are processed a band at a time.
+        """
+
+        print('Started estimating spectrum backgrounds...')
+
+        cal = self.calibration
+
+        # Float64 input, transformed values and temporaries for one row
+        budget = parse_memory(self.max_memory)
+        row_bytes = 8 * 4 * (self.energy_max + 1)
+        band = max(int(budget * BACKGROUND_SHARE) // row_bytes, 1)
+
+        for spec_group in self.h5file.root.spectra:
+            for node in [x for x in spec_group if (x.name[-4:] == 'spec')]:
+                det = node.title.split()[-1]
+                if det not in cal.detectors:
+                    continue
+
+                fwhm = cal.channel_fwhm(det)[:node.shape[1]]
+                out = self.h5file.createCArray(
+                    self.h5_gBackground, background_name(node.name),
+                    tb.Float32Atom(), node.shape,
+                    node.title.replace('Spec Array', 'SNIP Background'))
+
+                for lo in range(0, node.shape[0], band):
+                    hi = min(lo + band, node.shape[0])
+                    out[lo:hi] = snip_background(node[lo:hi], fwhm,
+                                                 self.snip_width)
+
+        self.report_peak_memory('background')
+
+    def store_detection_limits_h5(self):
+        """
+        Currie critical level, detection limit and MDA of every signature
+        library line, for every time-chunked spectrum and every cumulative
+        row, written to the single /detection_limits table. ROI sums come
+        from channel prefix sums over a band of rows at a time; the ROI
+        background is taken from the stored SNIP continuum when there is one.
+        With fit_peak_areas, net areas come from batched peak fits of every
+        line in the band, falling back to the window estimate where a fit
+        does not converge.
+        """
+
+        print('Started computing detection limits...')
+
+        cal = self.calibration
+        sig_lib = read_sig_library(self.sig_library)
+        branching = np.array([self.branching.get(zaid, np.nan) for zaid in
+                              sig_lib['zaid'].astype(str)])
+
+        stats = self.h5file.root.stats
+        live_chunks = None
+        if 'live_chunks' in stats:
+            live_chunks = stats.live_chunks.read()
+
+        # Float64 input, background, prefix sums and temporaries for one row
+        budget = parse_memory(self.max_memory)
+        row_bytes = 8 * 4 * (self.energy_max + 2)
+        band = max(int(budget * LIMITS_SHARE) // row_bytes, 1)
+
+        names = [x.name for group in self.h5file.root.spectra for x in group]
+        limits_dtype = sized_names(LIMITS_DTYPE, names)
+
+        table = self.h5file.createTable(self.h5file.root, 'detection_limits',
+                                        limits_dtype,
+                                        "Currie Detection Limits")
+        t_steps = self.stored_t_steps(self.h5file)
+
+        for spec_group in self.h5file.root.spectra:
+            for node in [x for x in spec_group if (x.name[-4:] == 'spec')]:
+                det = node.title.split()[-1]
+                if det not in cal.detectors:
+                    continue
+
+                left, right = sig_markers(sig_lib['energy'], cal, det)
+                valid = left >= 0
+                lines, left, right = sig_lib[valid], left[valid], right[valid]
+                yields = branching[valid]
+                eff = efficiency(self.efficiency_fit.get(det, ''),
+                                 lines['energy'])
+                centres = cal.to_channel(det, lines['energy'])
+                fwhm = cal.channel_fwhm(det)[:node.shape[1]]
+
+                bkg = None
+                if background_name(node.name) in self.h5_gBackground:
+                    bkg = getattr(self.h5_gBackground,
+                                  background_name(node.name))
+
+                # Row 0 of the cumulative arrays is always empty
+                for lo in range(1, node.shape[0], band):
+                    hi = min(lo + band, node.shape[0])
+                    spectra = node[lo:hi]
+                    bkg_rows = None if bkg is None else bkg[lo:hi]
+                    limits = currie_limits(spectra, left, right,
+                                           background=bkg_rows)
+                    if self.fit_peak_areas and len(lines):
+                        limits = fitted_net(limits, fit_peaks(
+                            spectra, centres, fwhm, self.fit_step,
+                            background=bkg_rows))
+
+                    live = np.empty(hi - lo) * np.nan
+                    if live_chunks is not None:
+                        live = live_chunks[lo:hi, int(det)]
+
+                    rows = np.zeros(limits['gross'].shape,
+                                    dtype=limits_dtype)
+                    rows['spectrum'] = node.name
+                    rows['det'] = int(det)
+                    for field in ('zaid', 'name', 'energy'):
+                        rows[field] = lines[field]
+                    rows['row'] = np.arange(lo, hi)[:, None]
+                    rows['t_stop'] = rows['row'] * t_steps
+                    rows['LM'], rows['RM'] = left, right
+                    for field, values in limits.items():
+                        rows[field] = values
+                    rows['live'] = live[:, None]
+                    rows['MDA'] = mda(limits['L_D'], live, eff, yields)
+
+                    table.append(rows.ravel())
+
+        table.flush()
+
+        self.report_peak_memory('limits')
+
+    def store_decay_h5(self):
+        """
+        Net ROI count-rate series of every signature library line, for every
+        time-chunked spectrum, over intervals of decay_chunks time chunks,
+        and a decay curve fitted to each series. ROI sums are taken from the
+        cumulative rows bounding the intervals (a band of rows at a time) and
+        differenced, with the background from the stored SNIP continuum when
+        there is one. Series go to /decay/series and the fits (half-life,
+        rate and activity at run start) to the single /decay/fits table.
+        """
+
+        print('Started fitting decay curves...')
+
+        cal = self.calibration
+        sig_lib = read_sig_library(self.sig_library)
+        branching = np.array([self.branching.get(zaid, np.nan) for zaid in
+                              sig_lib['zaid'].astype(str)])
+
+        edges = list(range(0, self.t_array_dim, self.decay_chunks))
+        edges.append(self.t_array_dim)
+        edges = np.array(edges)
+        t_edges = edges * self.stored_t_steps(self.h5file)
+
+        stats = self.h5file.root.stats
+        live_chunks = None
+        if 'live_chunks' in stats:
+            live_chunks = stats.live_chunks.read()
+
+        # Float64 input, background, prefix sums and temporaries for one row
+        budget = parse_memory(self.max_memory)
+        row_bytes = 8 * 4 * (self.energy_max + 2)
+        band = max(int(budget * LIMITS_SHARE) // row_bytes, 1)
+
+        names = [x.name for group in self.h5file.root.spectra for x in group]
+        series_dtype = sized_names(SERIES_DTYPE, names)
+        decay_dtype = sized_names(DECAY_DTYPE, names)
+
+        series = self.h5file.createTable(self.h5_gDecay, 'series',
+                                         series_dtype,
+                                         "Net ROI Count-Rate Series")
+        fits = self.h5file.createTable(self.h5_gDecay, 'fits', decay_dtype,
+                                       "Decay-Curve Fits")
+
+        for spec_group in self.h5file.root.spectra:
+            for node in [x for x in spec_group if (x.name[-4:] == 'spec')]:
+                det = node.title.split()[-1]
+                if det not in cal.detectors:
+                    continue
+
+                left, right = sig_markers(sig_lib['energy'], cal, det)
+                valid = left >= 0
+                lines, left, right = sig_lib[valid], left[valid], right[valid]
+                eff = efficiency(self.efficiency_fit.get(det, ''),
+                                 lines['energy'])
+
+                bkg = None
+                if background_name(node.name) in self.h5_gBackground:
+                    bkg = getattr(self.h5_gBackground,
+                                  background_name(node.name))
+
+                gross = np.empty((len(edges), len(lines)))
+                background = np.empty_like(gross)
+                for lo in range(0, len(edges), band):
+                    rows = edges[lo:lo + band]
+                    limits = currie_limits(
+                        read_rows(node, rows), left, right,
+                        background=None if bkg is None else
+                        read_rows(bkg, rows))
+                    gross[lo:lo + band] = limits['gross']
+                    background[lo:lo + band] = limits['background']
+
+                live = t_edges
+                if live_chunks is not None:
+                    live = live_chunks[edges, int(det)]
+
+                rates = interval_rates(gross, background, live)
+                times = 0.5 * (t_edges[:-1] + t_edges[1:])
+                decay = fit_decay(times, rates['rate'].T,
+                                  rates['rate_err'].T)
+
+                rows = np.zeros(rates['rate'].shape, dtype=series_dtype)
+                rows['spectrum'] = node.name
+                rows['det'] = int(det)
+                for field in ('zaid', 'name', 'energy'):
+                    rows[field] = lines[field]
+                rows['t_start'] = t_edges[:-1, None]
+                rows['t_stop'] = t_edges[1:, None]
+                rows['live'] = np.diff(live)[:, None]
+                for field, values in rates.items():
+                    rows[field] = values
+                series.append(rows.ravel())
+
+                results = np.zeros(len(lines), dtype=decay_dtype)
+                results['spectrum'] = node.name
+                results['det'] = int(det)
+                for field in ('zaid', 'name', 'energy'):
+                    results[field] = lines[field]
+                results['net'] = rates['net'].sum(axis=0)
+                for field in ('rate0', 'rate0_err', 'chi2', 'n_points',
+                              'converged'):
+                    results[field] = decay[field]
+                results['half_life'], results['half_life_err'] = \
+                    half_lives(decay['lambda'], decay['lambda_err'])
+
+                # Activity at run start (Bq) from the full-energy efficiency
+                yields = eff * branching[valid]
+                results['activity0'] = decay['rate0'] / yields
+                results['activity0_err'] = decay['rate0_err'] / yields
+                fits.append(results)
+
+        series.flush()
+        fits.flush()
+
+        self.report_peak_memory('decay')
+
+    def store_pyramid_h5(self):
+        """
+        Level-of-detail copies of every time-chunked spectrum for Pyraviz,
+        under /pyramid (e.g. norm1_L1, norm1_L2, ...). Level k sums 2**k
+        channels per bin and keeps every 2**k-th cumulative row (plus the
+        last), down to PYRAMID_MIN_BINS bins. Rows are read a band at a time.
+        """
+
+        print('Started building spectrum pyramids...')
+
+        # Int64 input, padded copy and output for one row
+        budget = parse_memory(self.max_memory)
+        row_bytes = 8 * 3 * (self.energy_max + 1)
+        band = max(int(budget * PYRAMID_SHARE) // row_bytes, 1)
+
+        for spec_group in self.h5file.root.spectra:
+            for node in [x for x in spec_group if (x.name[-4:] == 'spec')]:
+                n_rows, n_bins = node.shape
+
+                for level in range(1, n_levels(n_bins) + 1):
+                    factor = 2 ** level
+                    rows = level_rows(n_rows, factor)
+
+                    out = self.h5file.createCArray(
+                        self.h5_gPyramid, level_name(node.name, level),
+                        tb.Int64Atom(), (len(rows), -(-n_bins // factor)),
+                        node.title.replace(
+                            'Spec Array', 'Spec Array x{0}'.format(factor)),
+                        chunkshape=(1, -(-n_bins // factor)))
+                    out.attrs.factor = factor
+
+                    for lo in range(0, len(rows), band):
+                        out[lo:lo + band] = downsample(
+                            read_rows(node, rows[lo:lo + band], band),
+                            factor)
+
+        self.report_peak_memory('pyramid')
+
+    def _store_calibrated_group(self, nodes, sum_name, grid, band):
+
+        cal = self.calibration
+        n_grid = len(grid) - 1
+        n_rows = nodes[0].shape[0]
+        label = nodes[0].title.split()[0]
+
+        out = []
+        for node in nodes:
+            out.append(self.h5file.createCArray(
+                self.h5_gCalibrated, node.name[:-4] + 'kev',
+                tb.Float32Atom(), (n_rows, n_grid),
+                node.title.replace('Spec Array', 'keV-Grid Spec Array')))
+
+        sum_out = self.h5file.createCArray(
+            self.h5_gCalibrated, sum_name, tb.Float32Atom(), (n_rows, n_grid),
+            "{0} Time-Chunked keV-Grid Spec Array - Det Sum".format(label))
+
+        for lo in range(0, n_rows, band):
+            hi = min(lo + band, n_rows)
+
+            total = np.zeros((hi - lo, n_grid))
+            for node, node_out in zip(nodes, out):
+                det = node.title.split()[-1]
+                kev = cal.to_kev_grid(det, node[lo:hi], grid)
+                node_out[lo:hi] = kev
+                total += kev
+
+            sum_out[lo:hi] = total
 
 class SpectrumExporter(PyramdsBase):
 
     def write_spec(self):
+        """
+        Export the final cumulative row of every time-chunked spectrum in
+        each of export_formats. The HDF5 file is read once and the files are
+        then written in parallel.
+        """
+
+        f = tb.openFile(self.data_file, 'r')
+        try:
+            specs = list(self.final_specs(f))
+        finally:
+            f.close()
+
+        return export_spectra(specs, self.export_workers, self.export_formats)
+
+    def write_bulk(self, results_file=None):
+        """
+        Export the final spectra and every requested time slice into a
+        single compressed results file (.npz, or HDF5 for any other
+        extension) instead of one file per spectrum.
+        """
+
+        if results_file is None:
+            results_file = '{0}_PYRAMDS.{1}'.format(self.series_basename,
+                                                    self.bulk_export)
+
         f = tb.openFile(self.data_file, 'r')
-        spectra = f.root.spectra
+        try:
+            specs = chain(self.final_specs(f),
+                          chain.from_iterable(self.slice_specs(f)))
+            return write_results(results_file, specs)
+        finally:
+            f.close()
 
+    def final_specs(self, f):
+        """Records of the final cumulative row of every spectrum in 'f'."""
+
+        times = self.read_times(f)
+
+        for spec_type in f.root.spectra:
+            for group in [x for x in spec_type if (x.name[-4:] == 'spec')]:
+                det_no = group.title.split()[-1]
+                yield self.spec_record(group, group[-1], times['start'],
+                                       times['live'][int(det_no)],
+                                       times['total'])
+
+    def read_times(self, f):
         stl = f.root.stats.start.read()
         startt = datetime(*stl)
         times = {
             'live': f.root.stats.live.read(),
             'start': startt,
-            'total': f.root.stats.total.read()
+            'total': f.root.stats.total.read(),
+            't_steps': self.stored_t_steps(f)
         }
 
-        for spec_type in spectra:
-            for group in [x for x in spec_type if (x.name[-4:] == 'spec')]:
-                title_list = group.title.split()
-                spec_type = title_list[0]
-                det_no = title_list[-1]
+        # Times of the final cumulative row, where chunk times were stored
+        if 'live_chunks' in f.root.stats:
+            times['live'] = f.root.stats.live_chunks[-1]
+            times['total'] = f.root.stats.real_chunks[-1]
+
+        return times
+
+    def spec_record(self, group, counts, start, live, real, suffix=''):
+        """
+        Counts and header fields of one exported spectrum of 'group', in
+        the form taken by the spectrum_io writers.
+        """
+
+        title_list = group.title.split()
+        spec_type = title_list[0]
+        det_no = title_list[-1]
+
+        grp_lbl = spec_type + '-Det' + det_no + suffix
+        file_id = (self.series_basename, grp_lbl)
+
+        file_title = '{}-{}_PYRAMDS'
+        file_title = file_title.format(*file_id)
+
+        return {
+            'path': os.path.join(self.data_cwd, file_title),
+            'spec_id': 'PYRAMDS {} {}'.format(*file_id),
+            'det_no': det_no,
+            'start': start,
+            'live': live,
+            'real': real,
+            'counts': counts[:self.energy_max],
+            'enerfit': self.enerfit[det_no],
+            'fwhmfit': self.fwhmfit[det_no],
+            'mca_cal': self.mca_cal[det_no],
+            'shape_cal': self.shape_cal[det_no],
+            'rois': self.spec_rois(det_no),
+        }
 
-                grp_lbl = spec_type + '-Det' + det_no
-                file_id = (self.series_basename, grp_lbl)
+    def spec_rois(self, det_no):
+        """Library line ROIs written into the spectra of detector 'det_no'."""
 
-                file_title = '{}-{}_PYRAMDS.Spe'
-                file_title = file_title.format(*file_id)
-                file_string = os.path.join(self.data_cwd, file_title)
+        if not self.export_rois:
+            return []
 
-                spec_markers = group[-1]
+        return library_rois(self.calibration, det_no, self.energy_max,
+                            self.sig_library)
 
-                with open(file_string, 'w') as specout:
-                    field_width = 8
+    def slice_windows(self, duration):
+        """(start, stop) seconds of every requested time slice."""
 
-                    # see: "ORTEC-Sofware-File-Structure-Manual.pdf" for info
-                    spec_id = 'PYRAMDS {} {}'.format(*file_id)
+        windows = [(0.0, stop) for stop in self.time_stops]
+        windows.extend(self.time_windows)
 
-                    spec_rem = textwrap.dedent("""\
-                            DET# {}
-                            DETDESC# PYRAMDS
-                            AP# Maestro Version 6.04
-                            """)
-                    spec_rem = spec_rem.format(det_no)
+        if self.time_stride > 0:
+            starts = np.arange(0.0, duration, self.time_stride)
+            windows.extend(zip(starts, starts + self.time_stride))
 
-                    spe_date = times['start'].strftime("%m/%d/%Y %H:%M:%S")
+        # Drop repeats, keeping the first occurrence of each window
+        seen = set()
+        return [w for w in windows if not (w in seen or seen.add(w))]
 
-                    spe_meas = str(int(float(times['live'][int(det_no)]))) + ' ' + str(int(float(times['total'])))
+    def slice_rows(self, windows, n_rows, t_steps):
+        """
+        (start, stop) cumulative rows of each (start, stop) seconds window:
+        starts round down and stops up to whole t_steps chunks, within the
+        run. Windows left empty, or covering the same rows as an earlier
+        window, are dropped with a message.
+        """
 
-                    specout.write('$SPEC_ID:\r\n' + spec_id + '\r\n$SPEC_REM:\r\n' + spec_rem +
-                                  '\r\n$DATE_MEA:\r\n' + spe_date + '\r\n$MEAS_TIM:\r\n' + spe_meas +
-                                  '\r\n$DATA:\r\n0 ' + '8191' + '\r\n')
+        bounds = []
+        for t0, t1 in windows:
+            r_lo = int(np.floor(t0 / t_steps + 1e-9))
+            r_hi = int(np.ceil(t1 / t_steps - 1e-9))
+            r_lo, r_hi = min(max(r_lo, 0), n_rows - 1), min(r_hi, n_rows - 1)
 
-                    # Begin writing out the values for each channel in this user-defined
-                    # set of markers.
-                    for en in range(8192):
-                        str_number = str(spec_markers[en])
-                        specout.write('%s\r\n' % (str_number.rjust(field_width)))
+            if r_hi <= r_lo:
+                print('Skipping time slice {0:g}-{1:g} sec: outside the '
+                      'run'.format(t0, t1))
+            elif (r_lo, r_hi) in bounds:
+                print('Skipping time slice {0:g}-{1:g} sec: same chunks as '
+                      'an earlier slice'.format(t0, t1))
+            else:
+                bounds.append((r_lo, r_hi))
 
-                    roi_mark_list = []
+        return bounds
 
-                    specout.write('$ROI:\r\n' + str(len(roi_mark_list)) +
-                                  '\r\n$PRESETS:\r\nNone\r\n0\r\n0\r\n$ENER_FIT:\r\n' + self.enerfit[det_no] +
-                                  '\r\n$MCA_CAL:\r\n' + self.mca_cal[det_no] +
-                                  '\r\n$SHAPE_CAL:\r\n' + self.shape_cal[det_no] + '\r\n')
+    def write_time_slices(self):
+        """
+        Export every requested time slice of every spectrum in each of
+        export_formats, all of the files over a single pool of processes.
+        """
 
-        f.close()
+        f = tb.openFile(self.data_file, 'r')
+        try:
+            specs = list(chain.from_iterable(self.slice_specs(f)))
+        finally:
+            f.close()
+
+        return export_spectra(specs, self.export_workers, self.export_formats)
+
+    def slice_specs(self, f):
+        """
+        Records of the requested time slices, one list per spectrum. Each
+        slice is the difference of two cumulative rows of the time-chunked
+        arrays, so windows are widened to whole t_steps chunks (see
+        slice_rows) and named after the seconds they cover; live and real
+        times are differences of the stored chunk times in the same way.
+        Every array is read once, a band of rows at a time.
+        """
+
+        times = self.read_times(f)
+        stats = f.root.stats
+
+        nodes = [x for spec_type in f.root.spectra for x in spec_type
+                 if (x.name[-4:] == 'spec')]
+        if not nodes:
+            return
+        n_rows = nodes[0].shape[0]
+
+        if 'live_chunks' in stats:
+            live = stats.live_chunks.read()
+            real = stats.real_chunks.read()
+        else:
+            # Older files: spread the run times evenly over the chunks
+            real = np.linspace(0.0, float(times['total']), n_rows)
+            live = np.outer(real / max(real[-1], 1e-12),
+                            np.asarray(times['live'], dtype=float))
+
+        t_steps = times['t_steps']
+        bounds = self.slice_rows(
+            self.slice_windows((n_rows - 1) * t_steps), n_rows, t_steps)
+        if not bounds:
+            return
+
+        rows, index = np.unique(bounds, return_inverse=True)
+        index = index.reshape(-1, 2)
+
+        for node in nodes:
+            det = int(node.title.split()[-1])
+            cum = read_rows(node, rows)
+
+            specs = []
+            for lo, hi in index:
+                r_lo, r_hi = rows[lo], rows[hi]
+                if r_lo > 0:
+                    suffix = '_{0:g}-{1:g}sec'.format(r_lo * t_steps,
+                                                     r_hi * t_steps)
+                else:
+                    suffix = '_{0:g}sec'.format(r_hi * t_steps)
+
+                specs.append(self.spec_record(
+                    node, cum[hi] - cum[lo],
+                    times['start'] + timedelta(seconds=float(
+                        r_lo * t_steps)),
+                    live[r_hi, det] - live[r_lo, det],
+                    real[r_hi] - real[r_lo], suffix))
+
+            yield specs
 
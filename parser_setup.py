@@ -4,17 +4,21 @@
 
 # Standard Library Imports
 import os
-from datetime import datetime
 from fnmatch import fnmatch
 from os.path import dirname, join
 
 # External Imports
-import numpy as np
 from tables import openFile
-from traits.api import Dict, File, HasTraits, Float, Int, Property, Any
+from traits.api import (Any, Bool, Dict, File, HasTraits, Float, Int, List,
+                        Property, Str, Tuple)
 
 # Internal Imports
+from aggregation import peak_rss
+from calibration import get_calibration
 from detector_config import enerfit, fwhmfit, mca_cal, shape_cal
+from series_catalog import CHANHEADLEN, SeriesCatalog
+from signatures import SIG_LIBRARY
+from spectrum_config import spectra
 
 class PyramdsBase(HasTraits):
 
@@ -28,6 +32,9 @@ class PyramdsBase(HasTraits):
     active_file_path = Property
     stats = Dict()
 
+    # Sidecar catalog of the .bin/.ifm series, kept up to date on each use
+    series_catalog = Any()
+
     h5file = Any()
 
     # Only initialize buffer counter before the entire run
@@ -46,14 +53,102 @@ class PyramdsBase(HasTraits):
     # Timing chunks for storing spectrum states
     t_steps = 60.0
 
+    # Optional analysis stages run after the spectra (see jobs.PARSE_STAGES),
+    # switched on from the GUI or a batch/watch manifest
+    build_coincidence = Bool(False)
+    build_calibrated = Bool(False)
+    build_background = Bool(False)
+    build_limits = Bool(False)
+    build_decay = Bool(False)
+    build_pyramid = Bool(False)
+
+    # Build the sparse triple-coincidence (gamma-gamma-gamma) cube
+    ggg_cube = Bool(False)
+
+    # Signature library supplying the energy gates
+    sig_library = File(SIG_LIBRARY)
+
+    # Memory budget for each aggregation stage (e.g. '2GB', '512MB')
+    max_memory = Str('2GB')
+
     # Dictionaries from detector_config.py, stored as default parameters
     enerfit = Dict(enerfit)
     fwhmfit = Dict(fwhmfit)
     mca_cal = Dict(mca_cal)
     shape_cal = Dict(shape_cal)
 
+    # Parsed calibration with cached channel -> keV lookup tables
+    calibration = Property(depends_on='enerfit, fwhmfit, mca_cal, shape_cal, '
+                                      'energy_max')
+
+    # Bin width of the common keV grid for calibrated spectra
+    kev_width = Float(0.5)
+
+    # Spectrum definitions from spectrum_config.py
+    spectrum_defs = List(spectra)
+
+    # Gain-drift correction: reference lines (signature library ZAIDs) are
+    # tracked in intervals of gain_chunks time chunks of the normal spectra
+    gain_stabilize = Bool(False)
+    gain_lines = List(['33060-1', '33060-2'])
+    gain_chunks = Int(10)
+    gain_min_counts = Float(100.0)
+
+    # Detection limits: ln(efficiency) polynomial in ln(E / keV) for each
+    # detector, and branching ratios by signature library ZAID
+    efficiency_fit = Dict()
+    branching = Dict()
+
+    # Net ROI areas from Gaussian peak fits (with an optional erfc step
+    # under each peak) rather than the marker-window averages
+    fit_peak_areas = Bool(True)
+    fit_step = Bool(False)
+
+    # SNIP continuum clipping window half-width (FWHMs)
+    snip_width = Float(1.5)
+
+    # Time chunks summed into each point of the peak-area decay series
+    decay_chunks = Int(10)
+
+    # Worker processes for exporting spectrum files (0: one per CPU)
+    export_workers = Int(0)
+
+    # Per-spectrum file formats written on export ('spe', 'chn'), and the
+    # format of an optional single results file ('npz', 'h5'; '' for none)
+    export_formats = List(['spe'])
+    bulk_export = Str('')
+
+    # Write the signature library lines of each detector as .Spe ROIs
+    export_rois = Bool(True)
+
+    # Time slices to export (seconds from run start): cumulative spectra up
+    # to each of time_stops (as in the legacy read_pixie_bin), explicit
+    # (start, stop) time_windows, and consecutive windows of time_stride
+    time_stops = List(Float)
+    time_windows = List(Tuple(Float, Float))
+    time_stride = Float(0.0)
+
+    def get_catalog(self):
+        """
+        Series catalog of the current data file, loaded from its sidecar on
+        first use and refreshed (files re-read only if changed) after that.
+        """
+
+        catalog = self.series_catalog
+        if (catalog is None or
+                catalog.series_basename != self.series_basename):
+            self.series_catalog = SeriesCatalog.load(self.series_basename)
+        elif catalog.refresh():
+            catalog.save()
+
+        return self.series_catalog
+
     def get_file_series(self, ext):
 
+        # .bin and .ifm series come from the catalog, in series order
+        if ext in ('bin', 'ifm'):
+            return self.get_catalog().names(ext)
+
         file_series = []
 
         # Populate file_series list
@@ -66,41 +161,18 @@ class PyramdsBase(HasTraits):
 
     def get_bin_info(self):
 
-        ifm_file_series = self.get_file_series('ifm')
-        ifm_file_series.sort()
-
-        total_time = 0.0
-        live_time = np.zeros(4)
-
-        for ifm_file in ifm_file_series:
-            with open(join(self.data_cwd, ifm_file), 'rU') as f:
-
-                info_str_list = f.readlines()
-
-                # On first pass/file, store the series run start time
-                if ifm_file is ifm_file_series[0]:
-                    date_str = info_str_list[1][23:-2]
-                    date_format = '%I:%M:%S %p %a, %b %d, %Y'
-                    run_start_time = datetime.strptime(date_str, date_format)
-
-                # Total time = real time; increment value for each file read
-                total_time_str = info_str_list[6].split()[3]
-                total_time += float(total_time_str)
+        # Start, real and live times summed over the .ifm files
+        info = self.get_catalog().run_info()
 
-                # Live time for each detector channel
-                live_time_str = [info_str_list[9 + channel].split()[2]
-                                 for channel in range(4)]
-                live_time += np.array(map(float, live_time_str))
+        self.bufheadlen = info['bufheadlen']
+        self.eventheadlen = info['eventheadlen']
 
-                self.bufheadlen = int(info_str_list[33].split()[1])
-                self.eventheadlen = int(info_str_list[34].split()[1])
+        # Bug in PIXIE IGOR Software, explicity set chanheadlen
+        self.chanheadlen = CHANHEADLEN
 
-                # Bug in PIXIE IGOR Software, explicity set chanheadlen
-                self.chanheadlen = 2  # int(info_str_list[35].split()[1])
-
-        self.stats = {'start': run_start_time,
-                      'total': str(total_time),
-                      'live': map(str, live_time)}
+        self.stats = {'start': info['start'],
+                      'total': str(info['total']),
+                      'live': [str(live) for live in info['live']]}
 
         return self.stats
 
@@ -136,6 +208,40 @@ class PyramdsBase(HasTraits):
             self.h5file.root.spectra,
             "ggcoinc", "Gamma-Gamma Data")
 
+        self.h5_gCoinc = self.h5file.createGroup(
+            self.h5file.root, "coincidence", "Coincidence Matrices")
+
+        self.h5_gGated = self.h5file.createGroup(
+            self.h5file.root, "gated", "Energy-Gated Spectra")
+
+        self.h5_gCalibrated = self.h5file.createGroup(
+            self.h5file.root, "calibrated", "Calibrated keV-Grid Spectra")
+
+        self.h5_gGain = self.h5file.createGroup(
+            self.h5file.root, "gain", "Gain-Drift Correction")
+
+        self.h5_gBackground = self.h5file.createGroup(
+            self.h5file.root, "background", "SNIP Continuum Estimates")
+
+        self.h5_gDecay = self.h5file.createGroup(
+            self.h5file.root, "decay", "Peak-Area Series and Decay Fits")
+
+        self.h5_gPyramid = self.h5file.createGroup(
+            self.h5file.root, "pyramid", "Multi-Resolution Spectra")
+
+    def get_spectra_group(self, name):
+        """
+        Group under /spectra for a spectrum definition, created on first use
+        for groups beyond the standard normal/compton/ggcoinc set.
+        """
+
+        spectra = self.h5file.root.spectra
+        if name in spectra:
+            return getattr(spectra, name)
+
+        return self.h5file.createGroup(spectra, name, name.capitalize() +
+                                       " Data")
+
     def record_time_stats(self):
 
         self.h5file.createArray(
@@ -151,10 +257,49 @@ class PyramdsBase(HasTraits):
         self.h5file.createArray(
             self.h5file.root.stats, 'total', self.stats['total'])
 
+        # Chunk length of the time-chunked arrays, for later readers
+        self.h5file.root.stats._v_attrs.t_steps = self.t_steps
+
+    def stored_t_steps(self, h5file):
+        """
+        Chunk length (seconds) the arrays of 'h5file' were parsed with;
+        files written before it was stored fall back to t_steps.
+        """
+
+        attrs = h5file.root.stats._v_attrs
+        if 't_steps' in attrs._v_attrnames:
+            return float(attrs.t_steps)
+
+        return self.t_steps
+
+    def report_peak_memory(self, stage):
+        """
+        Print the peak resident memory of the process after an aggregation
+        stage and record it (bytes) as an attribute of /stats.
+        """
+
+        rss = peak_rss()
+        if rss is None:
+            return None
+
+        print('Peak memory after {0}: {1:.1f} MB'.format(stage,
+                                                       rss / 2.0 ** 20))
+        setattr(self.h5file.root.stats._v_attrs, 'peak_rss_' + stage, rss)
+
+        return rss
+
+    def _get_calibration(self):
+        return get_calibration(self.enerfit, self.fwhmfit, self.mca_cal,
+                               self.shape_cal, self.energy_max + 1)
+
     def _get_data_cwd(self):
         return dirname(self.series_basename)
 
     def _get_series_basename(self):
+        # HDF5 files are named after their series (see create_h5)
+        if self.data_file.endswith('.h5'):
+            return self.data_file[:-3]
+
         return self.data_file[:-8]
 
     def _get_active_file_path(self):
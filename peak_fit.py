@@ -0,0 +1,408 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import hashlib
+import math
+from functools import partial
+
+# External Imports
+import numpy as np
+
+try:
+    from scipy.special import erfc
+except ImportError:
+    erfc = np.vectorize(math.erfc, otypes=[float])
+
+# Internal Imports
+from signatures import ROI_WIDTH
+from spectrum_io import pool_map
+
+FWHM_SIGMA = 2.0 * math.sqrt(2.0 * math.log(2.0))
+SQRT_2PI = math.sqrt(2.0 * math.pi)
+
+# Background channels added either side of a peak's ROI in its fit region
+EDGE_CHANNELS = 3
+
+# Fits solved together per batch, and the job size worth a process pool
+FIT_BATCH = 4096
+POOL_FITS = 4 * FIT_BATCH
+
+# Fits held in a PeakFitter cache before it is cleared
+CACHE_SIZE = 32
+
+# Fitted centroids stay within CENTROID_SHIFT FWHMs of their start and
+# widths within a factor WIDTH_FACTOR of it; a fit left on one of these
+# bounds is not counted as converged
+CENTROID_SHIFT = 1.0
+WIDTH_FACTOR = 2.0
+
+# Smallest Levenberg-Marquardt damping, keeping the normal equations of
+# nearly degenerate fits (e.g. a peak on no counts) solvable
+LAMBDA_MIN = 1e-7
+
+FIT_DTYPE = np.dtype([('row', 'i4'), ('peak', 'i4'), ('region', 'i4'),
+                      ('centroid', 'f8'), ('centroid_err', 'f8'),
+                      ('fwhm', 'f8'), ('height', 'f8'), ('area', 'f8'),
+                      ('area_err', 'f8'), ('chi2', 'f8'),
+                      ('converged', '?')])
+
+
+def fit_regions(centres, fwhm, n_bins):
+    """
+    Group peaks into fit regions: each peak's ROI (ROI_WIDTH FWHMs either
+    side) plus EDGE_CHANNELS of background, with overlapping windows merged
+    so that neighbouring peaks are fitted together. Returns the region
+    (lo, hi) channels and the region and slot of each peak.
+    """
+
+    half = ROI_WIDTH * fwhm + EDGE_CHANNELS
+    lo = np.clip(np.floor(centres - half), 0, n_bins - 1).astype(np.intp)
+    hi = np.clip(np.ceil(centres + half), 0, n_bins - 1).astype(np.intp)
+
+    order = np.argsort(centres, kind='mergesort')
+    lo_s, hi_s = lo[order], np.maximum.accumulate(hi[order])
+
+    first = np.r_[True, lo_s[1:] > hi_s[:-1]]
+    region_s = np.cumsum(first) - 1
+    region_lo = lo_s[first]
+    region_hi = hi_s[np.r_[first[1:], True]]
+
+    slot_s = np.arange(len(order)) - np.flatnonzero(first)[region_s]
+
+    region = np.empty(len(order), dtype=np.intp)
+    slot = np.empty(len(order), dtype=np.intp)
+    region[order], slot[order] = region_s, slot_s
+
+    return region_lo, region_hi, region, slot
+
+
+class _MultipletModel(object):
+    """
+    Up to n_peaks Gaussians on a linear background, optionally with an
+    erfc step under each peak. Parameters per fit are [b0, b1] followed by
+    [height, centroid, sigma(, step)] per peak slot.
+    """
+
+    def __init__(self, n_peaks, step):
+        self.n_peaks = n_peaks
+        self.step = step
+        self.per_peak = 4 if step else 3
+        self.n_params = 2 + n_peaks * self.per_peak
+
+    def __call__(self, x, x_ref, params):
+        f = params[:, 0:1] + params[:, 1:2] * (x - x_ref)
+        jac = np.zeros(x.shape + (self.n_params,))
+        jac[..., 0] = 1.0
+        jac[..., 1] = x - x_ref
+
+        for peak in range(self.n_peaks):
+            k = 2 + peak * self.per_peak
+            height = params[:, k:k + 1]
+            mu = params[:, k + 1:k + 2]
+            sigma = params[:, k + 2:k + 3]
+
+            u = (x - mu) / sigma
+            g = np.exp(-0.5 * u * u)
+
+            f = f + height * g
+            jac[..., k] = g
+            jac[..., k + 1] = height * g * u / sigma
+            jac[..., k + 2] = height * g * u * u / sigma
+
+            if self.step:
+                step = params[:, k + 3:k + 4]
+                edge = 0.5 * erfc(u / math.sqrt(2.0))
+                f = f + step * edge
+                jac[..., k + 1] += step * g / (SQRT_2PI * sigma)
+                jac[..., k + 2] += step * g * u / (SQRT_2PI * sigma)
+                jac[..., k + 3] = edge
+
+        return f, jac
+
+
+def levenberg_marquardt(model, x, x_ref, y, weights, params, active,
+                        lower, upper, max_iter=50, tol=1e-3):
+    """
+    Batched Levenberg-Marquardt: every row of 'params' is an independent
+    fit of 'model' to y (fits x channels), solved together with batched
+    matrix products and a batched linear solve. Each iteration only works
+    on the fits still running. Parameters where 'active' is False stay
+    fixed, and all are kept within lower..upper. Returns the fitted
+    parameters, their covariance, chi-square and a convergence flag per
+    fit.
+    """
+
+    params = np.array(params, dtype=float)
+    n_fit, n_par = params.shape
+    eye = np.eye(n_par)
+    lam = np.empty(n_fit)
+    lam.fill(1e-3)
+    converged = np.zeros(n_fit, dtype=bool)
+
+    def normal_equations(fit, params):
+        f, jac = model(x[fit], x_ref[fit], params)
+        jac *= active[fit, None, :]
+        resid = y[fit] - f
+        chi2 = (weights[fit] * resid * resid).sum(axis=1)
+        jw_t = (jac * weights[fit, :, None]).transpose(0, 2, 1)
+        alpha = np.matmul(jw_t, jac)
+        beta = np.matmul(jw_t, resid[..., None])[..., 0]
+        return chi2, alpha, beta
+
+    todo = np.arange(n_fit)
+    chi2, alpha, beta = normal_equations(todo, params)
+
+    for _ in range(max_iter):
+        diag = np.einsum('bii->bi', alpha[todo])
+        damped = alpha[todo] + lam[todo, None, None] * diag[:, :, None] * eye
+        # Fixed parameters have empty rows; a unit diagonal keeps them put
+        damped += (diag == 0)[:, :, None] * eye
+
+        try:
+            delta = np.linalg.solve(damped, beta[todo][..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            delta = np.einsum('bij,bj->bi', np.linalg.pinv(damped),
+                              beta[todo])
+        trial = np.clip(params[todo] + delta, lower[todo], upper[todo])
+
+        chi2_t, alpha_t, beta_t = normal_equations(todo, trial)
+        better = chi2_t < chi2[todo]
+        small = better & (chi2[todo] - chi2_t <=
+                          tol * np.maximum(chi2[todo], 1.0))
+
+        moved = todo[better]
+        params[moved] = trial[better]
+        alpha[moved] = alpha_t[better]
+        beta[moved] = beta_t[better]
+        chi2[moved] = chi2_t[better]
+        lam[todo] = np.where(better, np.maximum(lam[todo] * 0.1, LAMBDA_MIN),
+                             lam[todo] * 10.0)
+
+        # Fits whose damping has run away are as good as they will get
+        converged[todo[small]] = True
+        converged[todo[lam[todo] > 1e10]] = True
+        todo = todo[~converged[todo]]
+        if not len(todo):
+            break
+
+    diag = np.einsum('bii->bi', alpha)
+    alpha = alpha + (diag == 0)[:, :, None] * eye
+    covariance = np.linalg.pinv(alpha)
+
+    return params, covariance, chi2, converged
+
+
+def _fit_batch(spectra, centres, fwhm, step=False, max_iter=50,
+               background=None):
+    """
+    Fit every peak of 'centres' in every row of 'spectra' (rows x channels).
+    One multiplet fit per row and region, all solved as a single batch.
+    """
+
+    spectra = np.asarray(spectra, dtype=float)
+    gross = spectra
+    if background is not None:
+        spectra = spectra - background
+    n_rows, n_bins = spectra.shape
+    width = fwhm[np.clip(np.round(centres).astype(np.intp), 0, n_bins - 1)]
+
+    region_lo, region_hi, region, slot = fit_regions(centres, width, n_bins)
+    n_regions = len(region_lo)
+    n_peaks = int(slot.max()) + 1 if len(slot) else 1
+    model = _MultipletModel(n_peaks, step)
+
+    # Region windows padded to a common length; padding has zero weight
+    offsets = np.arange(int((region_hi - region_lo).max()) + 1)
+    inside = offsets <= (region_hi - region_lo)[:, None]
+    chan = np.minimum(region_lo[:, None] + offsets, region_hi[:, None])
+
+    y = spectra[:, chan].reshape(n_rows * n_regions, len(offsets))
+    x = np.tile(chan.astype(float), (n_rows, 1))
+    variance = gross[:, chan].reshape(y.shape)
+    weights = np.tile(inside, (n_rows, 1)) / np.maximum(variance, 1.0)
+    x_ref = np.tile(0.5 * (region_lo + region_hi), n_rows)[:, None]
+
+    # Starting values: background through the region ends, heights from
+    # the counts above it at each centroid
+    edge = min(EDGE_CHANNELS, len(offsets))
+    last = np.tile(region_hi - region_lo, n_rows)
+    y_lo = y[:, :edge].mean(axis=1)
+    y_hi = _edge_means(y, last, edge)
+
+    params = np.zeros((len(y), model.n_params))
+    active = np.zeros_like(params, dtype=bool)
+    params[:, 0] = 0.5 * (y_lo + y_hi)
+    params[:, 1] = (y_hi - y_lo) / np.maximum(last, 1)
+    active[:, :2] = True
+
+    fit_index = np.arange(n_rows)[:, None] * n_regions + region
+    for k_par in range(model.per_peak):
+        col = 2 + slot * model.per_peak + k_par
+        active[fit_index, col] = True
+
+    k = 2 + slot * model.per_peak
+    centre_chan = np.clip(np.round(centres).astype(np.intp), 0, n_bins - 1)
+    background = params[fit_index, 0]
+    params[fit_index, k] = np.maximum(spectra[:, centre_chan] - background,
+                                      1.0)
+    params[fit_index, k + 1] = centres
+    params[fit_index, k + 2] = width / FWHM_SIGMA
+    params[:, 2::model.per_peak][~active[:, 2::model.per_peak]] = 0.0
+    # Unused slots get a unit width so the model stays finite
+    params[:, 4::model.per_peak][~active[:, 4::model.per_peak]] = 1.0
+
+    # Heights non-negative, centroids and widths near their start
+    lower = np.empty_like(params)
+    lower.fill(-np.inf)
+    upper = np.empty_like(params)
+    upper.fill(np.inf)
+    lower[fit_index, k] = 0.0
+    lower[fit_index, k + 1] = centres - CENTROID_SHIFT * width
+    upper[fit_index, k + 1] = centres + CENTROID_SHIFT * width
+    lower[fit_index, k + 2] = width / (FWHM_SIGMA * WIDTH_FACTOR)
+    upper[fit_index, k + 2] = width * WIDTH_FACTOR / FWHM_SIGMA
+
+    params, cov, chi2, converged = levenberg_marquardt(
+        model, x, x_ref, y, weights, params, active, lower, upper, max_iter)
+    pinned = ((params == lower) | (params == upper))[fit_index[..., None],
+                                                     k[:, None] +
+                                                     np.arange(1, 3)]
+
+    dof = np.maximum(np.tile(inside.sum(axis=1), n_rows) -
+                     active.sum(axis=1), 1)
+    scale = np.maximum(chi2 / dof, 1.0)
+
+    fits = np.zeros((n_rows, len(centres)), dtype=FIT_DTYPE)
+    fits['row'] = np.arange(n_rows)[:, None]
+    fits['peak'] = np.arange(len(centres))
+    fits['region'] = region
+
+    height = params[fit_index, k]
+    sigma = params[fit_index, k + 2]
+    var_h = cov[fit_index, k, k] * scale[fit_index]
+    var_s = cov[fit_index, k + 2, k + 2] * scale[fit_index]
+    cov_hs = cov[fit_index, k, k + 2] * scale[fit_index]
+
+    fits['centroid'] = params[fit_index, k + 1]
+    fits['centroid_err'] = np.sqrt(np.maximum(
+        cov[fit_index, k + 1, k + 1] * scale[fit_index], 0.0))
+    fits['fwhm'] = FWHM_SIGMA * sigma
+    fits['height'] = height
+    fits['area'] = SQRT_2PI * height * sigma
+    fits['area_err'] = SQRT_2PI * np.sqrt(np.maximum(
+        sigma ** 2 * var_h + height ** 2 * var_s +
+        2 * height * sigma * cov_hs, 0.0))
+    fits['chi2'] = (chi2 / dof)[fit_index]
+    fits['converged'] = converged[fit_index] & ~pinned.any(axis=-1)
+
+    return fits
+
+
+def _edge_means(y, last, edge):
+    """Mean of the last 'edge' valid channels of each padded window."""
+
+    idx = np.maximum(last[:, None] - np.arange(edge), 0)
+    return y[np.arange(len(y))[:, None], idx].mean(axis=1)
+
+
+def _fit_band(band, **kwargs):
+    """_fit_batch of a (spectra, background) pair, for the process pool."""
+
+    return _fit_batch(band[0], background=band[1], **kwargs)
+
+
+def fit_peaks(spectra, centres, fwhm, step=False, max_iter=50, workers=1,
+              background=None):
+    """
+    Fit Gaussian peaks at 'centres' (channels) on a linear background, or
+    a linear plus step background, in one spectrum or in every row of a
+    rows x channels array (e.g. all time chunks). Peaks close enough to
+    overlap are fitted together as multiplets, and centres falling in the
+    same channel (e.g. library lines of equal energy) share one fit, as
+    they would share a marker window. 'fwhm' gives the starting
+    width (channels) at each channel. If a continuum estimate of the same
+    shape is given (e.g. the stored SNIP background) it is subtracted first,
+    leaving the linear terms to take up what it misses.
+
+    Fits are solved in batches of FIT_BATCH; large jobs are spread over a
+    pool of 'workers' processes (0: one per CPU). Returns a FIT_DTYPE array
+    shaped (rows, peaks).
+    """
+
+    spectra = np.atleast_2d(spectra)
+    centres = np.asarray(centres, dtype=float)
+    fwhm = np.asarray(fwhm, dtype=float)
+    if not len(centres):
+        return np.zeros((len(spectra), 0), dtype=FIT_DTYPE)
+
+    if background is not None:
+        background = np.atleast_2d(background)
+
+    requested = centres
+    _, first, inverse = np.unique(np.round(centres), return_index=True,
+                                  return_inverse=True)
+    centres = centres[first]
+
+    rows_per_batch = max(FIT_BATCH // len(centres), 1)
+    bands = [(spectra[lo:lo + rows_per_batch],
+              None if background is None else
+              background[lo:lo + rows_per_batch])
+             for lo in range(0, len(spectra), rows_per_batch)]
+
+    fit = partial(_fit_band, centres=centres, fwhm=fwhm, step=step,
+                  max_iter=max_iter)
+    if workers == 1 or spectra.shape[0] * len(centres) < POOL_FITS:
+        results = [fit(band) for band in bands]
+    else:
+        results = pool_map(fit, bands, workers)
+
+    fits = np.concatenate(results)[:, inverse.ravel()]
+    fits['row'] = np.arange(len(fits))[:, None]
+    fits['peak'] = np.arange(len(requested))
+
+    return fits
+
+
+class PeakFitter(object):
+    """
+    fit_peaks with a fixed FWHM curve and background shape, memoizing the
+    fits of each (spectra, centres, background) set by a digest of them.
+    """
+
+    def __init__(self, fwhm, step=False, max_iter=50, workers=1):
+
+        self.fwhm = np.asarray(fwhm, dtype=float)
+        self.step = step
+        self.max_iter = max_iter
+        self.workers = workers
+        self._cache = {}
+
+    @classmethod
+    def from_coeffs(cls, fwhm_coeff, n_bins, step=False):
+        """Fitter for a FWHM polynomial (channels) over n_bins channels."""
+
+        fwhm = np.polyval(np.asarray(fwhm_coeff, dtype=float)[::-1],
+                          np.arange(n_bins, dtype=float))
+        return cls(fwhm, step)
+
+    def __call__(self, spectra, centres, background=None):
+        spectra = np.ascontiguousarray(spectra)
+        centres = np.ascontiguousarray(centres, dtype=float)
+
+        digest = hashlib.md5(spectra.view(np.uint8))
+        digest.update(centres.view(np.uint8))
+        if background is not None:
+            background = np.ascontiguousarray(background)
+            digest.update(background.view(np.uint8))
+        key = (spectra.shape, spectra.dtype.str, digest.hexdigest())
+
+        if key not in self._cache:
+            if len(self._cache) >= CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = fit_peaks(spectra, centres, self.fwhm,
+                                         self.step, self.max_iter,
+                                         self.workers, background)
+
+        return self._cache[key]
@@ -0,0 +1,144 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import hashlib
+
+# External Imports
+import numpy as np
+
+# Internal Imports
+from signatures import ROI_WIDTH
+
+# Minimum filter significance (standard deviations) for a peak
+THRESHOLD = 3.0
+
+# Searches kept in a PeakSearch cache before it is cleared
+CACHE_SIZE = 64
+
+PEAK_DTYPE = np.dtype([('row', 'i4'), ('channel', 'i4'),
+                       ('significance', 'f8'), ('net', 'f8'),
+                       ('LM', 'i4'), ('RM', 'i4')])
+
+
+def box_sums(prefix, lo, hi):
+    """Sums over channels lo..hi (inclusive, clipped) of every row."""
+
+    n_bins = prefix.shape[-1] - 1
+    lo = np.clip(lo, 0, n_bins)
+    hi = np.clip(hi + 1, lo, n_bins)
+
+    return prefix[..., hi] - prefix[..., lo], hi - lo
+
+
+def peak_filter(spectra, fwhm):
+    """
+    Zero-area top-hat filter (a boxcar-smoothed second difference) of every
+    row of 'spectra', its width following the detector FWHM (channels) at
+    each channel. Returns the filter response and its significance, in
+    standard deviations of the counting noise.
+    """
+
+    spectra = np.atleast_2d(spectra)
+    channel = np.arange(spectra.shape[-1])
+
+    # Centre window about one FWHM wide, with half as much on either side
+    half = np.maximum(np.round(0.5 * np.asarray(fwhm)), 1).astype(np.intp)
+
+    prefix = np.zeros(spectra.shape[:-1] + (spectra.shape[-1] + 1,))
+    np.cumsum(spectra, axis=-1, out=prefix[..., 1:])
+
+    centre, n_centre = box_sums(prefix, channel - half, channel + half)
+    left, n_left = box_sums(prefix, channel - 2 * half, channel - half - 1)
+    right, n_right = box_sums(prefix, channel + half + 1, channel + 2 * half)
+
+    weight = n_centre / np.maximum(n_left + n_right, 1).astype(float)
+    response = centre - weight * (left + right)
+    variance = centre + weight ** 2 * (left + right)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        significance = np.where(variance > 0,
+                                response / np.sqrt(variance), 0.0)
+
+    return response, significance
+
+
+def find_peaks(spectra, fwhm, threshold=THRESHOLD):
+    """
+    Peaks of every row of 'spectra' (one spectrum or rows x channels, e.g.
+    all time chunks) as a PEAK_DTYPE array: channels where the filter
+    significance is a local maximum above 'threshold', with ROI markers
+    ROI_WIDTH FWHMs either side.
+    """
+
+    spectra = np.atleast_2d(spectra)
+    fwhm = np.asarray(fwhm, dtype=float)
+    response, significance = peak_filter(spectra, fwhm)
+
+    inner = significance[:, 1:-1]
+    is_peak = ((inner > threshold) & (inner >= significance[:, :-2]) &
+               (inner > significance[:, 2:]))
+    row, channel = np.nonzero(is_peak)
+    channel += 1
+
+    width = np.round(ROI_WIDTH * fwhm[channel]).astype(np.intp)
+    n_bins = spectra.shape[-1]
+
+    peaks = np.zeros(len(row), dtype=PEAK_DTYPE)
+    peaks['row'] = row
+    peaks['channel'] = channel
+    peaks['significance'] = significance[row, channel]
+    peaks['net'] = response[row, channel]
+    peaks['LM'] = np.maximum(channel - width, 0)
+    peaks['RM'] = np.minimum(channel + width, n_bins - 1)
+
+    return peaks
+
+
+class PeakSearch(object):
+    """
+    find_peaks with a fixed FWHM curve and threshold, caching the result
+    for each version of the spectra searched (keyed by a digest of the
+    counts), so redrawing or re-selecting does not search again.
+    """
+
+    def __init__(self, fwhm, threshold=THRESHOLD):
+
+        self.fwhm = np.asarray(fwhm, dtype=float)
+        self.threshold = threshold
+        self._cache = {}
+
+    @classmethod
+    def from_coeffs(cls, fwhm_coeff, n_bins, threshold=THRESHOLD):
+        """Search for a FWHM polynomial (channels) over n_bins channels."""
+
+        fwhm = np.polyval(np.asarray(fwhm_coeff, dtype=float)[::-1],
+                          np.arange(n_bins, dtype=float))
+        return cls(fwhm, threshold)
+
+    def __call__(self, spectra):
+        spectra = np.ascontiguousarray(spectra)
+        key = (spectra.shape, spectra.dtype.str,
+               hashlib.md5(spectra.view(np.uint8)).hexdigest())
+
+        if key not in self._cache:
+            if len(self._cache) >= CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = find_peaks(spectra, self.fwhm,
+                                          self.threshold)
+
+        return self._cache[key]
+
+    def peak_at(self, spectrum, channel):
+        """
+        The found peak whose ROI contains 'channel' (the most significant if
+        several do), or None.
+        """
+
+        peaks = self(spectrum)
+        hits = peaks[(peaks['LM'] <= channel) & (peaks['RM'] >= channel)]
+        if not len(hits):
+            return None
+
+        return hits[np.argmax(hits['significance'])]
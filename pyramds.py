@@ -12,10 +12,11 @@ import textwrap
 
 # External Imports
 from traits.api import Button, Dict, File, HasTraits, Instance, List, Str
-from traitsui.api import (FileEditor, Group, HSplit, Item, ListStrEditor,
-                          TextEditor, VGroup, View)
+from traitsui.api import (FileEditor, Group, HGroup, HSplit, Item,
+                          ListStrEditor, TextEditor, VGroup, View)
 
 # Internal Imports
+from jobs import run_export, run_parse
 from parser_model import PyramdsParser, SpectrumExporter
 
 
@@ -86,6 +87,17 @@ class PyramdsView(HasTraits):
                           Item('stats_view', style='custom', show_label=False),
                           springy=True),
                    show_border=True),
+            HGroup(Item('object.parser.gain_stabilize', label='Gain Drift'),
+                   Item('object.parser.build_coincidence',
+                        label='Coincidence'),
+                   Item('object.parser.build_calibrated', label='keV Grid'),
+                   Item('object.parser.build_background',
+                        label='Background'),
+                   Item('object.parser.build_limits',
+                        label='Detection Limits'),
+                   Item('object.parser.build_decay', label='Decay Fits'),
+                   Item('object.parser.build_pyramid', label='Pyramid'),
+                   show_border=True, label="PARSE STAGES"),
             VGroup(Item('parse_button', show_label=False)),
             label="PIXE PARSER"),
         Group(
@@ -117,17 +129,14 @@ class PyramdsView(HasTraits):
             self.parser.h5file.close()
 
         # Open new HDF5 file, parse data, store spectra structurs, and close
-        self.parser.start_parse()
-        self.parser.store_spectra_h5()
-
-        self.hdf_filename = self.parser.h5_filename
+        self.hdf_filename = run_parse(self.parser)
 
     def _export_button_fired(self):
         # Check if old HDF5 file is still around
         if self.parser.h5file is not None:
             self.parser.h5file.close()
 
-        self.exporter.write_spec()
+        run_export(self.exporter)
 
 if __name__ == '__main__':
 
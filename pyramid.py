@@ -0,0 +1,136 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+
+# Coarsest level kept: at least this many energy bins
+PYRAMID_MIN_BINS = 256
+
+
+def n_levels(n_bins, min_bins=PYRAMID_MIN_BINS):
+    """Number of levels below full resolution for an n_bins spectrum."""
+
+    levels = 0
+    while (n_bins >> (levels + 1)) >= min_bins:
+        levels += 1
+
+    return levels
+
+
+def level_name(spec_name, level):
+    """
+    Name of level k of a spectrum array (norm1_spec -> norm1_Lk); names
+    without the '_spec' suffix are kept whole (myspec -> myspec_Lk).
+    """
+
+    if spec_name.endswith('_spec'):
+        spec_name = spec_name[:-5]
+
+    return '{0}_L{1}'.format(spec_name, level)
+
+
+def downsample(spectra, factor):
+    """
+    Sum each run of 'factor' channels of every row (the last bin takes
+    whatever channels remain), preserving the counts.
+    """
+
+    spectra = np.atleast_2d(spectra)
+    n_bins = spectra.shape[-1]
+    n_out = -(-n_bins // factor)
+
+    padded = np.zeros(spectra.shape[:-1] + (n_out * factor,),
+                      dtype=np.result_type(spectra.dtype, np.int64))
+    padded[..., :n_bins] = spectra
+
+    return padded.reshape(spectra.shape[:-1] + (n_out, factor)).sum(axis=-1)
+
+
+def level_rows(n_rows, stride):
+    """
+    Cumulative rows kept at a time stride: every stride-th row, plus the
+    last row so the whole run is always available.
+    """
+
+    rows = np.arange(0, n_rows, stride)
+    if len(rows) and rows[-1] != n_rows - 1:
+        rows = np.append(rows, n_rows - 1)
+
+    return rows
+
+
+class SpectrumPyramid(object):
+    """
+    Level-of-detail copies of a time-chunked spectrum array. Level k sums
+    2**k channels per bin and keeps every 2**k-th cumulative row, so a time
+    window is still the difference of two rows and its counts are exact at
+    the level's resolution; level 0 is the array itself.
+    """
+
+    def __init__(self, levels):
+
+        self.levels = levels
+
+    @classmethod
+    def load(cls, h5file, node):
+        """The stored pyramid of a spectrum array, or None without one."""
+
+        root = h5file.root
+        if 'pyramid' not in root:
+            return None
+
+        levels = [node]
+        while level_name(node.name, len(levels)) in root.pyramid:
+            levels.append(getattr(root.pyramid,
+                                  level_name(node.name, len(levels))))
+
+        return cls(levels)
+
+    def factor(self, level):
+        return 2 ** level
+
+    def level_for(self, n_channels, n_points):
+        """
+        Coarsest level that still gives n_points bins over n_channels
+        channels (e.g. the plot width in pixels over the zoomed range).
+        """
+
+        level = 0
+        while (level + 1 < len(self.levels) and
+               n_channels // self.factor(level + 1) >= n_points):
+            level += 1
+
+        return level
+
+    def nearest_row(self, level, row):
+        """Index in a level of the stored row nearest an original row."""
+
+        rows = level_rows(self.levels[0].shape[0], self.factor(level))
+        if len(rows) < 2:
+            return 0
+
+        pos = np.clip(np.searchsorted(rows, row), 1, len(rows) - 1)
+        if row - rows[pos - 1] <= rows[pos] - row:
+            pos -= 1
+
+        return int(pos)
+
+    def spectrum(self, level, lower_row, upper_row):
+        """
+        Counts per channel between two original cumulative rows at a level,
+        with the centre channel of each bin: the rows are snapped to the
+        level's time stride and each bin's counts spread over its channels.
+        """
+
+        node = self.levels[level]
+        factor = self.factor(level)
+        if level:
+            lower_row = self.nearest_row(level, lower_row)
+            upper_row = self.nearest_row(level, upper_row)
+
+        counts = node[upper_row] - node[lower_row]
+        chan = factor * np.arange(len(counts)) + 0.5 * (factor - 1)
+
+        return chan, counts / float(factor)
@@ -0,0 +1,246 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import io
+import json
+import os
+from datetime import datetime
+from os.path import basename, dirname, exists, getmtime, getsize, join
+
+# External Imports
+import numpy as np
+
+# Sidecar written next to the data (e.g. run_catalog.json for run0001.bin)
+CATALOG_SUFFIX = '_catalog.json'
+CATALOG_VERSION = 1
+
+# Bug in PIXIE IGOR Software: the .ifm channel header length is wrong
+CHANHEADLEN = 2
+
+IFM_DATE_FORMAT = '%I:%M:%S %p %a, %b %d, %Y'
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def read_ifm(path):
+    """
+    Run information from a PIXIE .ifm file: start time, real time, live
+    time of the four channels and the buffer/event header lengths.
+    """
+
+    with io.open(path, 'r') as f:
+        info_str_list = f.readlines()
+
+    start = datetime.strptime(info_str_list[1][23:-2], IFM_DATE_FORMAT)
+
+    return {
+        'start': start.strftime(ISO_FORMAT),
+        'real': float(info_str_list[6].split()[3]),
+        'live': [float(info_str_list[9 + channel].split()[2])
+                 for channel in range(4)],
+        'bufheadlen': int(info_str_list[33].split()[1]),
+        'eventheadlen': int(info_str_list[34].split()[1]),
+    }
+
+
+def buffer_starts(words):
+    """
+    Word offsets of the buffers of a PIXIE .bin file, from the buffer
+    length at the head of each buffer; a zero length ends the data.
+    """
+
+    starts = []
+    pos = 0
+    while pos < len(words):
+        buf_ndata = int(words[pos])
+        if not buf_ndata:
+            break
+
+        starts.append(pos)
+        pos += buf_ndata
+
+    return np.array(starts, dtype=np.intp)
+
+
+def prescan_bin(path, bufheadlen, eventheadlen, chanheadlen=CHANHEADLEN):
+    """
+    Number of buffers and events in a PIXIE .bin file, walking the buffer
+    and event headers the same way the parser does, without decoding.
+    Events are chained within a buffer (each event's length follows from
+    its hit pattern), so every buffer is walked at once: one vectorized
+    step per event of the longest buffer.
+    """
+
+    words = np.fromfile(path, dtype='<u2')
+    starts = buffer_starts(words)
+
+    # Event length from the hit pattern of detector channels 0, 1, 2
+    event_len = np.array([eventheadlen + chanheadlen * bin(pattern).count('1')
+                          for pattern in range(8)], dtype=np.intp)
+
+    ends = np.minimum(starts + words[starts], len(words))
+    pos = starts + bufheadlen
+    running = pos < ends
+    pos, ends = pos[running], ends[running]
+
+    n_events = 0
+    while len(pos):
+        n_events += len(pos)
+        pos = pos + event_len[words[pos] & 7]
+        running = pos < ends
+        pos, ends = pos[running], ends[running]
+
+    return {'buffers': len(starts), 'events': n_events}
+
+
+class SeriesCatalog(object):
+    """
+    Sidecar index of a PIXIE file series (series_basename0001.bin, ...):
+    the .bin and .ifm files in series order with their sizes, the .ifm run
+    information and the buffer and event counts of each .bin file.
+
+    Entries are checked against each file's size and mtime, so re-opening
+    a series only lists the directory and stats its files; new or changed
+    files are read again and the sidecar rewritten.
+    """
+
+    def __init__(self, series_basename, files=None):
+
+        self.series_basename = series_basename
+        self.files = files if files is not None else {'bin': [], 'ifm': []}
+
+    @property
+    def data_cwd(self):
+        return dirname(self.series_basename)
+
+    @property
+    def path(self):
+        return self.series_basename + CATALOG_SUFFIX
+
+    @classmethod
+    def load(cls, series_basename):
+        """Catalog of a series, refreshed from disk and saved if changed."""
+
+        catalog = cls(series_basename)
+        if exists(catalog.path):
+            try:
+                with open(catalog.path) as f:
+                    cached = json.load(f)
+                if cached.get('version') == CATALOG_VERSION:
+                    catalog.files = cached['files']
+            except (ValueError, KeyError):
+                pass
+
+        if catalog.refresh():
+            catalog.save()
+
+        return catalog
+
+    def names(self, ext):
+        return [entry['name'] for entry in self.files[ext]]
+
+    def list_series(self, ext):
+        """Files <basename>NNNN.<ext> of the series, in series order."""
+
+        prefix = basename(self.series_basename)
+        return sorted(name for name in os.listdir(self.data_cwd or '.')
+                      if name.startswith(prefix) and
+                      name.endswith('.' + ext) and
+                      len(name) == len(prefix) + 5 + len(ext) and
+                      name[len(prefix):len(prefix) + 4].isdigit())
+
+    def refresh(self):
+        """Bring the entries up to date; True if anything changed."""
+
+        changed = False
+
+        # .ifm first: the .bin prescan needs their header lengths
+        for ext in ('ifm', 'bin'):
+            names = self.list_series(ext)
+            changed |= names != self.names(ext)
+
+            old = dict((entry['name'], entry) for entry in self.files[ext])
+            entries = []
+            for name in names:
+                path = join(self.data_cwd, name)
+                stat = {'name': name, 'size': getsize(path),
+                        'mtime': getmtime(path)}
+                entry = old.get(name)
+                if (entry is None or entry['size'] != stat['size'] or
+                        entry['mtime'] != stat['mtime']):
+                    entry = self.scan(ext, path, stat)
+                    changed = True
+                entries.append(entry)
+
+            self.files[ext] = entries
+
+        return changed
+
+    def scan(self, ext, path, stat):
+        entry = dict(stat)
+        if ext == 'ifm':
+            entry.update(read_ifm(path))
+        elif self.files['ifm']:
+            header = self.header_lengths()
+            entry.update(prescan_bin(path, header['bufheadlen'],
+                                     header['eventheadlen']))
+        else:
+            entry.update({'buffers': None, 'events': None})
+
+        return entry
+
+    def header_lengths(self):
+        first = self.files['ifm'][0]
+        return {'bufheadlen': first['bufheadlen'],
+                'eventheadlen': first['eventheadlen']}
+
+    def total_events(self):
+        """Events in the .bin files (None if any was not prescanned)."""
+
+        counts = [entry['events'] for entry in self.files['bin']]
+        if None in counts:
+            return None
+
+        return sum(counts)
+
+    def run_info(self):
+        """
+        Series totals as the parser keeps them: run start (from the first
+        .ifm), total real time, per-channel live time and header lengths.
+        """
+
+        ifm = self.files['ifm']
+        info = self.header_lengths()
+        info.update({
+            'start': datetime.strptime(ifm[0]['start'], ISO_FORMAT),
+            'total': sum(entry['real'] for entry in ifm),
+            'live': np.sum([entry['live'] for entry in ifm], axis=0),
+            'events': self.total_events(),
+        })
+
+        return info
+
+    def save(self):
+        """
+        Write the sidecar; False if it cannot be written (e.g. a read-only
+        acquisition share), in which case the catalog is kept in memory
+        only and the files are scanned again next time.
+        """
+
+        # Written to a temporary file first so readers never see half of it
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': CATALOG_VERSION, 'files': self.files},
+                          f, indent=1)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            if exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return False
+
+        return True
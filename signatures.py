@@ -0,0 +1,218 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+from os.path import dirname, getmtime, join
+
+# External Imports
+import numpy as np
+
+# Default gamma signature library (ZAID, isotope name, line energy in keV)
+SIG_LIBRARY = join(dirname(__file__), '_legacy', 'sig_library.txt')
+
+SIG_DTYPE = np.dtype([('zaid', 'S12'), ('name', 'S12'), ('energy', 'f8')])
+
+# Rows of the /sig_lookup/det{n}_sig tables (the columns Pyraviz reads, plus
+# the ZAID)
+SIG_TABLE_DTYPE = np.dtype([('name', 'S12'), ('LM', 'i4'), ('RM', 'i4'),
+                            ('energy', 'f4'), ('zaid', 'S12')])
+
+# Half-width of a signature ROI in units of the detector FWHM
+ROI_WIDTH = 1.75
+
+# Merged library ROIs, keyed by library file, its mtime, calibration and
+# detector
+_library_rois = {}
+
+
+def read_sig_library(lib_name=SIG_LIBRARY):
+    """
+    Read the signature library into a structured array, one row per line
+    (columns: zaid, name, energy).
+    """
+
+    with open(lib_name, 'r') as ginput:
+        rows = [tuple(line.split()[:3]) for line in ginput if line.split()]
+
+    return np.array(rows, dtype=SIG_DTYPE)
+
+
+def sig_markers(energies, calibration, det):
+    """
+    Left/right ROI markers (channels) of detector 'det' for each line
+    energy, vectorized over the whole library. Same convention as the legacy
+    build_gamma: markers sit ROI_WIDTH FWHMs either side of the centroid
+    channel. Lines outside the calibrated range get markers of -1.
+    """
+
+    cent_chn = calibration.to_channel(det, energies)
+    width = calibration.fwhm(det, cent_chn)
+
+    valid = np.isfinite(cent_chn)
+    cent_chn = np.where(valid, cent_chn, 0.0)
+    width = np.where(valid, width, 0.0)
+
+    left_marker = np.round(cent_chn - ROI_WIDTH * width).astype(np.int64)
+    right_marker = np.round(cent_chn + ROI_WIDTH * width).astype(np.int64)
+    left_marker[~valid] = -1
+    right_marker[~valid] = -1
+
+    return left_marker, right_marker
+
+
+def merge_rois(left_marker, right_marker):
+    """
+    Sorted, non-overlapping (start, end) channel ROIs covering the given
+    marker windows. Overlapping or touching windows are merged, as .Spe ROIs
+    are a per-channel flag.
+    """
+
+    order = np.argsort(left_marker, kind='mergesort')
+    left = np.asarray(left_marker)[order]
+    right = np.maximum.accumulate(np.asarray(right_marker)[order])
+    if not len(left):
+        return np.zeros((0, 2), dtype=np.int64)
+
+    first = np.r_[True, left[1:] > right[:-1] + 1]
+    last = np.r_[first[1:], True]
+
+    return np.column_stack([left[first], right[last]])
+
+
+def library_rois(calibration, det, n_channels, lib_name=SIG_LIBRARY):
+    """
+    Merged ROIs of every library line for detector 'det', limited to the
+    first 'n_channels' channels. Computed once per library file version and
+    calibration set.
+    """
+
+    key = (lib_name, getmtime(lib_name), calibration, det, n_channels)
+
+    if key not in _library_rois:
+        rois = np.zeros((0, 2), dtype=np.int64)
+        if det in calibration.detectors:
+            sig_lib = read_sig_library(lib_name)
+            left, right = sig_markers(sig_lib['energy'], calibration, det)
+            valid = (left >= 0) & (left < n_channels) & (right >= left)
+            rois = merge_rois(left[valid],
+                              np.minimum(right[valid], n_channels - 1))
+
+        _library_rois[key] = [tuple(roi) for roi in rois.tolist()]
+
+    return _library_rois[key]
+
+
+class SignatureIndex(object):
+    """
+    Signature library sorted by energy, with the ROI markers of each
+    detector computed in one vectorized step and cached. Lines near an
+    energy are found by binary search, so queries stay cheap for libraries
+    of any size.
+    """
+
+    def __init__(self, lines, calibration):
+
+        order = np.argsort(lines['energy'], kind='mergesort')
+        self.lines = lines[order]
+        self.calibration = calibration
+        self._markers = {}
+
+    @classmethod
+    def from_library(cls, calibration, lib_name=SIG_LIBRARY):
+        return cls(read_sig_library(lib_name), calibration)
+
+    def markers(self, det):
+        """(LM, RM) channel markers of every line for detector 'det'."""
+
+        if det not in self._markers:
+            self._markers[det] = sig_markers(self.lines['energy'],
+                                             self.calibration, det)
+        return self._markers[det]
+
+    def window(self, energy, det, k=1.0):
+        """
+        Index range [lo, hi) of the lines within k FWHM of each energy (keV)
+        as resolved by detector 'det'.
+        """
+
+        cal = self.calibration
+        channel = cal.to_channel(det, energy)
+        half_width = k * cal.fwhm(det, channel)
+
+        e_lo = cal.to_kev(det, channel - half_width)
+        e_hi = cal.to_kev(det, channel + half_width)
+
+        energies = self.lines['energy']
+        lo = np.searchsorted(energies, e_lo, side='left')
+        hi = np.searchsorted(energies, e_hi, side='right')
+
+        # Energies outside the calibrated range match nothing
+        outside = ~np.isfinite(channel)
+        return np.where(outside, 0, lo), np.where(outside, 0, hi)
+
+    def search(self, energy, det, k=1.0):
+        """Lines within k FWHM of a single energy (keV) for detector 'det'."""
+
+        lo, hi = self.window(energy, det, k)
+        return self.lines[int(lo):int(hi)]
+
+    def table(self, det):
+        """Rows of the det{n}_sig table of detector 'det'."""
+
+        rows = np.zeros(len(self.lines), dtype=SIG_TABLE_DTYPE)
+        for field in ('name', 'energy', 'zaid'):
+            rows[field] = self.lines[field]
+        rows['LM'], rows['RM'] = self.markers(det)
+
+        return rows
+
+    def store(self, h5file, detectors=('1', '2')):
+        """
+        Cache the index in /sig_lookup in the layout Pyraviz reads: a
+        det{n}_sig marker table plus en_coeff_{n} and fwhm_coeff_{n} arrays
+        per detector.
+        """
+
+        if 'sig_lookup' in h5file.root:
+            h5file.removeNode(h5file.root.sig_lookup, recursive=True)
+        group = h5file.createGroup(h5file.root, 'sig_lookup',
+                                   "Sig Library info")
+
+        cal = self.calibration
+        for det in detectors:
+            if det not in cal.detectors:
+                continue
+
+            h5file.createArray(group, 'en_coeff_' + det, cal.en_coeff[det],
+                               "Energy coefficients for Det " + det)
+            h5file.createArray(group, 'fwhm_coeff_' + det,
+                               cal.fwhm_coeff[det],
+                               "FWHM coefficients for Det " + det)
+            h5file.createTable(group, 'det{0}_sig'.format(det),
+                               self.table(det),
+                               "Sig Markers for Det " + det)
+
+        return group
+
+    @classmethod
+    def load(cls, h5file, calibration, det='1'):
+        """
+        Index rebuilt from the det{n}_sig table cached in 'h5file', reusing
+        its markers for detector 'det' instead of recomputing them.
+        """
+
+        rows = getattr(h5file.root.sig_lookup, 'det{0}_sig'.format(det))
+        rows = rows.read()
+
+        lines = np.zeros(len(rows), dtype=SIG_DTYPE)
+        for field in ('zaid', 'name', 'energy'):
+            if field in rows.dtype.names:
+                lines[field] = rows[field]
+
+        index = cls(lines, calibration)
+        order = np.argsort(rows['energy'], kind='mergesort')
+        index._markers[det] = (rows['LM'][order].astype(np.int64),
+                               rows['RM'][order].astype(np.int64))
+
+        return index
@@ -0,0 +1,145 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import threading
+
+# External Imports
+import numpy as np
+
+# Internal Imports
+from histogram_service import LRUCache
+
+# Time chunks x channel bins in each cached tile, and tiles kept
+TILE_SIZE = 256
+TILE_CACHE = 128
+
+
+def waterfall(cumulative, channel_edges):
+    """
+    Counts per time step and energy bin from cumulative rows (rows x
+    channels, each row the spectrum up to a time): rows are differenced
+    and channels summed between channel_edges, all at once through channel
+    prefix sums. Returns a (rows - 1) x (len(channel_edges) - 1) image.
+    """
+
+    cumulative = np.asarray(cumulative, dtype=float)
+    prefix = np.zeros(cumulative.shape[:-1] + (cumulative.shape[-1] + 1,))
+    np.cumsum(cumulative, axis=-1, out=prefix[..., 1:])
+
+    edges = np.clip(channel_edges, 0, cumulative.shape[-1])
+    binned = np.diff(prefix[..., edges], axis=-1)
+
+    return np.diff(binned, axis=0)
+
+
+def power_of_two(value):
+    """Largest power of two not above value (at least 1)."""
+
+    power = 1
+    while power * 2 <= value:
+        power *= 2
+
+    return power
+
+
+class Spectrogram(object):
+    """
+    Time x energy waterfall of a time-chunked spectrum array, rendered at
+    the resolution asked for. Images are put together from tiles of
+    TILE_SIZE x TILE_SIZE steps, a step being a power-of-two number of time
+    chunks and of channels; tiles are cached so panning and zooming reuse
+    them, and each tile reads only its TILE_SIZE + 1 bounding rows. Reads
+    hold 'lock' (e.g. the HistogramService lock of the same file).
+    """
+
+    def __init__(self, node, lock=None, tile_size=TILE_SIZE,
+                 max_tiles=TILE_CACHE):
+
+        self.node = node
+        self.lock = lock if lock is not None else threading.RLock()
+        self.tile_size = tile_size
+        self.tiles = LRUCache(max_tiles)
+
+    @property
+    def n_chunks(self):
+        return self.node.shape[0] - 1
+
+    @property
+    def n_bins(self):
+        return self.node.shape[1]
+
+    def tile(self, t_step, e_step, t_tile, e_tile):
+        """Counts per chunk and channel of one tile (NaN beyond the data)."""
+
+        key = (t_step, e_step, t_tile, e_tile)
+        image = self.tiles.get(key)
+        if image is not None:
+            return image
+
+        span = self.tile_size
+        rows = t_step * (t_tile * span + np.arange(span + 1))
+        c_lo = e_step * e_tile * span
+        c_hi = min(c_lo + e_step * span, self.n_bins)
+        edges = e_step * np.arange(span + 1)
+
+        image = np.empty((span, span))
+        image.fill(np.nan)
+
+        # The last step of the run may be shorter than t_step
+        valid = np.unique(np.minimum(rows, self.n_chunks))
+        if len(valid) > 1 and c_lo < c_hi:
+            with self.lock:
+                cumulative = [self.node[k, c_lo:c_hi] for k in valid]
+
+            n_e = -(-(c_hi - c_lo) // e_step)
+            counts = waterfall(cumulative, edges[:n_e + 1])
+            widths = np.diff(np.minimum(edges[:n_e + 1], c_hi - c_lo))
+            image[:len(valid) - 1, :n_e] = counts / (
+                np.diff(valid)[:, None] * widths)
+
+        self.tiles.put(key, image)
+        return image
+
+    def steps_for(self, n_chunks, n_channels, height, width):
+        """Time and channel steps giving at least height x width pixels."""
+
+        return (power_of_two(max(n_chunks // max(height, 1), 1)),
+                power_of_two(max(n_channels // max(width, 1), 1)))
+
+    def image(self, row_lo, row_hi, chan_lo, chan_hi, height, width):
+        """
+        Counts per chunk and channel over chunks row_lo..row_hi and
+        channels chan_lo..chan_hi, at about height x width pixels or
+        finer. Returns the image and its chunk and channel edges, which are
+        snapped to the step grid.
+        """
+
+        row_lo, row_hi = max(int(row_lo), 0), min(int(row_hi), self.n_chunks)
+        chan_lo, chan_hi = max(int(chan_lo), 0), min(int(chan_hi),
+                                                     self.n_bins)
+        t_step, e_step = self.steps_for(max(row_hi - row_lo, 1),
+                                        max(chan_hi - chan_lo, 1),
+                                        height, width)
+
+        t_first, t_last = row_lo // t_step, -(-row_hi // t_step)
+        e_first, e_last = chan_lo // e_step, -(-chan_hi // e_step)
+        span = self.tile_size
+
+        t_tiles = range(t_first // span, (t_last - 1) // span + 1)
+        e_tiles = range(e_first // span, (e_last - 1) // span + 1)
+        mosaic = np.vstack([np.hstack([self.tile(t_step, e_step, ti, ej)
+                                       for ej in e_tiles])
+                            for ti in t_tiles])
+
+        t_off = t_first - t_tiles[0] * span
+        e_off = e_first - e_tiles[0] * span
+        image = mosaic[t_off:t_off + t_last - t_first,
+                       e_off:e_off + e_last - e_first]
+
+        row_edges = t_step * np.arange(t_first, t_last + 1)
+        chan_edges = e_step * np.arange(e_first, e_last + 1)
+
+        return (image, np.minimum(row_edges, self.n_chunks),
+                np.minimum(chan_edges, self.n_bins))
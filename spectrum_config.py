@@ -0,0 +1,53 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Spectrum Definition File
+#
+# Each entry declares one time-chunked spectrum built by store_spectra_h5.
+#
+#   name    - HDF5 array name (arrays ending in 'spec' are exported)
+#   group   - group under /spectra, created if it does not exist
+#   title   - array title; the exporter labels files with its first word
+#             and takes the detector number from its last word
+#   channel - Pixie input channel whose energy is histogrammed
+#   hits    - hit-pattern terms, OR-ed together. Each term is a pattern of
+#             '1' (fired), '0' (did not fire) or 'x' (either) for channels
+#             0, 1, 2, optionally followed by timing cuts: 'deltaT_12' keeps
+#             events inside short_window, 'deltaT_12<50' uses 50 ns instead
+#   energy  - optional energy cuts {channel: (low, high)}, inclusive channels
+#   log     - optional event log table (energy, timestamp) in the same group
+
+spectra = [
+    {'name': 'norm1_spec', 'group': 'normal', 'channel': 1,
+     'title': "Normal Time-Chunked Spec Array - Det 1",
+     'hits': ['x1x'],
+     'log': 'norm_evts1'},
+
+    {'name': 'norm2_spec', 'group': 'normal', 'channel': 2,
+     'title': "Normal Time-Chunked Spec Array - Det 2",
+     'hits': ['xx1'],
+     'log': 'norm_evts2'},
+
+    {'name': 'compt1_spec', 'group': 'compton', 'channel': 1,
+     'title': "Compton-Supp Time-Chunked Spec Array - Det 1",
+     'hits': ['010'],
+     'log': 'compt_evts1'},
+
+    {'name': 'compt2_spec', 'group': 'compton', 'channel': 2,
+     'title': "Compton-Supp Time-Chunked Spec Array - Det 2",
+     'hits': ['001'],
+     'log': 'compt_evts2'},
+
+    {'name': 'gg1_spec', 'group': 'ggcoinc', 'channel': 1,
+     'title': "G-G Time-Chunked Spec Array - Det 1",
+     'hits': ['011 deltaT_12', '110 deltaT_01',
+              '111 deltaT_01', '111 deltaT_12'],
+     'log': 'gg_evts1'},
+
+    {'name': 'gg2_spec', 'group': 'ggcoinc', 'channel': 2,
+     'title': "G-G Time-Chunked Spec Array - Det 2",
+     'hits': ['011 deltaT_12', '101 deltaT_02',
+              '111 deltaT_02', '111 deltaT_12'],
+     'log': 'gg_evts2'},
+    ]
@@ -0,0 +1,220 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+
+# Number of Pixie channels taking part in hit patterns
+HIT_CHANNELS = 3
+
+
+def hit_codes(block):
+    """
+    Hit pattern of each event as an integer code, bit c set when channel c
+    fired. Codes index the per-term lookup tables below.
+    """
+
+    codes = np.zeros(len(block), dtype=np.intp)
+    for chan in range(HIT_CHANNELS):
+        codes |= (block['energy_' + str(chan)] != -1).astype(np.intp) << chan
+
+    return codes
+
+
+def pattern_lut(pattern):
+    """
+    Compile a hit pattern string ('1' fired, '0' not fired, 'x' either, one
+    character per channel) into a boolean table over all hit codes.
+    """
+
+    if len(pattern) != HIT_CHANNELS or set(pattern) - set('01x'):
+        raise ValueError("Bad hit pattern: {0!r}".format(pattern))
+
+    codes = np.arange(2 ** HIT_CHANNELS)
+    lut = np.ones(len(codes), dtype=bool)
+
+    for chan, state in enumerate(pattern):
+        fired = (codes >> chan) & 1
+        if state != 'x':
+            lut &= fired == int(state)
+
+    return lut
+
+
+def parse_cut(cut_str):
+    """
+    Split a timing cut 'deltaT_12' or 'deltaT_12<50' into (field, window).
+    A window of None means the parser's short_window.
+    """
+
+    field, _, window = cut_str.partition('<')
+    if window:
+        return field.strip(), float(window)
+    return field.strip(), None
+
+
+class SpectrumDefinition(object):
+    """
+    A spectrum declared in spectrum_config, compiled to one hit-pattern
+    lookup table per term plus its timing and energy cuts.
+    """
+
+    def __init__(self, name, group, title, channel, hits, energy=None,
+                 log=None):
+
+        self.name = name
+        self.group = group
+        self.title = title
+        self.channel = int(channel)
+        self.field = 'energy_' + str(self.channel)
+        self.log = log
+
+        self.terms = []
+        for term in hits:
+            words = term.split()
+            cuts = tuple(parse_cut(cut) for cut in words[1:])
+            self.terms.append((pattern_lut(words[0]), cuts))
+
+        self.energy_cuts = [('energy_' + str(chan), low, high)
+                            for chan, (low, high) in (energy or {}).items()]
+
+    def mask(self, block, codes, timing_mask):
+        """
+        Events of 'block' falling in this spectrum. 'timing_mask' returns the
+        (cached) boolean mask of a timing cut.
+        """
+
+        sel = np.zeros(len(block), dtype=bool)
+        for lut, cuts in self.terms:
+            term = lut[codes]
+            for cut in cuts:
+                term &= timing_mask(cut)
+            sel |= term
+
+        for field, low, high in self.energy_cuts:
+            sel &= (block[field] >= low) & (block[field] <= high)
+
+        return sel
+
+
+def compile_definitions(spectra):
+    """Compile spectrum_config style dicts into SpectrumDefinitions."""
+
+    return [SpectrumDefinition(**spec) for spec in spectra]
+
+
+def evaluate_definitions(definitions, block, short_window):
+    """
+    Select the events of every definition from one block. Hit codes are
+    computed once and each distinct timing cut is evaluated only once, no
+    matter how many definitions share it.
+    """
+
+    codes = hit_codes(block)
+    cut_cache = {}
+
+    def timing_mask(cut):
+        if cut not in cut_cache:
+            field, window = cut
+            if window is None:
+                window = short_window
+            cut_cache[cut] = block[field] < window
+        return cut_cache[cut]
+
+    return [defn.mask(block, codes, timing_mask) for defn in definitions]
+
+
+class ChunkedSpectrum(object):
+    """
+    Time-chunked spectrum accumulator. Row k of the finished array holds the
+    cumulative counts of events less than k * t_steps after t_start, so row
+    0 is empty and the last row is the whole run.
+
+    By default the per-chunk counts are held in memory. Given a 'spill'
+    array of the final shape (e.g. a CArray in the HDF5 file), only the
+    running total and the chunks still open are kept in memory; each row is
+    written out as soon as the event stream has moved past it.
+    """
+
+    # Rows written to a spill array per write
+    spill_rows = 256
+
+    def __init__(self, definition, n_bins, n_chunks, t_start, t_steps,
+                 spill=None):
+
+        self.definition = definition
+        self.n_bins = n_bins
+        self.n_chunks = n_chunks
+        self.t_start = t_start
+        self.t_steps = t_steps
+        self.spill = spill
+
+        if spill is None:
+            self.dt_array = np.zeros((n_chunks + 1, n_bins), dtype=np.int32)
+        else:
+            self.flushed = 0
+            self.total = np.zeros(n_bins, dtype=np.int64)
+            self.pending = {}
+
+    def chunk_index(self, timestamp):
+        chunk = np.floor((timestamp - self.t_start) / self.t_steps)
+        return np.clip(chunk, 0, self.n_chunks - 1).astype(np.intp)
+
+    def update(self, block, sel):
+        energy = block[self.definition.field]
+        sel = sel & (energy >= 0) & (energy < self.n_bins)
+
+        chunk = self.chunk_index(block['timestamp'][sel])
+
+        # Histogram only the chunks present in this block
+        chunks, inverse = np.unique(chunk, return_inverse=True)
+        keys = inverse.ravel() * self.n_bins + energy[sel]
+        hist = np.bincount(keys, minlength=len(chunks) * self.n_bins)
+        hist = hist.reshape(len(chunks), self.n_bins)
+
+        if self.spill is None:
+            self.dt_array[chunks + 1] += hist
+        else:
+            for chunk, row in zip(chunks, hist):
+                self._add_spilled(chunk, row)
+            if len(block):
+                self._flush(self.chunk_index(block['timestamp'][-1:])[0])
+
+        return sel
+
+    def finish(self):
+        if self.spill is None:
+            return np.cumsum(self.dt_array, axis=0, out=self.dt_array)
+
+        self._flush(self.n_chunks)
+        return self.spill
+
+    def _add_spilled(self, chunk, row):
+        if chunk >= self.flushed:
+            if chunk in self.pending:
+                self.pending[chunk] += row
+            else:
+                self.pending[chunk] = row.astype(np.int64)
+            return
+
+        # Late event for a chunk already written: patch the rows after it
+        self.total += row
+        for start in range(chunk + 1, self.flushed, self.spill_rows):
+            stop = min(start + self.spill_rows, self.flushed)
+            self.spill[start:stop] = self.spill[start:stop] + row
+
+    def _flush(self, upto):
+        """Write every row up to 'upto' (inclusive) to the spill array."""
+
+        for start in range(self.flushed, upto + 1, self.spill_rows):
+            stop = min(start + self.spill_rows, upto + 1)
+
+            rows = np.empty((stop - start, self.n_bins), dtype=np.int32)
+            for k in range(start, stop):
+                rows[k - start] = self.total
+                self.total += self.pending.pop(k, 0)
+
+            self.spill[start:stop] = rows
+
+        self.flushed = max(self.flushed, upto + 1)
@@ -0,0 +1,404 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import struct
+import textwrap
+from datetime import datetime
+from functools import partial
+
+# External Imports
+import numpy as np
+import tables as tb
+
+# Internal Imports
+from calibration import parse_cal, parse_fit
+
+# Spectra handed to each worker at a time
+EXPORT_CHUNKSIZE = 8
+
+# see: "ORTEC-Sofware-File-Structure-Manual.pdf" for info
+SPE_HEADER = textwrap.dedent("""\
+    $SPEC_ID:
+    {spec_id}
+    $SPEC_REM:
+    DET# {det_no}
+    DETDESC# PYRAMDS
+    AP# Maestro Version 6.04
+
+    $DATE_MEA:
+    {date}
+    $MEAS_TIM:
+    {live:d} {real:d}
+    $DATA:
+    0 {last:d}
+    """).replace('\n', '\r\n')
+
+SPE_TRAILER = textwrap.dedent("""\
+    $ROI:
+    {n_roi:d}
+    {rois}$PRESETS:
+    None
+    0
+    0
+    $ENER_FIT:
+    {enerfit}
+    $MCA_CAL:
+    {mca_cal}
+    $SHAPE_CAL:
+    {shape_cal}
+    """).replace('\n', '\r\n')
+
+
+def format_spe(spec):
+    """
+    Text of an ORTEC .Spe file. 'spec' is a dict holding the counts array
+    and the header fields (spec_id, det_no, start, live, real, enerfit,
+    mca_cal, shape_cal). The channel block is formatted in one operation.
+    """
+
+    counts = np.asarray(spec['counts'])
+    rois = spec.get('rois', [])
+
+    header = SPE_HEADER.format(
+        spec_id=spec['spec_id'], det_no=spec['det_no'],
+        date=spec['start'].strftime("%m/%d/%Y %H:%M:%S"),
+        live=int(float(spec['live'])), real=int(float(spec['real'])),
+        last=len(counts) - 1)
+
+    data = ('%8d\r\n' * len(counts)) % tuple(counts.tolist())
+
+    trailer = SPE_TRAILER.format(
+        n_roi=len(rois),
+        rois=''.join('{0:d} {1:d}\r\n'.format(*roi) for roi in rois),
+        enerfit=spec['enerfit'], mca_cal=spec['mca_cal'],
+        shape_cal=spec['shape_cal'])
+
+    return header + data + trailer
+
+
+def write_spe(spec):
+    """Write one .Spe file in a single buffered write."""
+
+    path = spec['path'] + '.Spe'
+    with open(path, 'w') as specout:
+        specout.write(format_spe(spec))
+
+    return path
+
+
+def cal_coeffs(cal_str, fit_str, n_coeff=3):
+    """
+    First 'n_coeff' polynomial coefficients of an MCA_CAL/SHAPE_CAL string,
+    falling back to the ENER_FIT/FWHM_FIT string, zero padded.
+    """
+
+    coeff = parse_cal(cal_str)
+    if not len(coeff):
+        coeff = parse_fit(fit_str)
+
+    out = np.zeros(n_coeff)
+    out[:min(len(coeff), n_coeff)] = coeff[:n_coeff]
+    return out
+
+
+def format_chn(spec):
+    """
+    Bytes of an ORTEC integer .Chn file: 32-byte header, one int32 per
+    channel and the 512-byte trailer carrying the energy and FWHM
+    calibrations and the descriptions.
+    """
+
+    counts = np.asarray(spec['counts'], dtype='<i4')
+    start = spec['start']
+
+    # Times are in increments of 20 ms; the 8th date character flags 20xx
+    header = struct.pack(
+        '<hhh2sii8s4shh', -1, int(spec['det_no']), 1,
+        start.strftime('%S').encode('ascii'),
+        int(round(float(spec['real']) * 50)),
+        int(round(float(spec['live']) * 50)),
+        (start.strftime('%d%b%y').upper() +
+         ('1' if start.year >= 2000 else '0')).encode('ascii'),
+        start.strftime('%H%M').encode('ascii'), 0, len(counts))
+
+    en_coeff = cal_coeffs(spec['mca_cal'], spec['enerfit'])
+    fwhm_coeff = cal_coeffs(spec['shape_cal'], spec.get('fwhmfit', ''))
+
+    det_desc = 'PYRAMDS DET# {0}'.format(spec['det_no']).encode('ascii')[:63]
+    sample_desc = spec['spec_id'].encode('ascii')[:63]
+
+    trailer = struct.pack('<hh6f', -101, 0, *np.r_[en_coeff, fwhm_coeff])
+    trailer = trailer.ljust(256, b'\0')
+    trailer += struct.pack('<B63s', len(det_desc), det_desc)
+    trailer += struct.pack('<B63s', len(sample_desc), sample_desc)
+    trailer = trailer.ljust(512, b'\0')
+
+    return header + counts.tobytes() + trailer
+
+
+def write_chn(spec):
+    """Write one .Chn file in a single buffered write."""
+
+    path = spec['path'] + '.Chn'
+    with open(path, 'wb') as specout:
+        specout.write(format_chn(spec))
+
+    return path
+
+
+# Per-spectrum file writers, by export format name
+WRITERS = {'spe': write_spe, 'chn': write_chn}
+
+
+def write_formats(spec, formats=('spe',)):
+    """Write one spectrum in each of 'formats'; returns the paths."""
+
+    return [WRITERS[fmt](spec) for fmt in formats]
+
+
+def export_spectra(specs, workers=0, formats=('spe',)):
+    """
+    Write every spectrum in 'specs' in each of 'formats', spread over a pool
+    of 'workers' processes (0: one per CPU). Small batches are written in
+    this process. Returns the paths written.
+    """
+
+    paths = pool_map(partial(write_formats, formats=tuple(formats)), specs,
+                     workers)
+
+    return [path for spec_paths in paths for path in spec_paths]
+
+
+def pool_map(func, items, workers=0):
+    """
+    map() over a pool of 'workers' processes (0: one per CPU); small
+    batches are handled in this process, as is everything inside a pool
+    worker (e.g. a batch or watch-folder job), which cannot start a pool.
+    """
+
+    items = list(items)
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+
+    if (workers == 1 or len(items) <= EXPORT_CHUNKSIZE or
+            multiprocessing.current_process().daemon):
+        return [func(item) for item in items]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(func, items, EXPORT_CHUNKSIZE)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Metadata of each spectrum in a bulk results file
+RESULT_DTYPE = np.dtype([('label', 'S64'), ('det_no', 'i4'),
+                         ('start', 'S19'), ('live', 'f8'), ('real', 'f8'),
+                         ('enerfit', 'S64'), ('mca_cal', 'S128'),
+                         ('shape_cal', 'S128')])
+
+
+def result_row(spec):
+    row = np.zeros((), dtype=RESULT_DTYPE)
+    row['label'] = spec['spec_id'].split()[-1]
+    row['det_no'] = int(spec['det_no'])
+    row['start'] = spec['start'].strftime('%Y-%m-%dT%H:%M:%S')
+    row['live'] = float(spec['live'])
+    row['real'] = float(spec['real'])
+    for field in ('enerfit', 'mca_cal', 'shape_cal'):
+        row[field] = spec[field]
+    return row
+
+
+def write_results(path, specs):
+    """
+    Write every spectrum of 'specs' into one compressed results file: a
+    'counts' array (spectra x channels) and a 'spectra' table of RESULT_DTYPE
+    metadata, row for row. '.npz' files are written with savez_compressed;
+    anything else is written as HDF5, appending one spectrum at a time.
+    """
+
+    if path.endswith('.npz'):
+        specs = list(specs)
+        counts = np.array([spec['counts'] for spec in specs], dtype=np.int32)
+        meta = np.array([result_row(spec) for spec in specs],
+                        dtype=RESULT_DTYPE)
+        np.savez_compressed(path, counts=counts, spectra=meta)
+        return path
+
+    h5file = tb.openFile(path, mode='w', title='PYRAMDS Exported Spectra')
+    try:
+        counts = None
+        meta = h5file.createTable(h5file.root, 'spectra', RESULT_DTYPE,
+                                  "Exported spectrum metadata")
+        for spec in specs:
+            if counts is None:
+                counts = h5file.createEArray(
+                    h5file.root, 'counts', tb.Int32Atom(),
+                    (0, len(spec['counts'])), "Exported spectrum counts",
+                    filters=tb.Filters(complevel=5, complib='zlib',
+                                       shuffle=True))
+            counts.append(np.asarray(spec['counts'], dtype=np.int32)[None])
+            meta.append(result_row(spec)[None])
+        meta.flush()
+    finally:
+        h5file.close()
+
+    return path
+
+
+# Section headers ($DATA:, $MEAS_TIM:, ...) of a .Spe file
+SPE_SECTION = re.compile(r'^\$(\w+):[ \t]*$', re.M)
+
+
+def parse_spe(text, path=''):
+    """
+    Record (as taken by the writers) from the text of a .Spe file written by
+    PYRAMDS or Maestro. The $DATA block is converted in one operation.
+    """
+
+    parts = SPE_SECTION.split(text.replace('\r\n', '\n'))
+    sections = dict(zip(parts[1::2], [body.strip('\n') for body in
+                                      parts[2::2]]))
+
+    data = sections['DATA'].split(None, 2)
+    counts = np.array(data[2].split() if len(data) > 2 else [],
+                      dtype=np.int64)
+    counts = counts[:int(data[1]) - int(data[0]) + 1]
+
+    live, real = sections.get('MEAS_TIM', '0 0').split()[:2]
+    det_no = re.search(r'DET#\s*(\S+)', sections.get('SPEC_REM', ''))
+
+    roi_lines = sections.get('ROI', '0').split('\n')
+    rois = [tuple(int(x) for x in line.split()[:2])
+            for line in roi_lines[1:1 + int(roi_lines[0])]]
+
+    start = sections.get('DATE_MEA', '').strip()
+    start = datetime.strptime(start, "%m/%d/%Y %H:%M:%S") if start else None
+
+    return {
+        'path': os.path.splitext(path)[0],
+        'spec_id': sections.get('SPEC_ID', ''),
+        'det_no': det_no.group(1) if det_no else '',
+        'start': start,
+        'live': float(live),
+        'real': float(real),
+        'counts': counts,
+        'rois': rois,
+        'enerfit': sections.get('ENER_FIT', ''),
+        'mca_cal': sections.get('MCA_CAL', '').replace('\n', '\r\n'),
+        'shape_cal': sections.get('SHAPE_CAL', '').replace('\n', '\r\n'),
+    }
+
+
+def parse_chn(data, path=''):
+    """Record from the bytes of an integer ORTEC .Chn file."""
+
+    (file_type, det_no, _, seconds, real, live, date, hhmm, _,
+     n_channels) = struct.unpack('<hhh2sii8s4shh', data[:32])
+    if file_type != -1:
+        raise ValueError("Not an integer .Chn file: {0}".format(path))
+
+    counts = np.frombuffer(data[32:32 + 4 * n_channels], dtype='<i4')
+
+    start = datetime.strptime(
+        (date[:7] + hhmm + seconds).decode('ascii'), '%d%b%y%H%M%S')
+
+    en_coeff = np.zeros(3)
+    fwhm_coeff = np.zeros(3)
+    spec_id = ''
+    trailer = data[32 + 4 * n_channels:]
+    if len(trailer) >= 512:
+        coeffs = struct.unpack('<hh6f', trailer[:28])
+        en_coeff = np.array(coeffs[2:5])
+        fwhm_coeff = np.array(coeffs[5:8])
+        n_desc = struct.unpack('<B', trailer[320:321])[0]
+        spec_id = trailer[321:321 + n_desc].decode('ascii', 'replace')
+
+    return {
+        'path': os.path.splitext(path)[0],
+        'spec_id': spec_id,
+        'det_no': str(det_no),
+        'start': start,
+        'live': live / 50.0,
+        'real': real / 50.0,
+        'counts': counts.astype(np.int64),
+        'rois': [],
+        'enerfit': '{0:E} {1:E}'.format(*en_coeff[:2]),
+        'mca_cal': '3\r\n{0:E} {1:E} {2:E}'.format(*en_coeff),
+        'shape_cal': '3\r\n{0:E} {1:E} {2:E}'.format(*fwhm_coeff),
+    }
+
+
+def read_spectrum(path):
+    """Read one .Spe or .Chn file, chosen by extension."""
+
+    if path.lower().endswith('.chn'):
+        with open(path, 'rb') as specin:
+            return parse_chn(specin.read(), path)
+
+    with open(path, 'r') as specin:
+        return parse_spe(specin.read(), path)
+
+
+def cache_path(cache_dir, path):
+    """Cache file of spectrum file 'path' in 'cache_dir'."""
+
+    key = hashlib.md5(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.npz')
+
+
+def read_cached(path, cache_dir=None):
+    """
+    read_spectrum through an on-disk cache: the parsed record is kept in
+    'cache_dir' and reused for as long as the file's mtime is unchanged.
+    """
+
+    if cache_dir is None:
+        return read_spectrum(path)
+
+    mtime = os.path.getmtime(path)
+    cached = cache_path(cache_dir, path)
+
+    if os.path.exists(cached):
+        with np.load(cached) as stored:
+            header = json.loads(str(stored['header']))
+            if header.pop('mtime') == mtime:
+                if header['start']:
+                    header['start'] = datetime.strptime(
+                        header['start'], '%Y-%m-%dT%H:%M:%S')
+                header['rois'] = [tuple(roi) for roi in header['rois']]
+                header['counts'] = stored['counts']
+                return header
+
+    spec = read_spectrum(path)
+
+    header = dict((k, v) for k, v in spec.items() if k != 'counts')
+    header['mtime'] = mtime
+    if spec['start'] is not None:
+        header['start'] = spec['start'].strftime('%Y-%m-%dT%H:%M:%S')
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cached, 'wb') as cache_out:
+        np.savez(cache_out, counts=spec['counts'],
+                 header=np.array(json.dumps(header)))
+
+    return spec
+
+
+def read_spectra(paths, workers=0, cache_dir=None):
+    """
+    Read many .Spe/.Chn files in parallel into records (see parse_spe),
+    optionally through an mtime-keyed cache in 'cache_dir'.
+    """
+
+    return pool_map(partial(read_cached, cache_dir=cache_dir), paths, workers)
@@ -0,0 +1,77 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Author: Jordan Weaver
+
+# External Imports
+import numpy as np
+
+# Internal Imports
+from peak_fit import FWHM_SIGMA, SQRT_2PI, erfc, fit_peaks
+
+N_BINS = 512
+CENTRES = np.array([150.3, 161.8, 340.6])
+AREAS = np.array([4.0e4, 2.0e4, 3.0e4])
+FWHM = 6.0
+
+
+def synthetic_spectrum(step=0.0, seed=0):
+    """Gaussian peaks on a linear background (plus an erfc step)."""
+
+    chan = np.arange(N_BINS, dtype=float)
+    sigma = FWHM / FWHM_SIGMA
+
+    expected = 200.0 - 0.1 * chan
+    for centre, area in zip(CENTRES, AREAS):
+        u = (chan - centre) / sigma
+        expected += area / (SQRT_2PI * sigma) * np.exp(-0.5 * u * u)
+        expected += step * 0.5 * erfc(u / np.sqrt(2.0))
+
+    return np.random.RandomState(seed).poisson(expected)
+
+
+def check_fits(fits, area_tol=0.03):
+    assert fits.shape == (1, len(CENTRES))
+    assert fits['converged'].all()
+
+    fit = fits[0]
+    pulls = (fit['area'] - AREAS) / fit['area_err']
+    assert np.all(np.abs(fit['area'] / AREAS - 1.0) < area_tol)
+    assert np.all(np.abs(pulls) < 4.0)
+    assert np.all(np.abs(fit['centroid'] - CENTRES) < 0.1)
+    assert np.all(np.abs(fit['fwhm'] / FWHM - 1.0) < 0.05)
+
+
+def test_linear_background():
+    spectrum = synthetic_spectrum()
+    start = CENTRES + np.array([1.0, -1.0, 0.5])
+    check_fits(fit_peaks(spectrum, start, np.ones(N_BINS) * FWHM))
+
+
+def test_step_background():
+    spectrum = synthetic_spectrum(step=40.0)
+    start = CENTRES + np.array([1.0, -1.0, 0.5])
+    # The steps of the doublet trade off against the background slope,
+    # so its areas are less certain
+    check_fits(fit_peaks(spectrum, start, np.ones(N_BINS) * FWHM,
+                         step=True), area_tol=0.1)
+
+
+def test_time_chunks():
+    # Every row of a chunk array is fitted in the same batch
+    spectra = np.array([synthetic_spectrum(seed=seed) for seed in range(8)])
+    fits = fit_peaks(spectra, CENTRES, np.ones(N_BINS) * FWHM)
+
+    assert fits.shape == (8, len(CENTRES))
+    assert fits['converged'].all()
+    assert np.all(np.abs(fits['area'].mean(axis=0) / AREAS - 1.0) < 0.01)
+
+
+def test_shared_channel():
+    # Centres in the same channel are fitted once and share the result
+    spectrum = synthetic_spectrum()
+    centres = np.r_[CENTRES, CENTRES[2] + 0.2]
+    fits = fit_peaks(spectrum, centres, np.ones(N_BINS) * FWHM)
+
+    assert fits.shape == (1, len(centres))
+    assert fits[0, 3]['area'] == fits[0, 2]['area']
+    assert np.abs(fits[0, 3]['area'] / AREAS[2] - 1.0) < 0.03
@@ -0,0 +1,236 @@
+# PYRAMDS (Python for Radioisotope Analysis & Multidetector Suppression)
+#
+# Watch-folder daemon: polls directories for finished PIXIE file series and
+# parses and exports each one on a pool of worker processes.
+#
+# Author: Jordan Weaver
+
+# Standard Library Imports
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from os.path import getmtime, getsize, join
+
+# Internal Imports
+from jobs import POOL_SETTINGS, run_job
+
+# Seconds between directory scans, and the time a series' files must stay
+# unchanged before it is taken as complete
+POLL_INTERVAL = 30.0
+SETTLE_TIME = 60.0
+
+# Failed jobs are tried again up to RETRIES times, RETRY_DELAY seconds
+# later for each attempt made so far
+RETRIES = 2
+RETRY_DELAY = 60.0
+
+STATUS_FILE = 'pyramds_jobs.json'
+
+
+def find_series(directory):
+    """
+    Series in a directory with the (name, size, mtime) of their .bin and
+    .ifm files, keyed by series path (the series_basename of the parser).
+    """
+
+    series = {}
+    for name in sorted(os.listdir(directory)):
+        ext = name[-4:]
+        if ext not in ('.bin', '.ifm') or not name[-8:-4].isdigit():
+            continue
+
+        path = join(directory, name)
+        series.setdefault(join(directory, name[:-8]), []).append(
+            [name, getsize(path), getmtime(path)])
+
+    return series
+
+
+def is_complete(files, now, settle=SETTLE_TIME):
+    """
+    A series is complete once every .bin file has the .ifm that PIXIE
+    writes when the file is closed, and nothing has changed for 'settle'.
+    """
+
+    names = set(entry[0] for entry in files)
+    bins = [name for name in names if name.endswith('.bin')]
+    if not bins or any(name[:-4] + '.ifm' not in names for name in bins):
+        return False
+
+    return now - max(entry[2] for entry in files) >= settle
+
+
+class WatchFolder(object):
+    """
+    Polls 'directories' for complete series, queues each new or changed
+    one and runs it with jobs.run_job on 'workers' processes. The state of
+    every job (queued, running, retry, done, failed) with its attempts,
+    outputs, timings and errors is kept in a JSON status file, which also
+    lets a restarted daemon skip series it has already done.
+    """
+
+    def __init__(self, directories, status_file=None, workers=2,
+                 poll_interval=POLL_INTERVAL, settle=SETTLE_TIME,
+                 retries=RETRIES, retry_delay=RETRY_DELAY, overrides=None,
+                 export=True):
+
+        self.directories = list(directories)
+        self.status_file = status_file or join(self.directories[0],
+                                               STATUS_FILE)
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.overrides = dict(overrides or {}, **POOL_SETTINGS)
+        self.export = export
+
+        self.jobs = {}
+        self.running = {}
+        if os.path.exists(self.status_file):
+            with open(self.status_file) as f:
+                self.jobs = json.load(f)
+
+        # Jobs cut short by a restart are run again
+        for job in self.jobs.values():
+            if job['status'] == 'running':
+                job['status'] = 'queued'
+
+    def scan(self, now):
+        """Queue complete series that are new or changed since their job."""
+
+        for directory in self.directories:
+            for series, files in find_series(directory).items():
+                if not is_complete(files, now, self.settle):
+                    continue
+
+                job = self.jobs.get(series)
+                if job is not None and job['files'] == files:
+                    continue
+
+                # The lowest-numbered .bin file found, which is not
+                # always ...0001.bin (e.g. a partial copy)
+                first = min(entry[0] for entry in files
+                            if entry[0].endswith('.bin'))
+                self.jobs[series] = {
+                    'status': 'queued', 'files': files, 'attempts': 0,
+                    'next_try': now, 'queued': now,
+                    'data_file': join(directory, first),
+                }
+
+    def collect(self, now):
+        """Record the results of finished jobs, scheduling retries."""
+
+        for series, result in list(self.running.items()):
+            if not result.ready():
+                continue
+
+            del self.running[series]
+            job = self.jobs[series]
+            try:
+                summary = result.get()
+            except Exception as err:
+                summary = {'status': 'failed', 'error': repr(err)}
+
+            job.update(summary)
+            job['finished'] = now
+            if summary['status'] == 'failed' and \
+                    job['attempts'] <= self.retries:
+                job['status'] = 'retry'
+                job['next_try'] = now + self.retry_delay * job['attempts']
+
+    def submit(self, pool, now):
+        """Start waiting jobs, oldest first, while workers are free."""
+
+        waiting = sorted((job['queued'], series) for series, job in
+                         self.jobs.items()
+                         if job['status'] in ('queued', 'retry') and
+                         job['next_try'] <= now)
+
+        for _, series in waiting[:self.workers - len(self.running)]:
+            job = self.jobs[series]
+            job['status'] = 'running'
+            job['attempts'] += 1
+            job['started'] = now
+            self.running[series] = pool.apply_async(
+                run_job, (job['data_file'], self.overrides, self.export))
+
+    def save(self):
+        # Written to a temporary file first so readers never see half of it
+        tmp_path = self.status_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.jobs, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.status_file)
+
+    def poll(self, pool):
+        now = time.time()
+        self.collect(now)
+        self.scan(now)
+        self.submit(pool, now)
+        self.save()
+
+    def pending(self):
+        return bool(self.running) or any(
+            job['status'] in ('queued', 'retry') for job in self.jobs.values())
+
+    def run(self, once=False):
+        """
+        Poll until interrupted; with 'once', stop after the series found in
+        the first scan (and their retries) have finished.
+        """
+
+        # A fresh process per job, so each parse starts with clean memory
+        pool = multiprocessing.Pool(self.workers, maxtasksperchild=1)
+        try:
+            self.poll(pool)
+            while not once or self.pending():
+                time.sleep(self.poll_interval if not once else
+                           min(self.poll_interval, 1.0))
+                now = time.time()
+                self.collect(now)
+                if not once:
+                    self.scan(now)
+                self.submit(pool, now)
+                self.save()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parse and export PIXIE series as they appear in the "
+                    "watched directories.")
+    parser.add_argument('directories', nargs='+')
+    parser.add_argument('--status', default=None,
+                        help="job status file (default: "
+                             "<first directory>/" + STATUS_FILE + ")")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--poll', type=float, default=POLL_INTERVAL)
+    parser.add_argument('--settle', type=float, default=SETTLE_TIME)
+    parser.add_argument('--retries', type=int, default=RETRIES)
+    parser.add_argument('--retry-delay', type=float, default=RETRY_DELAY)
+    parser.add_argument('--settings', default=None,
+                        help="JSON file of parser/exporter settings")
+    parser.add_argument('--no-export', action='store_true')
+    parser.add_argument('--once', action='store_true',
+                        help="process what is there now, then exit")
+    args = parser.parse_args(argv)
+
+    overrides = None
+    if args.settings:
+        with open(args.settings) as f:
+            overrides = json.load(f)
+
+    watcher = WatchFolder(args.directories, args.status, args.workers,
+                          args.poll, args.settle, args.retries,
+                          args.retry_delay, overrides, not args.no_export)
+    try:
+        watcher.run(args.once)
+    except KeyboardInterrupt:
+        watcher.save()
+
+if __name__ == '__main__':
+    main()